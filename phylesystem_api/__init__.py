@@ -1,8 +1,10 @@
 """The main function needed to configure pyramids to run the phylesystem API."""
 import logging
 from pyramid.config import Configurator
+from pyramid.renderers import JSON
 from pyramid.request import Request
 from pyramid.request import Response
+from phylesystem_api import json_codec
 from phylesystem_api.utility import fill_app_settings
 
 _LOG = logging.getLogger(__name__)
@@ -33,11 +35,14 @@ def main(global_config, **settings):
     """Return a Pyramid WSGI application after configuring the routes for phylesystem API."""
     _LOG.debug('main running from "{}" and called with "{}"'.format(global_config['here'],
                                                                     global_config['__file__']))
-    from phylesystem_api.utility import get_resource_type_to_umbrella_name_copy
+    from phylesystem_api.utility import (get_doc_id_pattern,
+                                         get_resource_type_to_umbrella_name_copy)
     fill_app_settings(settings)
     config = Configurator(settings=settings)
     config.include('pyramid_chameleon')
+    config.add_renderer('json', JSON(serializer=json_codec.renderer_serializer))
     config.set_request_factory(request_factory)
+    config.add_tween('phylesystem_api.request_limits.body_size_limit_tween_factory')
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
     config.add_route('index', '/index')
@@ -54,13 +59,10 @@ def main(global_config, **settings):
 
     # The doc IDs have different regex patterns, so we build a url frag to match each type
     # these can be used in URLs that are specific to one resource type.
-    phylesystem = settings['phylesystem']
-    taxon_amendments = settings['taxon_amendments']
-    tree_collections = settings['tree_collections']
-    _LOG.debug('ID of tree_collections = {}'.format(id(tree_collections)))
-    study_id_frag = "{doc_id:" + phylesystem.id_regex.pattern + "}"
-    study_id_ext_frag = "{doc_id:" + phylesystem.id_regex.pattern + "[.][a-z]+}"
-    amendment_id_frag = "{doc_id:" + taxon_amendments.id_regex.pattern + "}"
+    study_id_pattern = get_doc_id_pattern(settings, 'phylesystem')
+    study_id_frag = "{doc_id:" + study_id_pattern + "}"
+    study_id_ext_frag = "{doc_id:" + study_id_pattern + "[.][a-z]+}"
+    amendment_id_frag = "{doc_id:" + get_doc_id_pattern(settings, 'taxon_amendments') + "}"
     collection_id_frag = "{coll_user_id:[a-zA-Z0-9-]+}/{coll_id:[a-zA-Z0-9-]+}"
     # Set up the routes that we anticipate using in v4 and above:
     config.add_route('versioned_home',
@@ -69,6 +71,15 @@ def main(global_config, **settings):
     config.add_route('versioned_index',
                      v_prefix + '/index',
                      request_method='GET')
+    config.add_route('versioned_health',
+                     v_prefix + '/health',
+                     request_method='GET')
+    config.add_route('cache_stats',
+                     v_prefix + '/cache_stats',
+                     request_method='GET')
+    config.add_route('batch_get',
+                     v_prefix + '/batch',
+                     request_method='POST')
     config.add_route('render_markdown',
                      v_prefix + '/render_markdown',
                      request_method='POST')
@@ -87,6 +98,9 @@ def main(global_config, **settings):
     config.add_route('generic_push',
                      v_rt_prefix + '/push',
                      request_method='PUT')
+    config.add_route('bulk_write',
+                     v_rt_prefix + '/bulk',
+                     request_method='POST')
     config.add_route('generic_push_failure',
                      v_rt_prefix + '/push_failure',
                      request_method='GET')
@@ -121,6 +135,16 @@ def main(global_config, **settings):
     config.add_route('put_tree_collection_via_id',
                      v_prefix + '/collection/' + collection_id_frag,
                      request_method='PUT')
+    # PATCH methods need the doc id
+    config.add_route('patch_study_via_id',
+                     v_prefix + '/study/' + study_id_frag,
+                     request_method='PATCH')
+    config.add_route('patch_taxon_amendment_via_id',
+                     v_prefix + '/amendment/' + amendment_id_frag,
+                     request_method='PATCH')
+    config.add_route('patch_tree_collection_via_id',
+                     v_prefix + '/collection/' + collection_id_frag,
+                     request_method='PATCH')
     # DELETE methods need the doc id
     config.add_route('delete_study_via_id',
                      v_prefix + '/study/' + study_id_frag,
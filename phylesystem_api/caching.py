@@ -0,0 +1,215 @@
+"""In-process caches used to avoid repeating git, parsing and serialization work.
+
+Every cache is registered by name when it is created, so that its counters can be reported by
+the `cache_stats` view and its size can be configured in the INI file with:
+    {name}_cache_max_entries = ...
+    {name}_cache_max_bytes = ...
+SingleFlight groups (which coalesce concurrent identical computations) are reported too.
+"""
+import sys
+from collections import OrderedDict
+from threading import Event, Lock
+
+from peyotl import get_logger
+from pyramid.httpexceptions import HTTPException
+
+_LOG = get_logger(__name__)
+_REGISTRY = OrderedDict()
+_FLIGHT_REGISTRY = OrderedDict()
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded, least-recently-used cache with hit/miss/eviction counters.
+
+    The cache is bounded by the number of entries and (optionally) by the sum of the sizes of the
+    values, where the size of a value is supplied by the caller of `put`. A max of 0 disables the
+    cache.
+    """
+
+    def __init__(self, name, max_entries=256, max_bytes=None):
+        """Creates and registers the cache with the name `name`."""
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        _REGISTRY[name] = self
+
+    def get(self, key, default=None):
+        """Returns the value cached for `key` (and marks it as recently used) or `default`."""
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        """Stores `value` for `key`, evicting the least recently used entries if needed."""
+        with self._lock:
+            if self.max_entries == 0 or (self.max_bytes is not None and size > self.max_bytes):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._num_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._num_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """Drops the oldest entries until the cache is within its bounds. Lock must be held."""
+        while self._entries and ((len(self._entries) > self.max_entries)
+                                 or (self.max_bytes is not None
+                                     and self._num_bytes > self.max_bytes)):
+            size = self._entries.popitem(last=False)[1][1]
+            self._num_bytes -= size
+            self.evictions += 1
+
+    def discard_if(self, predicate):
+        """Removes every entry whose key satisfies `predicate`. Returns the number removed."""
+        with self._lock:
+            doomed = [k for k in self._entries if predicate(k)]
+            for key in doomed:
+                self._num_bytes -= self._entries.pop(key)[1]
+            self.invalidations += len(doomed)
+            return len(doomed)
+
+    def clear(self):
+        """Removes all entries (counters are not reset)."""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """Changes the bounds of the cache (None leaves a bound unchanged)."""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        """Returns a dict of the sizes, bounds and counters of the cache."""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._num_bytes,
+                    'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations, }
+
+
+class _Flight(object):
+    """A computation in progress in a SingleFlight group."""
+
+    def __init__(self):
+        """Creates an unfinished flight."""
+        self.done = Event()
+        self.num_waiters = 0
+        self.result = None
+        self.exc_info = None
+
+
+def _copy_of_http_exception(exc):
+    """Returns a new instance of the HTTPException `exc` with the same detail, headers and body.
+    """
+    copied = exc.__class__(detail=exc.detail, comment=exc.comment)
+    copied.body = exc.body
+    copied.headerlist = list(exc.headerlist)
+    return copied
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into one computation.
+
+    The first caller for a key runs the computation; callers that arrive while it is running
+    wait for it and get the same result (or exception). An HTTPException is a mutable Response
+    (Pyramid prepares its body when it is rendered), so each caller gets its own copy of it.
+    Nothing is kept once the computation has finished, so this is not a cache.
+    """
+
+    def __init__(self, name):
+        """Creates and registers the group with the name `name`."""
+        self.name = name
+        self._lock = Lock()
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+        _FLIGHT_REGISTRY[name] = self
+
+    def do(self, key, fn, *args, **kwargs):
+        """Returns (result of fn(*args, **kwargs), shared) for the flight of `key`.
+
+        `shared` is True if the result was handed to more than one caller (so it must be
+        treated as read-only).
+        """
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                flight.num_waiters += 1
+                self.coalesced += 1
+        if not is_leader:
+            flight.done.wait()
+            if flight.exc_info is not None:
+                exc_type, exc, tb = flight.exc_info
+                if isinstance(exc, HTTPException):
+                    exc = _copy_of_http_exception(exc)
+                raise exc_type, exc, tb
+            return flight.result, True
+        try:
+            flight.result = fn(*args, **kwargs)
+        except:
+            exc_type, exc, tb = sys.exc_info()
+            # the waiters copy a copy, as the caller may change `exc` while they do so
+            shared = _copy_of_http_exception(exc) if isinstance(exc, HTTPException) else exc
+            flight.exc_info = exc_type, shared, tb
+            raise exc_type, exc, tb
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, flight.num_waiters > 0
+
+    def stats(self):
+        """Returns a dict of the counters of the group."""
+        with self._lock:
+            return {'calls': self.calls,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self._flights), }
+
+
+def cache_stats():
+    """Returns a dict mapping the name of each registered cache (or SingleFlight group) to its
+    `stats()`."""
+    stats = {name: cache.stats() for name, cache in _REGISTRY.items()}
+    stats.update({name: group.stats() for name, group in _FLIGHT_REGISTRY.items()})
+    return stats
+
+
+def configure_caches(settings):
+    """Applies the "{name}_cache_max_entries" and "{name}_cache_max_bytes" settings."""
+    for name, cache in _REGISTRY.items():
+        max_entries = settings.get('{}_cache_max_entries'.format(name))
+        max_bytes = settings.get('{}_cache_max_bytes'.format(name))
+        if max_entries is not None or max_bytes is not None:
+            msg = 'resizing {} cache to {} entries, {} bytes'
+            _LOG.debug(msg.format(name, max_entries, max_bytes))
+            cache.resize(max_entries=None if max_entries is None else int(max_entries),
+                         max_bytes=None if max_bytes is None else int(max_bytes))
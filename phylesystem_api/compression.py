@@ -0,0 +1,165 @@
+"""Content-Encoding negotiation and cached compression of response bodies.
+
+Views opt in by calling `compress_response(request, cache_key)`. That registers a response
+callback that compresses the response with the best encoding that the client accepts
+("br" if the optional brotli package is installed, or "gzip"). Compressed bodies are held in
+the "compressed_body" cache, keyed by the encoding and either the `cache_key` supplied by the
+view or a hash of the uncompressed body, so a hot document is compressed once.
+
+Streamed responses (see `streaming_json_response`) are compressed incrementally; the result is
+cached only if the view supplied a `cache_key` (as the body is never available as a whole).
+"""
+import functools
+import hashlib
+import zlib
+
+from peyotl import get_logger
+
+from phylesystem_api.caching import LRUCache
+
+try:
+    # noinspection PyPackageRequirements
+    import brotli
+except ImportError:
+    brotli = None
+
+_LOG = get_logger(__name__)
+_COMPRESSED_BODY_CACHE = LRUCache('compressed_body',
+                                  max_entries=256,
+                                  max_bytes=64 * 1024 * 1024)
+# bodies smaller than this are not worth compressing
+_MIN_COMPRESSIBLE_SIZE = 1024
+_GZIP_LEVEL = 6
+_BROTLI_QUALITY = 6
+
+
+def _supported_encodings():
+    """Returns the content codings that we can produce, in order of preference."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_content_encoding(request):
+    """Returns "br", "gzip" or None based on the Accept-Encoding header of `request`."""
+    if not request.headers.get('Accept-Encoding'):
+        return None
+    offers = _supported_encodings()
+    accept = request.accept_encoding
+    if hasattr(accept, 'acceptable_offers'):
+        acceptable = accept.acceptable_offers(offers)
+        return acceptable[0][0] if acceptable else None
+    return accept.best_match(offers)
+
+
+class _Compressor(object):
+    """Incremental compressor with the same interface for both encodings."""
+
+    def __init__(self, encoding):
+        """Creates a compressor for "gzip" or "br"."""
+        if encoding == 'gzip':
+            self._impl = zlib.compressobj(_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._process, self._finish = self._impl.compress, self._impl.flush
+        else:
+            self._impl = brotli.Compressor(quality=_BROTLI_QUALITY)
+            process = getattr(self._impl, 'process', None) or self._impl.compress
+            self._process, self._finish = process, self._impl.finish
+
+    def compress(self, data):
+        """Returns the compressed output (possibly empty) produced by adding `data`."""
+        return self._process(data)
+
+    def finish(self):
+        """Returns the rest of the compressed output."""
+        return self._finish()
+
+
+def compress_bytes(data, encoding):
+    """Returns `data` compressed with `encoding` ("gzip" or "br")."""
+    compressor = _Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def _iter_compressed(app_iter, encoding, cache_key):
+    """Yields the compressed form of the chunks of `app_iter`, caching the result if a
+    `cache_key` is given."""
+    compressor = _Compressor(encoding)
+    output, size = [], 0
+    try:
+        for chunk in app_iter:
+            out = compressor.compress(chunk)
+            if out:
+                size += len(out)
+                if cache_key is not None:
+                    output.append(out)
+                yield out
+        out = compressor.finish()
+        if cache_key is not None:
+            output.append(out)
+            _COMPRESSED_BODY_CACHE.put(cache_key, ''.join(output), size=size + len(out))
+        yield out
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def _add_vary_accept_encoding(response):
+    """Adds Accept-Encoding to the Vary header of `response`."""
+    vary = tuple(response.vary or ())
+    if 'Accept-Encoding' not in vary:
+        response.vary = vary + ('Accept-Encoding',)
+
+
+def encoded_etag(etag, encoding):
+    """Returns the ETag of the `encoding` form of a response with the ETag `etag`."""
+    return '{}-{}'.format(etag, encoding)
+
+
+def etag_variants(etag):
+    """Returns the list of ETags that a response with the (identity) `etag` could be sent with.
+    """
+    return [etag] + [encoded_etag(etag, e) for e in _supported_encodings()]
+
+
+def _compress_response_callback(request, response, cache_key=None):
+    """Response callback that compresses the body of `response` (see `compress_response`)."""
+    if response.status_int != 200 or response.content_encoding:
+        return
+    _add_vary_accept_encoding(response)
+    encoding = negotiate_content_encoding(request)
+    if encoding is None:
+        return
+    streamed = response.content_length is None
+    if streamed:
+        key = None if cache_key is None else (encoding, cache_key)
+        compressed = None if key is None else _COMPRESSED_BODY_CACHE.get(key)
+        if compressed is None:
+            response.app_iter = _iter_compressed(response.app_iter, encoding, key)
+        else:
+            if hasattr(response.app_iter, 'close'):
+                response.app_iter.close()
+            response.body = compressed
+    else:
+        body = response.body
+        if len(body) < _MIN_COMPRESSIBLE_SIZE:
+            return
+        if cache_key is None:
+            key = (encoding, hashlib.sha1(body).hexdigest())
+        else:
+            key = (encoding, cache_key)
+        compressed = _COMPRESSED_BODY_CACHE.get(key)
+        if compressed is None:
+            compressed = compress_bytes(body, encoding)
+            _COMPRESSED_BODY_CACHE.put(key, compressed, size=len(compressed))
+        response.body = compressed
+    response.content_encoding = encoding
+    if response.etag:
+        response.etag = encoded_etag(response.etag, encoding)
+
+
+def compress_response(request, cache_key=None):
+    """Arranges for the response to `request` to be compressed if the client accepts it.
+
+    `cache_key` must identify the uncompressed body (e.g. an ETag). If it is None, the key is
+    a hash of the body (and streamed responses are not cached).
+    """
+    request.add_response_callback(functools.partial(_compress_response_callback,
+                                                    cache_key=cache_key))
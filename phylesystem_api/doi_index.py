@@ -0,0 +1,176 @@
+"""In-process index of the publication DOIs of the studies in the phylesystem.
+
+The index is used to fill the "duplicateStudyIDs" field of study GETs without calling otindex.
+It is built by reading every study once (normally in a background thread at startup). It
+records the SHA of the master branch of each shard that it reflects, and `sync` brings it up to
+date by re-reading only the studies whose files differ between that SHA and the current master
+(so writes made by other processes, and pulls triggered by webhooks, are also picked up).
+"""
+import os
+import subprocess
+from threading import Lock, Thread
+
+from peyotl import get_logger
+
+from phylesystem_api.git_refs import read_ref_sha
+
+_LOG = get_logger(__name__)
+
+
+def doi_key(doi):
+    """Returns the normalized form of a DOI (or DOI URL) used as a key of the index."""
+    candidate = ''.join(doi.split()).lower()
+    start = candidate.find('10.')
+    return candidate if start < 0 else candidate[start:]
+
+
+def study_doi(nexson):
+    """Returns the publication DOI (URL) of a NexSON study blob or None."""
+    try:
+        return nexson['nexml']['^ot:studyPublication']['@href'] or None
+    except:
+        return None
+
+
+def _changed_doc_ids(repo_path, old_sha, new_sha):
+    """Returns the set of IDs of the JSON documents that differ between two commits."""
+    out = subprocess.check_output(['git', '-c', 'core.quotepath=off', 'diff', '--name-only',
+                                   '--no-renames', old_sha, new_sha], cwd=repo_path)
+    changed = set()
+    for rel_path in out.decode('utf-8').split('\n'):
+        filename = os.path.basename(rel_path.strip())
+        if filename.endswith('.json'):
+            changed.add(filename[:-len('.json')])
+    return changed
+
+
+class StudyDOIIndex(object):
+    """Maps normalized DOIs to the IDs of the studies (on master) that cite them."""
+
+    def __init__(self, get_umbrella):
+        """:param get_umbrella: callable that takes no arguments and returns the phylesystem."""
+        self._get_umbrella = get_umbrella
+        self._lock = Lock()  # guards the maps
+        self._sync_lock = Lock()  # serializes builds and syncs
+        self._doi_to_ids = {}
+        self._id_to_doi = {}
+        self._shard_shas = None  # repo path -> SHA of master reflected in the index
+        self._build_pid = None
+        self._failed = False
+
+    @property
+    def status(self):
+        """Returns "ready", "failed", or "pending" without blocking."""
+        if self._shard_shas is not None:
+            return 'ready'
+        return 'failed' if self._failed else 'pending'
+
+    def start_background_build(self):
+        """Launches a daemon thread that builds the index (if it has not been built)."""
+        self._build_pid = os.getpid()
+        t = Thread(target=self._build_quietly, name='build-study-doi-index')
+        t.setDaemon(True)
+        t.start()
+
+    def _build_quietly(self):
+        """Calls `ensure_built`, logging any error."""
+        try:
+            self.ensure_built()
+        except:
+            self._failed = True
+            self._build_pid = None  # the next lookup will retry
+            _LOG.exception('building the study DOI index failed')
+
+    @staticmethod
+    def _read_shard_shas(umbrella):
+        """Returns a dict of shard repo path -> SHA of its master branch."""
+        shards = umbrella.get_configuration_dict()['shards']
+        return {s['path']: read_ref_sha(s['path'], 'refs/heads/master') for s in shards}
+
+    def _set_study_doi(self, doc_id, doi):
+        """Records `doi` (may be None) as the DOI of `doc_id`. Caller must hold self._lock."""
+        old_key = self._id_to_doi.pop(doc_id, None)
+        if old_key is not None:
+            ids = self._doi_to_ids.get(old_key)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self._doi_to_ids[old_key]
+        if doi:
+            key = doi_key(doi)
+            self._id_to_doi[doc_id] = key
+            self._doi_to_ids.setdefault(key, set()).add(doc_id)
+
+    def ensure_built(self):
+        """Builds the index by reading every study, unless it has already been built."""
+        if self._shard_shas is not None:
+            return
+        umbrella = self._get_umbrella()
+        with self._sync_lock:
+            if self._shard_shas is not None:
+                return
+            # read the refs first, so that commits that land during the walk are synced later
+            shard_shas = self._read_shard_shas(umbrella)
+            with self._lock:
+                self._doi_to_ids, self._id_to_doi = {}, {}
+            for doc_id, nexson in umbrella.iter_doc_objs():
+                doi = study_doi(nexson)
+                with self._lock:
+                    self._set_study_doi(doc_id, doi)
+            self._shard_shas = shard_shas
+            self._failed = False
+        _LOG.debug('study DOI index built with {} DOIs'.format(len(self._doi_to_ids)))
+
+    def _refresh_study(self, umbrella, doc_id):
+        """Re-reads the master version of `doc_id` (which may have been deleted)."""
+        try:
+            nexson = umbrella.return_document(doc_id)[0]
+        except:
+            nexson = None
+        with self._lock:
+            self._set_study_doi(doc_id, study_doi(nexson) if nexson is not None else None)
+
+    def sync(self):
+        """Updates the index for the studies changed on master since the last build or sync.
+
+        Does nothing if the index has not been built.
+        """
+        if self._shard_shas is None:
+            return
+        umbrella = self._get_umbrella()
+        with self._sync_lock:
+            current = self._read_shard_shas(umbrella)
+            if current == self._shard_shas:
+                return
+            changed = set()
+            for repo_path, new_sha in current.items():
+                old_sha = self._shard_shas.get(repo_path)
+                if old_sha == new_sha or new_sha is None:
+                    continue
+                try:
+                    if old_sha is None:
+                        raise ValueError('new shard {}'.format(repo_path))
+                    changed.update(_changed_doc_ids(repo_path, old_sha, new_sha))
+                except:
+                    # new shard, or a forced update removed old_sha. Re-read every study.
+                    _LOG.exception('could not diff {} to {}'.format(old_sha, new_sha))
+                    changed.update(doc_id for doc_id, _ in umbrella.iter_doc_objs())
+            for doc_id in changed:
+                self._refresh_study(umbrella, doc_id)
+            self._shard_shas = current
+        _LOG.debug('study DOI index synced for {} changed studies'.format(len(changed)))
+
+    def find_studies(self, doi):
+        """Returns the sorted list of IDs of studies with `doi`, or None if the index is not
+        ready (in which case a build is started if none is running in this process).
+        """
+        if self.status != 'ready':
+            if self._build_pid != os.getpid():
+                self.start_background_build()  # lazy start, or a fork interrupted a build
+            return None
+        try:
+            self.sync()
+        except:
+            _LOG.exception('sync of the study DOI index failed')
+        with self._lock:
+            return sorted(self._doi_to_ids.get(doi_key(doi), ()))
@@ -0,0 +1,131 @@
+"""Reads of documents from the object databases of the shards with `git cat-file --batch`.
+
+peyotl reads a document by checking out the branch (or commit) in the shard's working tree,
+which requires the shard's lock, so GETs wait for writes. Blobs can instead be read from the
+object database for any commit without touching the working tree. Each shard has a pool of
+long-lived `git cat-file --batch` processes, so a read is a write and a read on a pipe rather
+than a fork of git.
+"""
+import os
+import subprocess
+from threading import BoundedSemaphore, Lock
+
+from peyotl import get_logger
+
+_LOG = get_logger(__name__)
+_DEFAULT_PROCESSES_PER_SHARD = 2
+_POOLS = {}
+_POOLS_LOCK = Lock()
+_POOLS_PID = None
+_PROCESSES_PER_SHARD = _DEFAULT_PROCESSES_PER_SHARD
+
+
+class CatFileProcess(object):
+    """One `git cat-file --batch` process for the repo at `repo_path`. Not thread-safe."""
+
+    def __init__(self, repo_path):
+        """Launches the git process."""
+        self._proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                      cwd=repo_path,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+
+    def read_object(self, spec):
+        """Returns (object type, content) for `spec` (e.g. "SHA:path"), or None if missing."""
+        if '\n' in spec:
+            raise ValueError('object name cannot contain a newline')
+        if isinstance(spec, unicode):
+            spec = spec.encode('utf-8')
+        self._proc.stdin.write(spec + '\n')
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline()
+        if not header:
+            raise IOError('git cat-file exited')
+        fields = header.split()
+        if len(fields) != 3:
+            # "<spec> missing" or "<spec> ambiguous"
+            return None
+        obj_type, size = fields[1], int(fields[2])
+        content = self._proc.stdout.read(size)
+        self._proc.stdout.read(1)  # the newline that follows the content
+        if len(content) != size:
+            raise IOError('git cat-file output was truncated')
+        return obj_type, content
+
+    def close(self):
+        """Ends the git process."""
+        try:
+            self._proc.stdin.close()
+            self._proc.wait()
+        except:
+            _LOG.exception('closing git cat-file failed')
+
+
+class CatFilePool(object):
+    """Up to `max_processes` CatFileProcess instances shared by the threads that read a repo."""
+
+    def __init__(self, repo_path, max_processes=_DEFAULT_PROCESSES_PER_SHARD):
+        """Creates an empty pool; processes are launched when they are first needed."""
+        self.repo_path = repo_path
+        self._idle = []
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_processes)
+
+    def read_object(self, spec):
+        """Returns (object type, content) for `spec`, or None if the object does not exist.
+
+        Waits if all of the processes are busy. A process that fails is discarded (and the
+        exception re-raised); a new one is launched for a later call.
+        """
+        with self._slots:
+            with self._lock:
+                proc = self._idle.pop() if self._idle else None
+            if proc is None:
+                proc = CatFileProcess(self.repo_path)
+            try:
+                result = proc.read_object(spec)
+            except:
+                proc.close()
+                raise
+            with self._lock:
+                self._idle.append(proc)
+            return result
+
+    def read_blob(self, commit_sha, rel_path):
+        """Returns the content of the file at `rel_path` in the commit `commit_sha`, or None."""
+        r = self.read_object('{}:{}'.format(commit_sha, rel_path))
+        if r is None or r[0] != 'blob':
+            return None
+        return r[1]
+
+    def close(self):
+        """Ends the idle processes."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for proc in idle:
+            proc.close()
+
+
+def configure_cat_file_pools(settings):
+    """Sets the size of the pools from the 'git_cat_file_processes' setting (per shard)."""
+    global _PROCESSES_PER_SHARD
+    value = settings.get('git_cat_file_processes')
+    if value is not None:
+        _PROCESSES_PER_SHARD = max(1, int(value))
+
+
+def get_cat_file_pool(repo_path):
+    """Returns the (shared) CatFilePool of the repo at `repo_path`.
+
+    Pools are not shared across a fork: a child process gets new pools (and git processes).
+    """
+    global _POOLS_PID
+    with _POOLS_LOCK:
+        if _POOLS_PID != os.getpid():
+            _POOLS.clear()  # the pipes of the parent's processes must not be used here
+            _POOLS_PID = os.getpid()
+        pool = _POOLS.get(repo_path)
+        if pool is None:
+            pool = CatFilePool(repo_path, max_processes=_PROCESSES_PER_SHARD)
+            _POOLS[repo_path] = pool
+        return pool
@@ -0,0 +1,101 @@
+"""Cheap, read-only access to the refs of the git repos that hold the doc store shards.
+
+These functions read the files in a repo's git dir directly rather than spawning a git process,
+so they are cheap enough to be called while serving a request.
+"""
+import hashlib
+import os
+
+from peyotl import get_logger
+
+_LOG = get_logger(__name__)
+
+
+def git_dir_for_repo(repo_path):
+    """Returns the path to the git dir of the repo with a working tree at `repo_path`.
+
+    Handles the case of the ".git" entry being a file that contains a "gitdir: ..." pointer.
+    """
+    git_dir = os.path.join(repo_path, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir, 'r') as inp:
+            content = inp.read().strip()
+        if content.startswith('gitdir:'):
+            git_dir = content[len('gitdir:'):].strip()
+            if not os.path.isabs(git_dir):
+                git_dir = os.path.normpath(os.path.join(repo_path, git_dir))
+    return git_dir
+
+
+def _read_packed_refs(git_dir):
+    """Returns a dict of ref name -> SHA from the packed-refs file of `git_dir` (may be empty)."""
+    packed = {}
+    fp = os.path.join(git_dir, 'packed-refs')
+    if not os.path.isfile(fp):
+        return packed
+    with open(fp, 'r') as inp:
+        for line in inp:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('^'):
+                continue
+            sha, ref_name = line.split(' ', 1)
+            packed[ref_name] = sha
+    return packed
+
+
+def read_ref_sha(repo_path, ref_name):
+    """Returns the SHA that `ref_name` (e.g. "refs/heads/master") points to, or None."""
+    git_dir = git_dir_for_repo(repo_path)
+    fp = os.path.join(git_dir, ref_name)
+    if os.path.isfile(fp):
+        with open(fp, 'r') as inp:
+            return inp.read().strip()
+    return _read_packed_refs(git_dir).get(ref_name)
+
+
+def read_head_sha(repo_path):
+    """Returns the SHA of the commit that HEAD resolves to in the repo at `repo_path`.
+
+    Returns None if HEAD cannot be resolved (e.g. an empty repo).
+    """
+    git_dir = git_dir_for_repo(repo_path)
+    with open(os.path.join(git_dir, 'HEAD'), 'r') as inp:
+        head = inp.read().strip()
+    if not head.startswith('ref:'):
+        return head  # detached HEAD
+    return read_ref_sha(repo_path, head[len('ref:'):].strip())
+
+
+def read_branch_shas(repo_path):
+    """Returns a dict mapping local branch name -> SHA for the repo at `repo_path`."""
+    git_dir = git_dir_for_repo(repo_path)
+    prefix = 'refs/heads/'
+    branches = {}
+    for ref_name, sha in _read_packed_refs(git_dir).items():
+        if ref_name.startswith(prefix):
+            branches[ref_name[len(prefix):]] = sha
+    heads_dir = os.path.join(git_dir, 'refs', 'heads')
+    for dirpath, _, filenames in os.walk(heads_dir):
+        for filename in filenames:
+            fp = os.path.join(dirpath, filename)
+            if filename.endswith('.lock'):
+                continue
+            with open(fp, 'r') as inp:
+                sha = inp.read().strip()
+            branches[os.path.relpath(fp, heads_dir).replace(os.sep, '/')] = sha
+    return branches
+
+
+def shard_state_token(repo_path):
+    """Returns a string that changes whenever any branch (or the checkout) of the repo changes.
+
+    Because a write to a shard always creates or moves a branch (master or a work-in-progress
+    branch), the token can be used as a cache key for anything derived from the docs and
+    the WIP branch map of the shard.
+    """
+    git_dir = git_dir_for_repo(repo_path)
+    with open(os.path.join(git_dir, 'HEAD'), 'r') as inp:
+        head = inp.read().strip()
+    items = sorted(read_branch_shas(repo_path).items())
+    content = '\n'.join([head] + ['{} {}'.format(b, s) for b, s in items])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
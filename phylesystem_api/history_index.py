@@ -0,0 +1,156 @@
+"""In-memory index of the version history of every document in a shard.
+
+peyotl reports the version history of a document by running
+    git log --follow -- DOC_PATH
+in the shard for each request. A ShardHistoryIndex holds the same records (for the master
+branch) for every file in the shard. It is built with one `git log --name-status` walk and
+then brought up to date by walking only the commits that have landed on master since the last
+walk, so a history lookup is normally a read of the master ref and a copy of a list.
+
+The records have the keys used by peyotl's `get_version_history_for_file`:
+    id, author_name, author_email, date, date_ISO_8601, relative_date, message_subject,
+    message_body
+"""
+import subprocess
+import time
+from threading import Lock
+
+from peyotl import get_logger
+
+from phylesystem_api.git_refs import read_ref_sha
+
+_LOG = get_logger(__name__)
+_COMMIT_FIELDS = ('id', 'author_name', 'author_email', 'date', 'date_ISO_8601', 'timestamp',
+                  'message_subject', 'message_body')
+_LOG_FORMAT = '%x1e' + '%x1f'.join(['%H', '%an', '%ae', '%aD', '%ai', '%at', '%s', '%b']) + '%x1f'
+_INDICES = {}
+_INDICES_LOCK = Lock()
+
+
+def _plural(num, unit):
+    """Returns "1 `unit`" or "`num` `unit`s"."""
+    return '{} {}{}'.format(num, unit, '' if num == 1 else 's')
+
+
+def relative_date(timestamp, now=None):
+    """Returns a description of the age of `timestamp` in the style of git's "%ar" format."""
+    if now is None:
+        now = time.time()
+    diff = int(now - timestamp)
+    if diff < 0:
+        return 'in the future'
+    if diff < 90:
+        return _plural(diff, 'second') + ' ago'
+    diff = (diff + 30) // 60
+    if diff < 90:
+        return _plural(diff, 'minute') + ' ago'
+    diff = (diff + 30) // 60
+    if diff < 36:
+        return _plural(diff, 'hour') + ' ago'
+    diff = (diff + 12) // 24
+    if diff < 14:
+        return _plural(diff, 'day') + ' ago'
+    if diff < 70:
+        return _plural((diff + 3) // 7, 'week') + ' ago'
+    if diff < 365:
+        return _plural((diff + 15) // 30, 'month') + ' ago'
+    if diff < 1825:
+        total_months = (diff * 12 * 2 + 365) // (365 * 2)
+        years, months = total_months // 12, total_months % 12
+        if months:
+            return '{}, {} ago'.format(_plural(years, 'year'), _plural(months, 'month'))
+        return _plural(years, 'year') + ' ago'
+    return _plural((diff + 183) // 365, 'year') + ' ago'
+
+
+def _parse_log(output):
+    """Returns a list of (commit record, [name-status row, ...]) from `git log` output."""
+    commits = []
+    for chunk in output.split('\x1e')[1:]:
+        fields = chunk.split('\x1f')
+        record = dict(zip(_COMMIT_FIELDS, fields[:len(_COMMIT_FIELDS)]))
+        record['message_body'] = record.get('message_body', '').strip()
+        record['timestamp'] = int(record['timestamp'])
+        changes = [line.split('\t') for line in fields[-1].split('\n') if '\t' in line]
+        commits.append((record, changes))
+    return commits
+
+
+class ShardHistoryIndex(object):
+    """Version histories (newest first) of all of the files on a branch of one shard's repo."""
+
+    def __init__(self, repo_path, branch='master'):
+        """Creates an empty index. It is filled on the first call of `update` or `history`."""
+        self.repo_path = repo_path
+        self.branch = branch
+        self._lock = Lock()
+        self._indexed_sha = None
+        self._by_path = {}  # repo-relative path -> list of commit records, oldest first
+
+    def _git(self, *args):
+        """Returns the stdout of running git with `args` in the repo."""
+        cmd = ['git', '-c', 'core.quotepath=off'] + list(args)
+        return subprocess.check_output(cmd, cwd=self.repo_path).decode('utf-8')
+
+    def _is_ancestor(self, older, newer):
+        """Returns True if `older` is an ancestor of `newer` (False after a forced update)."""
+        return subprocess.call(['git', 'merge-base', '--is-ancestor', older, newer],
+                               cwd=self.repo_path) == 0
+
+    def update(self):
+        """Adds the commits that have landed on the branch since the last update."""
+        with self._lock:
+            head_sha = read_ref_sha(self.repo_path, 'refs/heads/' + self.branch)
+            if head_sha is None or head_sha == self._indexed_sha:
+                return
+            if self._indexed_sha is None or not self._is_ancestor(self._indexed_sha, head_sha):
+                self._by_path = {}
+                rev_range = head_sha
+            else:
+                rev_range = '{}..{}'.format(self._indexed_sha, head_sha)
+            output = self._git('log', '--reverse', '--name-status', '--find-renames=100%',
+                               '--format=' + _LOG_FORMAT, rev_range)
+            commits = _parse_log(output)
+            for record, changes in commits:
+                for change in changes:
+                    if change[0].startswith('R') and len(change) == 3:
+                        # like `git log --follow`, the new path inherits the old history
+                        old_path, new_path = change[1], change[2]
+                        self._by_path[new_path] = list(self._by_path.get(old_path, []))
+                        self._by_path[new_path].append(record)
+                    else:
+                        self._by_path.setdefault(change[-1], []).append(record)
+            msg = 'history index of {} now at {} ({} new commits)'
+            _LOG.debug(msg.format(self.repo_path, head_sha, len(commits)))
+            self._indexed_sha = head_sha
+
+    def history(self, rel_path, max_count=None):
+        """Returns the list of commit records for `rel_path`, newest first, or None if the
+        path has never been on the branch."""
+        self.update()
+        with self._lock:
+            records = self._by_path.get(rel_path)
+            if records is None:
+                return None
+            if max_count is None:
+                selected = records[::-1]
+            else:
+                selected = records[:-(max_count + 1):-1]
+        now = time.time()
+        history = []
+        for record in selected:
+            rec = dict(record)
+            rec['relative_date'] = relative_date(rec.pop('timestamp'), now)
+            history.append(rec)
+        return history
+
+
+def get_shard_history_index(repo_path):
+    """Returns the (shared) ShardHistoryIndex for the master branch of the repo at `repo_path`.
+    """
+    with _INDICES_LOCK:
+        index = _INDICES.get(repo_path)
+        if index is None:
+            index = ShardHistoryIndex(repo_path)
+            _INDICES[repo_path] = index
+        return index
@@ -0,0 +1,247 @@
+"""Incremental validation of an edit of a study, against the version that the edit started from.
+
+Curators usually change a few OTU mappings or one tree of a study. A study in NexSON 1.2 is
+split into "blocks": each otus group of "otusById" and each tree of "treesById". The rest of
+the study (its metadata, the attributes of the trees groups and the IDs of the blocks) is the
+"frame". If the frame of the edited study is that of the starting version, only a skeleton
+study with the frame, the blocks that changed and the otus groups that they refer to is
+validated. A tree is also validated if its otus group changed, as its nodes refer to the OTUs.
+
+The messages of the annotation are then merged: those about the validated blocks come from the
+validation of the skeleton, and the others from the annotation that the validator stored in the
+starting version. The whole study must be validated instead (`plan_incremental_validation` or
+`IncrementalValidation.merge_annotation` return None) whenever the merged result could differ
+from that of validating the whole study: if the frame changed, if the starting version has no
+annotation of the validator or did not pass its checks, if an ID is used by two blocks, if a
+message cannot be attributed to one block, or if a message is about an otus group that was
+only validated with some of the trees that use it (e.g. the warning of tips of different trees
+mapped to the same OTT ID).
+"""
+from phylesystem_api.study_structure import filter_id_list
+
+# NexSON versions that store the blocks by ID (and are not converted when they are written)
+BY_ID_VERSIONS = frozenset(['1.2', '1.2.1'])
+# members of "nexml" that are not part of the frame
+_NOT_IN_FRAME = frozenset(['otusById', 'treesById', '^ot:annotationEvents', '^ot:agents'])
+_FRAME = ('frame',)
+_AMBIGUOUS = ('ambiguous',)
+
+
+def _split_study(study):
+    """Returns (frame, blocks, otus_of_tree) for a study in NexSON 1.2, or None.
+
+    `blocks` maps ("otus", otus_id) and ("tree", tree_id) to the blocks, and `otus_of_tree`
+    maps tree IDs to the "@otus" of their trees group.
+    """
+    nexml = study.get('nexml') if isinstance(study, dict) else None
+    if not isinstance(nexml, dict) or nexml.get('@nexml2json') not in BY_ID_VERSIONS:
+        return None
+    otus_by_id, trees_by_id = nexml.get('otusById'), nexml.get('treesById')
+    if not isinstance(otus_by_id, dict) or not isinstance(trees_by_id, dict):
+        return None
+    blocks = {('otus', otus_id): otus for otus_id, otus in otus_by_id.items()}
+    groups, otus_of_tree = {}, {}
+    for trees_id, group in trees_by_id.items():
+        tree_by_id = group.get('treeById') if isinstance(group, dict) else None
+        if not isinstance(tree_by_id, dict):
+            return None
+        groups[trees_id] = {k: v for k, v in group.items() if k != 'treeById'}
+        for tree_id, tree in tree_by_id.items():
+            if ('tree', tree_id) in blocks:
+                return None  # the same tree ID in two groups
+            if not isinstance(tree, dict):
+                return None
+            blocks[('tree', tree_id)] = tree
+            otus_of_tree[tree_id] = group.get('@otus')
+    if not all(isinstance(otus, dict) for otus in otus_by_id.values()):
+        return None
+    frame = ({k: v for k, v in study.items() if k != 'nexml'},
+             {k: v for k, v in nexml.items() if k not in _NOT_IN_FRAME},
+             groups,
+             sorted(blocks.keys()))
+    return frame, blocks, otus_of_tree
+
+
+def _build_skeleton(study, otus_ids, tree_ids):
+    """Returns a copy of `study` with only the otus groups `otus_ids` and trees `tree_ids`.
+
+    The lists of IDs that give the order of the otus groups, trees groups and trees are
+    filtered to match. The blocks are shared with `study`.
+    """
+    nexml = study['nexml']
+    skeleton_nexml = {k: v for k, v in nexml.items() if k not in ('otusById', 'treesById')}
+    skeleton_nexml['otusById'] = {i: nexml['otusById'][i] for i in otus_ids}
+    filter_id_list(skeleton_nexml, '^ot:otusElementOrder', otus_ids)
+    skeleton_nexml['treesById'] = {}
+    for trees_id, group in nexml['treesById'].items():
+        kept = [i for i in group['treeById'] if i in tree_ids]
+        if kept:
+            skeleton_group = dict(group)
+            skeleton_group['treeById'] = {i: group['treeById'][i] for i in kept}
+            filter_id_list(skeleton_group, '^ot:treeElementOrder', kept)
+            skeleton_nexml['treesById'][trees_id] = skeleton_group
+    filter_id_list(skeleton_nexml, '^ot:treesElementOrder', skeleton_nexml['treesById'])
+    skeleton = dict(study)
+    skeleton['nexml'] = skeleton_nexml
+    return skeleton
+
+
+def _add_id(id_to_block, nex_id, block):
+    """Records that `nex_id` belongs to `block` (or to more than one block)."""
+    if id_to_block.setdefault(nex_id, block) != block:
+        id_to_block[nex_id] = _AMBIGUOUS
+
+
+def _id_to_block_map(study):
+    """Returns a dict mapping the IDs of the elements of the study in NexSON 1.2 to their block.
+
+    The ID of an otus group maps to ("otus group", otus_id), to tell the messages about the
+    group from those about its OTUs. IDs of the frame map to _FRAME, and IDs used in more than
+    one block to _AMBIGUOUS.
+    """
+    nexml = study['nexml']
+    id_to_block = {}
+    if nexml.get('@id') is not None:
+        _add_id(id_to_block, nexml['@id'], _FRAME)
+    for otus_id, otus in nexml['otusById'].items():
+        _add_id(id_to_block, otus_id, ('otus group', otus_id))
+        for otu_id in otus.get('otuById', {}):
+            _add_id(id_to_block, otu_id, ('otus', otus_id))
+    for trees_id, group in nexml['treesById'].items():
+        _add_id(id_to_block, trees_id, _FRAME)
+        for tree_id, tree in group['treeById'].items():
+            block = ('tree', tree_id)
+            _add_id(id_to_block, tree_id, block)
+            for node_id in tree.get('nodeById', {}):
+                _add_id(id_to_block, node_id, block)
+            for edges in tree.get('edgeBySourceId', {}).values():
+                for edge_id in edges:
+                    _add_id(id_to_block, edge_id, block)
+    return id_to_block
+
+
+def _block_of_message(message, id_to_block):
+    """Returns the block that a message of a validation annotation refers to."""
+    refers_to = message.get('refersTo')
+    if not isinstance(refers_to, dict):
+        return _FRAME
+    if '@treeID' in refers_to:
+        return ('tree', refers_to['@treeID'])
+    if '@otusID' in refers_to:
+        if '@otuID' in refers_to:
+            return ('otus', refers_to['@otusID'])
+        return ('otus group', refers_to['@otusID'])
+    nex_id = refers_to.get('@idref')
+    if nex_id is None:
+        return _FRAME
+    if not isinstance(nex_id, basestring):
+        return _AMBIGUOUS
+    return id_to_block.get(nex_id, _AMBIGUOUS)
+
+
+def _message_sort_key(message):
+    """Sort key that puts the messages in the order used by peyotl's validation logger."""
+    severity = 0 if message.get('@severity') == 'ERROR' else 1
+    data = message.get('data', [0])
+    refers_to = message.get('refersTo')
+    if not isinstance(refers_to, dict):
+        return severity, 2, None, data
+    nex_id = refers_to.get('@idref')
+    if nex_id is None:
+        keys = sorted(refers_to.keys())
+        return severity, 1, (keys, [refers_to[k] for k in keys]), data
+    return severity, 0, nex_id, data
+
+
+def _find_annotation_event(study, agent_id):
+    """Returns the annotation event of `agent_id` stored in the study (or None)."""
+    events = study['nexml'].get('^ot:annotationEvents')
+    if not isinstance(events, dict):
+        return None
+    for event in events.get('annotation', []):
+        if isinstance(event, dict) and event.get('@wasAssociatedWithAgentId') == agent_id:
+            return event
+    return None
+
+
+class IncrementalValidation(object):
+    """The skeleton to validate for an edit of a study, and the merging of the results.
+
+    Created by `plan_incremental_validation`.
+    """
+
+    def __init__(self, document, parent, id_to_block, validated_otus, validated_trees,
+                 referenced_otus):
+        """`id_to_block` is the `_id_to_block_map` of `document`, `validated_*` are the IDs of
+        the blocks that are validated, and `referenced_otus` the IDs of all of the otus groups
+        in the skeleton."""
+        self.document = document
+        self.parent = parent
+        self._id_to_block = id_to_block
+        self.skeleton = _build_skeleton(document, referenced_otus, validated_trees)
+        self._validated = set([('otus', i) for i in validated_otus] +
+                              [('otus group', i) for i in validated_otus] +
+                              [('tree', i) for i in validated_trees])
+        # otus groups that are validated with only some of the trees that use them
+        self._partial = set([('otus group', i) for i in referenced_otus
+                             if i not in validated_otus])
+
+    def merge_annotation(self, annotation):
+        """Returns the annotation of the whole document, given the `annotation` that resulted
+        from the validation of the skeleton (which must have passed the checks).
+
+        Returns None if the whole document must be validated instead.
+        """
+        try:
+            event = annotation['annotationEvent']
+            parent_event = _find_annotation_event(self.parent,
+                                                  event['@wasAssociatedWithAgentId'])
+        except (KeyError, TypeError):
+            return None
+        if parent_event is None or parent_event.get('@passedChecks') is not True:
+            return None
+        messages = []
+        parent_messages = parent_event.get('message', [])
+        parent_id_to_block = _id_to_block_map(self.parent) if parent_messages else {}
+        for study_messages, id_to_block, from_skeleton in (
+                (parent_messages, parent_id_to_block, False),
+                (event.get('message', []), self._id_to_block, True)):
+            for message in study_messages:
+                block = _block_of_message(message, id_to_block)
+                if block == _AMBIGUOUS or block in self._partial:
+                    return None
+                if (block in self._validated) == from_skeleton:
+                    messages.append(message)
+        messages.sort(key=_message_sort_key)
+        merged_event = dict(event)
+        merged_event['message'] = messages
+        merged = dict(annotation)
+        merged['annotationEvent'] = merged_event
+        return merged
+
+
+def plan_incremental_validation(document, parent, repo_nexml2json):
+    """Returns an IncrementalValidation for `document`, an edit of the study `parent` (in a
+    doc store that holds studies in the `repo_nexml2json` version of NexSON).
+
+    Returns None if the whole document must be validated. The documents are not modified.
+    """
+    if repo_nexml2json not in BY_ID_VERSIONS:
+        return None  # the validated document is converted before it is written
+    split, parent_split = _split_study(document), _split_study(parent)
+    if split is None or parent_split is None or split[0] != parent_split[0]:
+        return None
+    blocks, otus_of_tree = split[1:]
+    id_to_block = _id_to_block_map(document)
+    if _AMBIGUOUS in id_to_block.values():
+        return None  # the validation of a block could depend on the others
+    parent_blocks = parent_split[1]
+    validated_otus = set(i for (kind, i), block in blocks.items()
+                         if kind == 'otus' and block != parent_blocks[(kind, i)])
+    validated_trees = set(i for (kind, i), block in blocks.items()
+                          if kind == 'tree' and (block != parent_blocks[(kind, i)] or
+                                                 otus_of_tree[i] in validated_otus))
+    otus_ids = set(i for kind, i in blocks if kind == 'otus')
+    referenced_otus = validated_otus.union(otus_of_tree[i] for i in validated_trees)
+    return IncrementalValidation(document, parent, id_to_block, validated_otus, validated_trees,
+                                 referenced_otus.intersection(otus_ids))
@@ -0,0 +1,210 @@
+"""On-disk snapshot of the index of the documents in each shard of the doc store.
+
+To build the doc store wrapper, peyotl walks the doc directory of every shard to map each doc
+ID to a (shard name, directory, filepath) triple. The snapshot records the map that each walk
+produced, with the SHA of the shard's HEAD at the time of the walk. A restarting server then
+only walks the shards whose HEAD has moved since the snapshot was written, and the shards
+whose HEAD has not moved get the recorded map.
+
+peyotl does not accept a pre-built index, so while a DocIndexSnapshot is active (see
+`DocIndexSnapshot.activate`) the functions that peyotl calls to walk a shard
+(`_SCAN_FUNCTION_NAMES`) are served from the snapshot.
+
+The snapshot is a JSON file of the form:
+    {"snapshot_format": 1,
+     "doc_dirs": {absolute path of a doc dir: {"head_sha": SHA of HEAD when it was walked,
+                                               "tag": shard name,
+                                               "index": {doc_id: [tag, dir, filepath]}}}}
+"""
+import functools
+import importlib
+import json
+import os
+import sys
+from threading import Lock
+
+from peyotl import get_logger
+
+from phylesystem_api.git_refs import read_head_sha
+
+_LOG = get_logger(__name__)
+_SNAPSHOT_FORMAT = 1
+# modules of peyotl that define (or import) the functions that walk a shard
+_SCAN_MODULE_NAMES = ('peyotl.phylesystem',
+                      'peyotl.phylesystem.helper',
+                      'peyotl.amendments.helper',
+                      'peyotl.collections_store.helper')
+_SCAN_FUNCTION_NAMES = ('create_id2study_info', 'create_id2amendment_info',
+                        'create_id2collection_info')
+_SCAN_WRAPPERS = {}  # function name -> wrapper of peyotl's function
+_ACTIVE = None  # the DocIndexSnapshot that serves the walks
+_ACTIVE_LOCK = Lock()
+
+
+def _to_str(text):
+    """Returns the str form of a string loaded from JSON (peyotl builds its maps with str)."""
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def _is_plain_index(index):
+    """Returns True if `index` is a doc ID -> (tag, dir, filepath) map that survives JSON."""
+    if not isinstance(index, dict):
+        return False
+    for doc_id, info in index.items():
+        if not isinstance(doc_id, basestring) or not isinstance(info, tuple) or len(info) != 3:
+            return False
+        if not all(isinstance(i, basestring) for i in info):
+            return False
+    return True
+
+
+def _repo_path_for(doc_dir):
+    """Returns the path of the git repo that holds `doc_dir` (or None)."""
+    path = os.path.abspath(doc_dir)
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _head_sha_or_none(repo_path):
+    """Returns the SHA of HEAD of the repo at `repo_path` (or None if it cannot be read)."""
+    if repo_path is None:
+        return None
+    try:
+        return read_head_sha(repo_path)
+    except (IOError, OSError):
+        return None
+
+
+def _scan_wrapper(fn_name, scan_fn):
+    """Returns the wrapper of peyotl's `scan_fn` that consults the active snapshot."""
+    @functools.wraps(scan_fn)
+    def scan_with_snapshot(path, tag):
+        snapshot = _ACTIVE
+        if snapshot is None:
+            return scan_fn(path, tag)
+        return snapshot.scan(scan_fn, path, tag)
+
+    scan_with_snapshot.scan_fn = scan_fn
+    return _SCAN_WRAPPERS.setdefault(fn_name, scan_with_snapshot)
+
+
+def _install_scan_wrappers():
+    """Replaces peyotl's functions that walk a shard by wrappers, in every peyotl module that
+    holds them (including the modules that imported them by name). Repeated calls are no-ops.
+    """
+    for module_name in _SCAN_MODULE_NAMES:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass  # not part of the installed version of peyotl
+    for module_name, module in list(sys.modules.items()):
+        if module is None or module_name.split('.')[0] != 'peyotl':
+            continue
+        for fn_name in _SCAN_FUNCTION_NAMES:
+            fn = getattr(module, fn_name, None)
+            if fn is None or fn is _SCAN_WRAPPERS.get(fn_name):
+                continue
+            wrapper = _scan_wrapper(fn_name, fn)
+            if wrapper.scan_fn is fn:
+                setattr(module, fn_name, wrapper)
+
+
+class DocIndexSnapshot(object):
+    """The index snapshot stored at `filepath`, and the walks of the shards since it was read.
+
+    A missing or unreadable file is treated as an empty snapshot.
+    """
+
+    def __init__(self, filepath):
+        """Reads the snapshot at `filepath`"""
+        self.filepath = filepath
+        self._lock = Lock()
+        self._stored = self._read()
+        self._current = {}  # the entries for the doc dirs walked (or reused) since reading
+        self._dirty = False
+
+    def _read(self):
+        """Returns the "doc_dirs" dict of the file (or {} if it is absent or unusable)."""
+        if not os.path.isfile(self.filepath):
+            return {}
+        try:
+            with open(self.filepath, 'r') as inp:
+                snapshot = json.load(inp)
+            if snapshot.get('snapshot_format') != _SNAPSHOT_FORMAT:
+                _LOG.debug('Ignoring doc store index snapshot with an unknown format')
+                return {}
+            return snapshot['doc_dirs']
+        except:
+            _LOG.exception('Could not read doc store index snapshot from "{}"'.format(
+                self.filepath))
+            return {}
+
+    def scan(self, scan_fn, path, tag):
+        """Returns the index of the doc dir `path` of the shard `tag`, as `scan_fn` would.
+
+        The stored index is returned if the HEAD of the repo has not moved since it was
+        recorded. Otherwise `scan_fn` walks the doc dir, and the result is recorded if HEAD did
+        not move during the walk.
+        """
+        key = os.path.abspath(path)
+        repo_path = _repo_path_for(path)
+        head_sha = _head_sha_or_none(repo_path)
+        entry = self._stored.get(key)
+        if head_sha is not None and entry is not None and entry.get('head_sha') == head_sha \
+                and entry.get('tag') == tag:
+            _LOG.debug('using the index snapshot of "{}"'.format(key))
+            with self._lock:
+                self._current[key] = entry
+            return {_to_str(doc_id): tuple(_to_str(i) for i in info)
+                    for doc_id, info in entry['index'].items()}
+        index = scan_fn(path, tag)
+        if head_sha is not None and head_sha == _head_sha_or_none(repo_path) \
+                and _is_plain_index(index):
+            with self._lock:
+                self._current[key] = {'head_sha': head_sha, 'tag': tag, 'index': index}
+                self._dirty = True
+        return index
+
+    def activate(self):
+        """Serves peyotl's walks of the shards from this snapshot until `deactivate` is called.
+        """
+        global _ACTIVE
+        with _ACTIVE_LOCK:
+            _install_scan_wrappers()
+            _ACTIVE = self
+
+    def deactivate(self):
+        """Lets peyotl walk the shards again."""
+        global _ACTIVE
+        with _ACTIVE_LOCK:
+            if _ACTIVE is self:
+                _ACTIVE = None
+
+    def write(self):
+        """Writes the entries of the doc dirs walked since reading, if they differ from those
+        that were read. Returns True if the file was written.
+
+        The content is written to a temporary file that is then renamed, so that a concurrently
+        starting server never reads a partially written snapshot.
+        """
+        with self._lock:
+            if not self._dirty and set(self._current) == set(self._stored):
+                return False
+            snapshot = {'snapshot_format': _SNAPSHOT_FORMAT, 'doc_dirs': dict(self._current)}
+            tmp_filepath = '{}.{}.tmp'.format(self.filepath, os.getpid())
+            try:
+                with open(tmp_filepath, 'w') as outp:
+                    json.dump(snapshot, outp)
+                os.rename(tmp_filepath, self.filepath)
+            except (IOError, OSError, ValueError):
+                _LOG.exception('Could not write doc store index snapshot to "{}"'.format(
+                    self.filepath))
+                return False
+            self._stored, self._dirty = snapshot['doc_dirs'], False
+        _LOG.debug('doc store index snapshot written to "{}"'.format(self.filepath))
+        return True
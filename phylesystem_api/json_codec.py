@@ -0,0 +1,130 @@
+"""The JSON encoder/decoder used for request bodies, documents and JSON responses.
+
+The "json_codec" setting selects the implementation: "json" (the standard library, the default)
+or "simplejson" (which must be installed separately). ujson is not offered: the releases that
+support Python 2 encode floats with at most 15 decimal places, which would change the floats
+(e.g. branch lengths) of documents. Only the parsing of request bodies and documents and the
+encoding of responses use the selected codec; hashes and cache keys that need a canonical
+encoding always use the standard library.
+
+If the "json_incremental_parsing" setting is true, JSON read from files (e.g. request bodies)
+is parsed with ijson (which must be installed separately) as the file is read, so malformed
+JSON is rejected at the first bad byte, without reading the rest of the file. The callers of
+`load` can also pass a `check` of the structure of the value, which then rejects the JSON as
+soon as one of the values near its root fails the check.
+"""
+import importlib
+import json
+from decimal import Decimal
+
+from peyotl import get_logger
+from pyramid.settings import asbool
+
+_LOG = get_logger(__name__)
+_CODECS = ('json', 'simplejson')
+_CODEC = json
+_IJSON = None  # the ijson module, if JSON files are parsed incrementally
+
+
+def configure_json_codec(settings):
+    """Selects the codec named by the "json_codec" setting (raises ValueError if unusable)."""
+    global _CODEC
+    name = settings.get('json_codec', 'json')
+    if name not in _CODECS:
+        raise ValueError('json_codec must be one of {}'.format(', '.join(_CODECS)))
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        raise ValueError('json_codec is "{n}" but the {n} package is not installed'.format(n=name))
+    _CODEC = module
+    _LOG.debug('using the {} JSON codec'.format(name))
+    _configure_incremental_parsing(settings)
+
+
+def _configure_incremental_parsing(settings):
+    """Selects ijson for parsing files if "json_incremental_parsing" is true."""
+    global _IJSON
+    if not asbool(settings.get('json_incremental_parsing', False)):
+        _IJSON = None
+        return
+    try:
+        _IJSON = importlib.import_module('ijson')
+    except ImportError:
+        raise ValueError('json_incremental_parsing is true but ijson is not installed')
+
+
+def loads(text, check=None):
+    """Returns the object decoded from the JSON string `text` (see `load` for `check`)."""
+    value = _CODEC.loads(text)
+    if check is not None:
+        check.check_value(value)
+    return value
+
+
+def load(fileobj, check=None):
+    """Returns the object decoded from the UTF-8 encoded JSON in the file `fileobj`.
+
+    `check` (optional) rejects the JSON by raising a ValueError from its methods:
+        `check_member(path, value)` is called, while the JSON is parsed incrementally, for
+            each value at a depth of at most `check.max_depth`, with the tuple of the keys
+            that lead to it (None for the items of arrays). Objects and arrays are passed
+            (empty) before their content is parsed.
+        `check_value(value)` is called with the decoded object.
+    """
+    if _IJSON is None:
+        value = _CODEC.load(fileobj)
+    else:
+        value = _build_from_events(_IJSON.basic_parse(fileobj), check)
+    if check is not None:
+        check.check_value(value)
+    return value
+
+
+def _build_from_events(events, check=None):
+    """Returns the value described by the ijson `basic_parse` events `events`.
+
+    ijson gives numbers that are not integers as Decimals, they are converted to floats (as
+    the other codecs return them). See `load` for `check`.
+    """
+    stack = []  # [container, key of the next member (or None for arrays)]
+    value = None
+    max_depth = -1 if check is None else check.max_depth
+    for event, datum in events:
+        if event == 'map_key':
+            stack[-1][1] = datum
+            continue
+        if event in ('end_map', 'end_array'):
+            value = stack.pop()[0]
+        else:
+            if event == 'start_map':
+                value = {}
+            elif event == 'start_array':
+                value = []
+            elif event == 'number' and isinstance(datum, Decimal):
+                value = float(datum)
+            else:
+                value = datum
+            if len(stack) <= max_depth:
+                check.check_member(tuple(key for _, key in stack), value)
+            if event in ('start_map', 'start_array'):
+                stack.append([value, None])
+                continue
+        if stack:
+            container, key = stack[-1]
+            if key is None:
+                container.append(value)
+            else:
+                container[key] = value
+    if stack:
+        raise ValueError('Incomplete JSON value')
+    return value
+
+
+def dumps(obj):
+    """Returns the JSON encoding of `obj`."""
+    return _CODEC.dumps(obj)
+
+
+def renderer_serializer(value, default=None, **kw):
+    """Serializer for pyramid's JSON renderer (see `pyramid.renderers.JSON`)."""
+    return _CODEC.dumps(value, default=default, **kw)
@@ -0,0 +1,165 @@
+"""Application of JSON Patch (RFC 6902) documents, used by the PATCH methods.
+
+Paths are JSON Pointers (RFC 6901). `apply_json_patch` works on a deep copy of the document,
+so the (possibly cached and shared) base document is never modified.
+"""
+import copy
+
+
+class JSONPatchError(ValueError):
+    """Raised for a malformed patch or an operation that cannot be applied."""
+
+
+class JSONPatchTestFailed(JSONPatchError):
+    """Raised when a "test" operation does not match the document."""
+
+
+def _parse_pointer(pointer):
+    """Returns the list of reference tokens of the JSON Pointer `pointer`."""
+    if not isinstance(pointer, basestring):
+        raise JSONPatchError('JSON Pointer must be a string: {}'.format(repr(pointer)))
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise JSONPatchError('JSON Pointer must start with "/": "{}"'.format(pointer))
+    return [t.replace('~1', '/').replace('~0', '~') for t in pointer[1:].split('/')]
+
+
+def _list_index(container, token, pointer, allow_end=False):
+    """Returns the index into the list `container` that `token` denotes."""
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JSONPatchError('invalid array index "{}" in "{}"'.format(token, pointer))
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise JSONPatchError('array index out of range in "{}"'.format(pointer))
+    return index
+
+
+def _json_equal(a, b):
+    """Returns True if `a` and `b` are equal as JSON values (see RFC 6902 section 4.6).
+
+    Unlike ==, booleans are not equal to numbers (so 1 does not match true).
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    if isinstance(a, (int, long, float)) or isinstance(b, (int, long, float)):
+        return isinstance(a, (int, long, float)) and isinstance(b, (int, long, float)) and a == b
+    if isinstance(a, basestring) or isinstance(b, basestring):
+        return isinstance(a, basestring) and isinstance(b, basestring) and a == b
+    if isinstance(a, list) or isinstance(b, list):
+        if not (isinstance(a, list) and isinstance(b, list)) or len(a) != len(b):
+            return False
+        return all(_json_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict) or isinstance(b, dict):
+        if not (isinstance(a, dict) and isinstance(b, dict)) or set(a) != set(b):
+            return False
+        return all(_json_equal(a[k], b[k]) for k in a)
+    return a is None and b is None
+
+
+def _resolve_parent(doc, pointer):
+    """Returns (container, last token) for `pointer`, which must not be the root."""
+    tokens = _parse_pointer(pointer)
+    if not tokens:
+        raise JSONPatchError('the operation cannot be applied to the whole document')
+    container = doc
+    for token in tokens[:-1]:
+        container = _get_child(container, token, pointer)
+    if not isinstance(container, (dict, list)):
+        msg = '"{}" does not refer to a member of an object or array'
+        raise JSONPatchError(msg.format(pointer))
+    return container, tokens[-1]
+
+
+def _get_child(container, token, pointer):
+    """Returns the member of `container` denoted by `token`."""
+    if isinstance(container, dict):
+        if token not in container:
+            raise JSONPatchError('"{}" does not exist'.format(pointer))
+        return container[token]
+    if isinstance(container, list):
+        return container[_list_index(container, token, pointer)]
+    raise JSONPatchError('"{}" does not exist'.format(pointer))
+
+
+def _get_value(doc, pointer):
+    """Returns the value that `pointer` refers to in `doc`."""
+    value = doc
+    for token in _parse_pointer(pointer):
+        value = _get_child(value, token, pointer)
+    return value
+
+
+def _add(doc, pointer, value):
+    """Applies an "add" operation and returns the (possibly new) document."""
+    if pointer == '':
+        return value
+    container, token = _resolve_parent(doc, pointer)
+    if isinstance(container, dict):
+        container[token] = value
+    else:
+        container.insert(_list_index(container, token, pointer, allow_end=True), value)
+    return doc
+
+
+def _remove(doc, pointer):
+    """Applies a "remove" operation and returns the removed value."""
+    container, token = _resolve_parent(doc, pointer)
+    if isinstance(container, dict):
+        if token not in container:
+            raise JSONPatchError('"{}" does not exist'.format(pointer))
+        return container.pop(token)
+    return container.pop(_list_index(container, token, pointer))
+
+
+def _operation_arg(operation, name):
+    """Returns the `name` member of `operation` (raising JSONPatchError if it is absent)."""
+    try:
+        return operation[name]
+    except KeyError:
+        raise JSONPatchError('"{}" operation needs a "{}" member'.format(operation['op'], name))
+
+
+def apply_json_patch(document, patch):
+    """Returns the result of applying the JSON Patch `patch` (a list of operations) to a copy of
+    `document`. Raises JSONPatchError (or JSONPatchTestFailed) if it cannot be applied.
+    """
+    if not isinstance(patch, list):
+        raise JSONPatchError('a JSON Patch must be an array of operations')
+    doc = copy.deepcopy(document)
+    for operation in patch:
+        if not isinstance(operation, dict) or 'op' not in operation:
+            raise JSONPatchError('each operation must be an object with an "op" member')
+        op = operation['op']
+        path = _operation_arg(operation, 'path')
+        if op == 'add':
+            doc = _add(doc, path, copy.deepcopy(_operation_arg(operation, 'value')))
+        elif op == 'remove':
+            _remove(doc, path)
+        elif op == 'replace':
+            value = copy.deepcopy(_operation_arg(operation, 'value'))
+            if path == '':
+                doc = value
+            else:
+                _remove(doc, path)
+                doc = _add(doc, path, value)
+        elif op in ('move', 'copy'):
+            from_path = _operation_arg(operation, 'from')
+            if op == 'move':
+                from_tokens, tokens = _parse_pointer(from_path), _parse_pointer(path)
+                if tokens == from_tokens:
+                    continue
+                if tokens[:len(from_tokens)] == from_tokens:
+                    raise JSONPatchError('cannot move "{}" into itself'.format(from_path))
+                value = _remove(doc, from_path)
+            else:
+                value = copy.deepcopy(_get_value(doc, from_path))
+            doc = _add(doc, path, value)
+        elif op == 'test':
+            if not _json_equal(_get_value(doc, path), _operation_arg(operation, 'value')):
+                raise JSONPatchTestFailed('test of "{}" failed'.format(path))
+        else:
+            raise JSONPatchError('unknown JSON Patch operation "{}"'.format(op))
+    return doc
@@ -0,0 +1,200 @@
+"""Pre-fork multi-process serving of the phylesystem API.
+
+The WSGI app (including the doc store indices) is created once in the parent process by
+`main()`. The parent then forks `workers` child processes that share that memory copy-on-write
+and each run a waitress server on the same listening socket.
+
+The parent process is the only "push owner": it keeps the JobQueue and the `worker` thread that
+pushes shards to GitHub. The children hand their push jobs (and queries for the push failure
+state) to the parent over a local socket by replacing the 'job_queue' in their settings with a
+PushOwnerClient.
+
+Use it in the [server:main] section of the INI file:
+
+    [server:main]
+    use = egg:phylesystem_api#prefork
+    host = 0.0.0.0
+    port = 6543
+    workers = 4
+
+Any other settings in that section are passed to waitress in each worker.
+"""
+import os
+import signal
+import socket
+import sys
+import tempfile
+from multiprocessing.connection import Client, Listener
+from threading import Lock, Thread
+
+from peyotl import get_logger
+
+from phylesystem_api.utility import (close_validation_process_pool, copy_of_push_failures,
+                                     GitPushJob, resolve_all_umbrellas, resolve_umbrella,
+                                     start_validation_process_pool, umbrella_settings_key)
+
+_LOG = get_logger(__name__)
+
+
+class PushOwnerClient(object):
+    """Stands in for the JobQueue in the settings of a worker process.
+
+    `put` sends the description of a GitPushJob to the push owner rather than queueing it.
+    """
+
+    def __init__(self, settings, address, authkey):
+        """`address` and `authkey` identify the push owner's Listener. `settings` are the
+        settings of the worker process (used to identify umbrellas)."""
+        self.settings = settings
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._conn_lock = Lock()
+
+    def _call(self, message, expect_reply):
+        """Sends `message` (reconnecting if needed) and returns the reply (if one is expected)."""
+        with self._conn_lock:
+            if self._conn is None:
+                self._conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            try:
+                self._conn.send(message)
+                return self._conn.recv() if expect_reply else None
+            except:
+                self._conn = None
+                raise
+
+    def put(self, job, block=None, timeout=None):  # pylint: disable=W0613
+        """Hands the push described by the GitPushJob `job` to the push owner."""
+        settings_key = umbrella_settings_key(self.settings, job.umbrella)
+        self._call(('push', settings_key, job.doc_id, job.operation, job.auth_info), False)
+
+    def copy_of_push_failures(self, umbrella):
+        """Returns the push owner's list of push failures for the doc type of `umbrella`."""
+        settings_key = umbrella_settings_key(self.settings, umbrella)
+        return self._call(('push_failures', settings_key), True)
+
+
+def _serve_push_owner_connection(conn, settings):
+    """Handles the messages sent by one worker process until it disconnects."""
+    job_queue = settings['job_queue']
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        try:
+            if message[0] == 'push':
+                settings_key, doc_id, operation, auth_info = message[1:]
+                job = GitPushJob(request=None,
+                                 umbrella=resolve_umbrella(settings, settings_key),
+                                 doc_id=doc_id,
+                                 operation=operation,
+                                 auth_info=auth_info,
+                                 settings=settings)
+                job_queue.put(job)
+            elif message[0] == 'push_failures':
+                umbrella = resolve_umbrella(settings, message[1])
+                conn.send(copy_of_push_failures(settings['push_failure_lock'],
+                                                settings['doc_type_to_push_failure_list'],
+                                                umbrella))
+        except:
+            _LOG.exception('push owner could not handle message "{}"'.format(message))
+
+
+def _run_push_owner(listener, settings):
+    """Accepts connections from worker processes forever (in the parent process)."""
+    while True:
+        try:
+            conn = listener.accept()
+        except:
+            _LOG.exception('push owner accept failed')
+            continue
+        t = Thread(target=_serve_push_owner_connection, args=(conn, settings))
+        t.setDaemon(True)
+        t.start()
+
+
+def _run_worker(app, sock, push_address, authkey, waitress_kwargs):
+    """Body of a forked worker process: serves requests on `sock` until killed."""
+    from waitress import serve
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    settings = app.registry.settings
+    settings['job_queue'] = PushOwnerClient(settings, push_address, authkey)
+    # each worker has its own validation pool, forked before waitress starts its threads
+    start_validation_process_pool(settings)
+    try:
+        serve(app, sockets=[sock], **waitress_kwargs)
+    finally:
+        os._exit(0)  # pylint: disable=W0212
+
+
+def _supervise_workers(spawn, children, shutting_down):
+    """Waits for the worker processes (the set of pids `children`) to exit, calling `spawn` to
+    replace each one that exits while `shutting_down` is empty (spawn adds the new pid).
+    """
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            continue
+        children.discard(pid)
+        if not shutting_down:
+            _LOG.error('worker {} exited with status {}; restarting it'.format(pid, status))
+            spawn()
+
+
+def prefork_server_runner(app, global_conf, host='127.0.0.1', port='6543', workers='2',
+                          **waitress_kwargs):  # pylint: disable=W0613
+    """paste.server_runner entry point. See the module docstring for the settings."""
+    num_workers = int(workers)
+    if num_workers < 1:
+        raise ValueError('The number of prefork workers must be positive')
+    settings = app.registry.settings
+    # the doc stores must be loaded before forking for the workers to share them.
+    resolve_all_umbrellas(settings)
+    # the parent does not validate documents, and the threads of its pool must not be forked
+    close_validation_process_pool()
+    doi_index = settings.get('study_doi_index')
+    if doi_index is not None:
+        try:
+            doi_index.ensure_built()
+        except:
+            _LOG.exception('study DOI index build failed. Workers will retry.')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(1024)
+    push_address = os.path.join(tempfile.mkdtemp(prefix='phylesystem-api-'), 'push-owner')
+    authkey = os.urandom(16)
+    listener = Listener(push_address, family='AF_UNIX', authkey=authkey)
+    t = Thread(target=_run_push_owner, args=(listener, settings))
+    t.setDaemon(True)
+    t.start()
+    children = set()
+    shutting_down = []
+
+    def spawn():
+        """Forks one worker process."""
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(app, sock, push_address, authkey, waitress_kwargs)
+        children.add(pid)
+
+    def terminate(signum, frame):  # pylint: disable=W0613
+        """Stops the worker processes, then the parent."""
+        shutting_down.append(signum)
+        for child_pid in list(children):
+            try:
+                os.kill(child_pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    _LOG.debug('serving on {}:{} with {} workers'.format(host, port, num_workers))
+    for _ in range(num_workers):
+        spawn()
+    _supervise_workers(spawn, children, shutting_down)
+    listener.close()
+    sys.exit(0)
@@ -0,0 +1,30 @@
+"""Early rejection of requests with bodies that are too large.
+
+Requests whose Content-Length is larger than the 'max_request_body_bytes' setting are
+answered with a 413 by `body_size_limit_tween_factory` before anything reads their bodies
+(waitress sets the Content-Length of chunked requests once it has received them, and bounds
+what it buffers with its own `max_request_body_size` setting).
+"""
+from pyramid.httpexceptions import HTTPRequestEntityTooLarge
+
+from phylesystem_api.utility import httpexcept
+
+
+def body_size_limit_tween_factory(handler, registry):
+    """Returns a tween that answers requests with too large bodies with a 413.
+
+    Returns `handler` itself if 'max_request_body_bytes' is absent or 0 (no limit).
+    """
+    max_bytes = int(registry.settings.get('max_request_body_bytes', 0))
+    if max_bytes <= 0:
+        return handler
+
+    def body_size_limit_tween(request):
+        """Rejects the request if its Content-Length is more than `max_bytes`."""
+        length = request.content_length
+        if length is not None and length > max_bytes:
+            msg = 'The request body ({n} bytes) is larger than the limit of {m} bytes'
+            return httpexcept(HTTPRequestEntityTooLarge, msg.format(n=length, m=max_bytes))
+        return handler(request)
+
+    return body_size_limit_tween
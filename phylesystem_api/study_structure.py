@@ -0,0 +1,170 @@
+"""Structure index of NexSON study files, used to serve subresources without decoding the study.
+
+A structure index records the byte offsets of the members of the "nexml" object of a study
+file, of each trees group and each tree in "treesById", and of each group in "otusById".
+Building it costs about one decoding of the file (the values that are not descended into are
+skipped with the C scanner of the json module). With the index, a GET of a tree, subtree,
+otus or otu subresource decodes only the slices of the file that it needs, and assembles them
+into a "skeleton" study that holds the study's metadata, but only the required trees group,
+tree and otus. The skeleton is then handed to the usual peyotl transformer.
+
+The index is cached (in the "study_structure" cache) by a hash of the bytes of the file, so
+it is always consistent with the content that it is applied to.
+"""
+import hashlib
+from json.decoder import JSONDecoder, WHITESPACE
+
+from phylesystem_api import json_codec
+from phylesystem_api.caching import LRUCache
+
+_STRUCTURE_CACHE = LRUCache('study_structure', max_entries=512)
+_SCANNER = JSONDecoder()
+# Members that are split into slices, rather than decoded as a unit.
+#   A dict maps the member keys to the description of the object that they hold ('*' for any)
+_SPLIT = {'nexml': {'treesById': {'*': {'treeById': {'*': None}}},
+                    'otusById': {'*': None}}}
+# subresource types that can be served from a skeleton study
+SKELETON_SUBRESOURCE_TYPES = frozenset(['tree', 'subtree', 'otus', 'otu'])
+
+
+def _skip_ws(text, idx):
+    """Returns the index of the first non-whitespace character at or after `idx`."""
+    return WHITESPACE.match(text, idx).end()
+
+
+def _scan_object(text, idx, split):
+    """Scans the JSON object that starts at text[idx].
+
+    Returns (members, end) where `members` is a list of (key, start, end, sub_members) for the
+    members of the object and `end` is the index after the closing brace. `sub_members` is
+    the list of members of the value if `split` says to descend into it, or None.
+    """
+    if text[idx] != '{':
+        raise ValueError('expecting an object at offset {}'.format(idx))
+    members = []
+    idx = _skip_ws(text, idx + 1)
+    if text[idx] == '}':
+        return members, idx + 1
+    while True:
+        key, idx = _SCANNER.scan_once(text, idx)
+        idx = _skip_ws(text, idx)
+        if text[idx] != ':':
+            raise ValueError('expecting ":" at offset {}'.format(idx))
+        start = _skip_ws(text, idx + 1)
+        sub_split = None if split is None else split.get(key, split.get('*'))
+        if sub_split is not None and text[start] == '{':
+            sub_members, end = _scan_object(text, start, sub_split)
+        else:
+            sub_members, end = None, _SCANNER.scan_once(text, start)[1]
+        members.append((key, start, end, sub_members))
+        idx = _skip_ws(text, end)
+        if text[idx] == '}':
+            return members, idx + 1
+        if text[idx] != ',':
+            raise ValueError('expecting "," at offset {}'.format(idx))
+        idx = _skip_ws(text, idx + 1)
+
+
+def build_structure_index(text):
+    """Returns the structure index of the NexSON `text` (a byte string).
+
+    The index is a dict with:
+    "top": [(key, start, end)] for members of the document other than "nexml";
+    "nexml": [(key, start, end)] for members of "nexml" other than the trees and otus;
+    "otus": {otus_id: (start, end)};
+    "trees_groups": {trees_id: {"other": [(key, start, end)], "trees": [(tree_id, start, end)]}};
+    "tree_to_group": {tree_id: trees_id}.
+    """
+    members = _scan_object(text, _skip_ws(text, 0), _SPLIT)[0]
+    index = {'top': [], 'nexml': [], 'otus': {}, 'trees_groups': {}, 'tree_to_group': {}}
+    for key, start, end, nexml_members in members:
+        if key != 'nexml' or nexml_members is None:
+            index['top'].append((key, start, end))
+            continue
+        for n_key, n_start, n_end, n_sub in nexml_members:
+            if n_key == 'otusById' and n_sub is not None:
+                for otus_id, o_start, o_end, _ in n_sub:
+                    index['otus'][otus_id] = (o_start, o_end)
+            elif n_key == 'treesById' and n_sub is not None:
+                for trees_id, t_start, t_end, group_members in n_sub:
+                    if group_members is None:
+                        raise ValueError('trees group {} is not an object'.format(trees_id))
+                    group = {'other': [], 'trees': []}
+                    for g_key, g_start, g_end, trees in group_members:
+                        if g_key == 'treeById' and trees is not None:
+                            for tree_id, tree_start, tree_end, _ in trees:
+                                group['trees'].append((tree_id, tree_start, tree_end))
+                                index['tree_to_group'][tree_id] = trees_id
+                        else:
+                            group['other'].append((g_key, g_start, g_end))
+                    index['trees_groups'][trees_id] = group
+            else:
+                index['nexml'].append((n_key, n_start, n_end))
+    return index
+
+
+def get_structure_index(text):
+    """Returns the (cached) structure index for the NexSON `text`."""
+    key = hashlib.sha1(text).hexdigest()
+    index = _STRUCTURE_CACHE.get(key)
+    if index is None:
+        index = build_structure_index(text)
+        _STRUCTURE_CACHE.put(key, index)
+    return index
+
+
+def _decode_members(text, spans):
+    """Returns a dict of key -> decoded value for a list of (key, start, end)."""
+    return {key: json_codec.loads(text[start:end]) for key, start, end in spans}
+
+
+def filter_id_list(obj, key, kept):
+    """Keeps only the IDs in `kept` in the list obj[key] (if there is one).
+
+    Used for the lists that give the order of the otus groups, trees groups and trees of a
+    study: peyotl looks up each of their IDs when it converts a study to another syntax.
+    """
+    id_list = obj.get(key)
+    if isinstance(id_list, list):
+        obj[key] = [i for i in id_list if i in kept]
+
+
+def build_skeleton_study(text, subresource_type, subresource_id=None):
+    """Returns a study blob with the metadata of the NexSON `text` and only the parts that are
+    needed to extract the subresource.
+
+    For "tree" and "subtree" this is the trees group (and otus) of the tree;
+    for "otus" and "otu" this is every otus group (and no trees). The lists of the order of
+    the trees groups, trees and otus groups only hold the IDs that are kept.
+    Raises KeyError if a tree cannot be found (the caller can then fall back to the full study)
+    and ValueError for subresource types that are not in SKELETON_SUBRESOURCE_TYPES.
+    """
+    if subresource_type not in SKELETON_SUBRESOURCE_TYPES:
+        raise ValueError('subresource type "{}" needs the full study'.format(subresource_type))
+    index = get_structure_index(text)
+    nexml = _decode_members(text, index['nexml'])
+    otus_needed = set(index['otus'].keys())
+    trees_by_id = {}
+    if subresource_type in ('tree', 'subtree'):
+        tree_id = subresource_id[0] if isinstance(subresource_id, tuple) else subresource_id
+        trees_id = index['tree_to_group'][tree_id]
+        group_index = index['trees_groups'][trees_id]
+        group = _decode_members(text, group_index['other'])
+        group['treeById'] = {}
+        for t_id, start, end in group_index['trees']:
+            if t_id == tree_id:
+                group['treeById'][t_id] = json_codec.loads(text[start:end])
+        filter_id_list(group, '^ot:treeElementOrder', group['treeById'])
+        trees_by_id[trees_id] = group
+        if group.get('@otus') in index['otus']:
+            otus_needed = set([group['@otus']])
+    nexml['treesById'] = trees_by_id
+    filter_id_list(nexml, '^ot:treesElementOrder', trees_by_id)
+    nexml['otusById'] = {}
+    for otus_id in otus_needed:
+        start, end = index['otus'][otus_id]
+        nexml['otusById'][otus_id] = json_codec.loads(text[start:end])
+    filter_id_list(nexml, '^ot:otusElementOrder', otus_needed)
+    study = _decode_members(text, index['top'])
+    study['nexml'] = nexml
+    return study
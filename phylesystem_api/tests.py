@@ -7,12 +7,43 @@ The functions starting with `check_...` are called with UnitTest.TestCase instan
 arg and the response. These functions are used within the unit tests in this file, but also
 in the `ws-tests` calls that perform the tests through http.
 """
+import copy
+import json
 import os
+import shutil
+import subprocess
+import tempfile
+import time
 import unittest
+import zlib
+from multiprocessing.connection import Listener
+from Queue import Empty
+from StringIO import StringIO
+from threading import Event, Thread
 
 from pyramid import testing
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden, HTTPNotFound
+from pyramid.request import Request
+from pyramid.response import Response
 
-from phylesystem_api.utility import fill_app_settings, umbrella_from_request
+from phylesystem_api import json_codec, utility
+from phylesystem_api.caching import cache_stats, LRUCache, SingleFlight
+from phylesystem_api.compression import compress_response
+from phylesystem_api.doi_index import StudyDOIIndex
+from phylesystem_api.git_blobs import CatFilePool
+from phylesystem_api.git_refs import read_head_sha, shard_state_token
+from phylesystem_api.history_index import relative_date, ShardHistoryIndex
+from phylesystem_api.incremental_validation import plan_incremental_validation
+from phylesystem_api.index_snapshot import DocIndexSnapshot
+from phylesystem_api.json_codec import configure_json_codec
+from phylesystem_api.json_patch import apply_json_patch, JSONPatchError, JSONPatchTestFailed
+from phylesystem_api.study_structure import build_skeleton_study, build_structure_index
+from phylesystem_api.utility import (DocStoreHandle, document_etag, fetch_document,
+                                     fill_app_settings,
+                                     invalidate_cached_document, iter_json_chunks,
+                                     parse_envelope_fields, parsed_json_body,
+                                     raw_document_response, render_markdown_html,
+                                     transform_document, umbrella_from_request)
 from phylesystem_api.views import import_nexson_from_crossref_metadata
 
 
@@ -48,6 +79,15 @@ def check_index_response(test_case, response):
         test_case.assertIn(k, response)
 
 
+def check_health_response(test_case, response):
+    """Check of the response to a `health` call: every doc store is listed with a known status."""
+    test_case.assertEquals(response['status'], 'ok')
+    test_case.assertSetEqual(set(response['doc_stores'].keys()),
+                             {'phylesystem', 'taxon_amendments', 'tree_collections'})
+    for status in response['doc_stores'].values():
+        test_case.assertIn(status, ('ready', 'pending', 'failed'))
+
+
 def check_render_markdown_response(test_case, response):
     """Check of `response` to a `render_markdown` call."""
     expected = '<p>hi from <a href="http://phylo.bio.ku.edu" target="_blank">' \
@@ -114,6 +154,12 @@ class ViewTests(unittest.TestCase):
         from phylesystem_api.views import index
         check_index_response(self, index(request))
 
+    def test_health(self):
+        """Test of health view"""
+        request = gen_versioned_dummy_request()
+        from phylesystem_api.views import health
+        check_health_response(self, health(request))
+
     def test_render_markdown(self):
         """Test of render_markdown view"""
         request = testing.DummyRequest(post={'src': render_test_input})
@@ -184,5 +230,1454 @@ class ViewTests(unittest.TestCase):
         self.assertEquals(len(errors), 0)
 
 
+class DocStoreHandleTests(unittest.TestCase):
+    """UnitTest of the lazy construction of doc store umbrellas."""
+
+    def test_builds_once(self):
+        """The build function should be called once, on the first `get`"""
+        calls = []
+
+        def build():
+            """Records the call and returns a fake umbrella."""
+            calls.append(1)
+            return 'umbrella'
+
+        handle = DocStoreHandle('phylesystem', build_fn=build)
+        self.assertEquals(handle.status, 'pending')
+        self.assertEquals(handle.get(), 'umbrella')
+        self.assertEquals(handle.get(), 'umbrella')
+        self.assertEquals(handle.status, 'ready')
+        self.assertEquals(len(calls), 1)
+
+    def test_failed_build_is_retried(self):
+        """A failed build should be reported and retried on the next `get`"""
+        outcomes = [RuntimeError('no repos'), 'umbrella']
+
+        def build():
+            """Raises the first time, then returns a fake umbrella."""
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        handle = DocStoreHandle('phylesystem', build_fn=build)
+        from pyramid.httpexceptions import HTTPServiceUnavailable
+        self.assertRaises(HTTPServiceUnavailable, handle.get)
+        self.assertEquals(handle.status, 'failed')
+        self.assertEquals(handle.get(), 'umbrella')
+
+
+class LRUCacheTests(unittest.TestCase):
+    """UnitTest of the bounded cache used for documents and derived data."""
+
+    def test_eviction_and_counters(self):
+        """The least recently used entry should be evicted and the counters updated"""
+        cache = LRUCache('test-lru', max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(cache.get('c'), 3)
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['evictions']), (2, 1, 1))
+
+    def test_byte_bound_and_discard(self):
+        """The sum of sizes should be bounded, and `discard_if` should remove matching keys"""
+        cache = LRUCache('test-lru-bytes', max_entries=10, max_bytes=10)
+        cache.put(('study', 'x'), 'x', size=6)
+        cache.put(('study', 'y'), 'y', size=6)
+        self.assertIsNone(cache.get(('study', 'x')))
+        cache.put(('study', 'z'), 'z', size=11)
+        self.assertIsNone(cache.get(('study', 'z')))
+        self.assertEquals(cache.discard_if(lambda k: k[1] == 'y'), 1)
+        self.assertEquals(cache.stats()['bytes'], 0)
+
+
+class SingleFlightTests(unittest.TestCase):
+    """UnitTest of the coalescing of concurrent identical computations."""
+
+    def test_coalescing(self):
+        """Callers that arrive during a computation should share its result or exception"""
+        group = SingleFlight('test_flights')
+        started, release, calls, results = Event(), Event(), [], []
+
+        def compute(value):
+            """Blocks until released"""
+            calls.append(value)
+            started.set()
+            release.wait()
+            if value is None:
+                raise ValueError('no value')
+            return value
+
+        def call(value):
+            """Records the outcome of a call"""
+            try:
+                results.append(group.do('k', compute, value))
+            except ValueError:
+                results.append('error')
+
+        for value in (1, None):
+            started.clear()
+            release.clear()
+            del calls[:], results[:]
+            threads = [Thread(target=call, args=(value,)) for _ in range(4)]
+            num_coalesced = group.stats()['coalesced']
+            threads[0].start()
+            started.wait()
+            for t in threads[1:]:
+                t.start()
+            while group.stats()['coalesced'] < num_coalesced + 3:
+                time.sleep(0.001)
+            release.set()
+            for t in threads:
+                t.join()
+            self.assertEquals(calls, [value])
+            expected = [(1, True)] * 4 if value == 1 else ['error'] * 4
+            self.assertEquals(results, expected)
+        self.assertEquals(group.do('k', lambda: 2), (2, False))
+        self.assertEquals(cache_stats()['test_flights']['in_flight'], 0)
+
+    def test_http_exceptions_are_copied(self):
+        """Each caller should get its own instance of an HTTPException"""
+        group = SingleFlight('test_http_flights')
+        started, release, raised = Event(), Event(), []
+
+        def compute():
+            """Blocks until released, then raises an HTTPNotFound"""
+            started.set()
+            release.wait()
+            raise utility.httpexcept(HTTPNotFound, 'no doc')
+
+        def call():
+            """Records the exception raised to the caller"""
+            try:
+                group.do('k', compute)
+            except HTTPNotFound, x:
+                raised.append(x)
+
+        threads = [Thread(target=call) for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        while group.stats()['coalesced'] < 2:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEquals(len(raised), 3)
+        self.assertEquals(len(set(id(x) for x in raised)), 3)
+        for x in raised:
+            self.assertEquals((x.status_int, x.body), (404, utility.err_body('no doc')))
+            self.assertEquals(x.content_type, raised[0].content_type)
+
+
+class DocumentETagTests(unittest.TestCase):
+    """UnitTest of the ETags of document GETs."""
+
+    def test_etag_varies(self):
+        """The ETag should depend on the doc state and on the requested output"""
+        req = {'output_is_json': True, 'output_format': {'schema': None, 'type_ext': None}}
+        params = {'doc_id': 'pg_10', 'version_history': True}
+        url = 'http://localhost/v3/study/pg_10'
+        etag = document_etag('abc', req, params, url)
+        self.assertEquals(etag, document_etag('abc', dict(req), dict(params), url))
+        self.assertNotEqual(etag, document_etag('abd', req, params, url))
+        nexml_req = {'output_is_json': False, 'output_format': {'schema': 'nexml'}}
+        self.assertNotEqual(etag, document_etag('abc', nexml_req, params, url))
+        self.assertNotEqual(etag, document_etag('abc', req, {'doc_id': 'pg_10'}, url))
+
+
+class TransformCacheTests(unittest.TestCase):
+    """UnitTest of the cache of transformer outputs."""
+
+    def test_cached_until_invalidated(self):
+        """A transformer should run once per doc version and output, and again after a write"""
+        calls = []
+
+        class FakeUmbrella(object):
+            """Stands in for a doc store."""
+            document_type = 'fake'
+
+        def to_newick(umbrella, doc_id, blob, head_sha):  # pylint: disable=W0613
+            """Records the call, and modifies its input like some peyotl transformers."""
+            calls.append(head_sha)
+            blob['tree'] += ';'
+            return blob['tree']
+
+        umbrella, blob = FakeUmbrella(), {'tree': '(a,b)'}
+        req = {'output_is_json': False, 'output_format': {'schema': 'newick'}}
+        for _ in range(2):
+            r = transform_document(umbrella, 'x_1', blob, 'sha1', to_newick, req)
+            self.assertEquals(r, '(a,b);')
+        self.assertEquals(calls, ['sha1'])
+        self.assertEquals(blob, {'tree': '(a,b)'})
+        transform_document(umbrella, 'x_1', blob, 'sha2', to_newick, req)
+        invalidate_cached_document(umbrella, 'x_1')
+        transform_document(umbrella, 'x_1', blob, 'sha2', to_newick, req)
+        self.assertEquals(calls, ['sha1', 'sha2', 'sha2'])
+
+
+def _create_tmp_git_repo():
+    """Returns the path to a new git repo (in a temp dir) with one commit."""
+    repo_path = tempfile.mkdtemp()
+    with open(os.path.join(repo_path, 'x.json'), 'w') as outp:
+        outp.write('{}')
+    git_cmd = ['git', '-c', 'user.name=tester', '-c', 'user.email=tester@example.org']
+    for args in (['init', '-q'], ['add', 'x.json'], ['commit', '-q', '-m', 'first']):
+        subprocess.check_call(git_cmd + args, cwd=repo_path)
+    return repo_path
+
+
+class _GitRepoTestCase(unittest.TestCase):
+    """Base of the UnitTests that need a temporary git repo (at `repo_path`) as a shard."""
+
+    def setUp(self):
+        """Creates a temporary git repo to serve as a shard"""
+        self.repo_path = _create_tmp_git_repo()
+
+    def tearDown(self):
+        """Removes the temporary repo"""
+        shutil.rmtree(self.repo_path)
+
+    def _git(self, *args):
+        """Runs git in the temporary repo."""
+        git_cmd = ['git', '-c', 'user.name=tester', '-c', 'user.email=tester@example.org']
+        subprocess.check_call(git_cmd + list(args), cwd=self.repo_path)
+
+
+class GitRefsTests(_GitRepoTestCase):
+    """UnitTest of the reading of git refs from the git dir of a shard."""
+
+    def test_read_head_sha(self):
+        """HEAD read from the git dir should agree with `git rev-parse`"""
+        expected = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.repo_path)
+        self.assertEquals(read_head_sha(self.repo_path), expected.decode('ascii').strip())
+
+    def test_shard_state_token(self):
+        """Creating a branch should change the shard state token"""
+        before = shard_state_token(self.repo_path)
+        self.assertEquals(before, shard_state_token(self.repo_path))
+        subprocess.check_call(['git', 'branch', 'tester_study_x_0'], cwd=self.repo_path)
+        self.assertNotEqual(before, shard_state_token(self.repo_path))
+
+
+class HistoryIndexTests(_GitRepoTestCase):
+    """UnitTest of the per-shard version history index."""
+
+    def _follow_log_ids(self, rel_path):
+        """Returns the commit SHAs reported by `git log --follow` for `rel_path`"""
+        out = subprocess.check_output(['git', 'log', '--follow', '--format=%H', '--', rel_path],
+                                      cwd=self.repo_path)
+        return out.decode('ascii').split()
+
+    def test_incremental_updates_match_git_log(self):
+        """Histories should agree with `git log --follow` as commits (and renames) land"""
+        index = ShardHistoryIndex(self.repo_path)
+        self.assertEquals([r['id'] for r in index.history('x.json')],
+                          self._follow_log_ids('x.json'))
+        self.assertIsNone(index.history('y.json'))
+        with open(os.path.join(self.repo_path, 'x.json'), 'w') as outp:
+            outp.write('{"a": 1}')
+        self._git('commit', '-q', '-a', '-m', 'second', '-m', 'with a body')
+        self._git('mv', 'x.json', 'y.json')
+        self._git('commit', '-q', '-m', 'rename')
+        history = index.history('y.json')
+        self.assertEquals([r['id'] for r in history], self._follow_log_ids('y.json'))
+        self.assertEquals(len(history), 3)
+        self.assertEquals(history[1]['message_subject'], 'second')
+        self.assertEquals(history[1]['message_body'], 'with a body')
+        self.assertEquals(history[0]['author_email'], 'tester@example.org')
+        self.assertEquals(len(index.history('y.json', max_count=1)), 1)
+
+    def test_relative_date(self):
+        """Relative dates should follow git's rounding"""
+        self.assertEquals(relative_date(0, now=1), '1 second ago')
+        self.assertEquals(relative_date(0, now=3 * 3600), '3 hours ago')
+        self.assertEquals(relative_date(0, now=400 * 86400), '1 year, 1 month ago')
+        self.assertEquals(relative_date(0, now=3650 * 86400), '10 years ago')
+
+
+class DocIndexSnapshotTests(_GitRepoTestCase):
+    """UnitTest of the on-disk snapshot of the index of the documents of the shards."""
+
+    def setUp(self):
+        """Creates a shard and a path for the snapshot"""
+        _GitRepoTestCase.setUp(self)
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.snapshot_filepath = os.path.join(self.snapshot_dir, 'doc_index.json')
+        self.scanned = []
+
+    def tearDown(self):
+        """Removes the shard and the snapshot"""
+        shutil.rmtree(self.snapshot_dir)
+        _GitRepoTestCase.tearDown(self)
+
+    def _scan(self, path, tag):
+        """Walks a doc dir like peyotl's create_id2study_info, recording the call"""
+        self.scanned.append(path)
+        index = {}
+        for root, _, files in os.walk(path):
+            for filename in files:
+                if filename.endswith('.json'):
+                    index[filename[:-5]] = (tag, root, os.path.join(root, filename))
+        return index
+
+    def _scan_with_new_snapshot(self):
+        """Returns the index from a snapshot read from the file, and writes the snapshot"""
+        snapshot = DocIndexSnapshot(self.snapshot_filepath)
+        index = snapshot.scan(self._scan, self.repo_path, 'shard')
+        snapshot.write()
+        return index
+
+    def test_only_moved_shards_are_rescanned(self):
+        """Shards should only be walked if their HEAD moved since the snapshot was written"""
+        fp = os.path.join(self.repo_path, 'x.json')
+        index = self._scan_with_new_snapshot()
+        self.assertEquals(index, {'x': ('shard', self.repo_path, fp)})
+        self.assertEquals(len(self.scanned), 1)
+        self.assertEquals(self._scan_with_new_snapshot(), index)
+        self.assertEquals(len(self.scanned), 1)
+        snapshot = DocIndexSnapshot(self.snapshot_filepath)
+        self.assertEquals(snapshot.scan(self._scan, self.repo_path, 'other'),
+                          {'x': ('other', self.repo_path, fp)})
+        self.assertEquals(len(self.scanned), 2)
+        with open(os.path.join(self.repo_path, 'y.json'), 'w') as outp:
+            outp.write('{}')
+        self._git('add', 'y.json')
+        self._git('commit', '-q', '-m', 'second')
+        self.assertEquals(sorted(self._scan_with_new_snapshot().keys()), ['x', 'y'])
+        self.assertEquals(len(self.scanned), 3)
+        self.assertEquals(sorted(self._scan_with_new_snapshot().keys()), ['x', 'y'])
+        self.assertEquals(len(self.scanned), 3)
+
+    def test_unusable_snapshot(self):
+        """An unreadable snapshot should lead to a walk, and only changes should be written"""
+        with open(self.snapshot_filepath, 'w') as outp:
+            outp.write('{"snapshot_format": ')
+        self.assertEquals(list(self._scan_with_new_snapshot()), ['x'])
+        self.assertEquals(len(self.scanned), 1)
+        snapshot = DocIndexSnapshot(self.snapshot_filepath)
+        snapshot.scan(self._scan, self.repo_path, 'shard')
+        self.assertFalse(snapshot.write())
+
+
+class EnvelopeFieldsTests(unittest.TestCase):
+    """UnitTest of the parsing of the `fields` argument of document GETs."""
+
+    def test_parse(self):
+        """Strings and lists should be accepted, and unknown names rejected"""
+        self.assertIsNone(parse_envelope_fields(None))
+        self.assertEquals(parse_envelope_fields('data, sha,'), frozenset(['data', 'sha']))
+        self.assertEquals(parse_envelope_fields(['shardName']), frozenset(['shardName']))
+        self.assertRaises(HTTPBadRequest, parse_envelope_fields, 'data,bogus')
+
+
+class _FakeUmbrella(object):
+    """Stands in for a doc store holding documents in a dict (in a shard at `repo_path`)."""
+    document_type = 'study'
+
+    def __init__(self, repo_path, docs):
+        """`docs` maps doc ID -> document blob"""
+        self.repo_path = repo_path
+        self.docs = docs
+
+    def get_shard(self, doc_id):
+        """Returns an object with the repo path of the shard"""
+        if doc_id not in self.docs:
+            raise KeyError(doc_id)
+        return self
+
+    @property
+    def path(self):
+        """Path of the (single) shard"""
+        return self.repo_path
+
+    @staticmethod
+    def is_plausible_transformation(subresource_req_dict):  # pylint: disable=W0613
+        """Only the whole document in JSON is supported"""
+        return True, None, 'JSON'
+
+    # pylint: disable=W0613
+    def return_document(self, doc_id, commit_sha=None, return_WIP_map=False):
+        """Returns (blob, sha, WIP map)"""
+        return self.docs[doc_id], 'a' * 40, {}
+
+
+class BatchGetTests(_GitRepoTestCase):
+    """UnitTest of the batch GET view."""
+
+    def setUp(self):
+        """Creates a temporary git repo to serve as a shard"""
+        _GitRepoTestCase.setUp(self)
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        """Removes the temporary repo"""
+        testing.tearDown()
+        _GitRepoTestCase.tearDown(self)
+
+    def test_ndjson_and_json_output(self):
+        """Each item should get its own status, in request order or keyed by index"""
+        from phylesystem_api.views import batch_get
+        items = [{'resource_type': 'study', 'doc_id': 'ot_1', 'fields': 'data,sha'},
+                 {'resource_type': 'study', 'doc_id': 'ot_2'},
+                 {'resource_type': 'bogus', 'doc_id': 'ot_1'}]
+        for output in ('ndjson', 'json'):
+            request = testing.DummyRequest(body=json.dumps({'requests': items, 'output': output}))
+            request.matchdict['api_version'] = 'v3'
+            request.registry.settings['phylesystem'] = _FakeUmbrella(self.repo_path,
+                                                                     {'ot_1': {'nexml': {}}})
+            response = batch_get(request)
+            text = ''.join(response.app_iter)
+            if output == 'ndjson':
+                results = [json.loads(line) for line in text.strip().split('\n')]
+            else:
+                by_key = json.loads(text)
+                results = [by_key[str(i)] for i in range(len(items))]
+            self.assertEquals([r['status'] for r in results], [200, 404, 404])
+            self.assertEquals(results[0]['body'], {'data': {'nexml': {}}, 'sha': 'a' * 40})
+            self.assertIn('error', results[2])
+
+
+class ConditionalGetTests(_GitRepoTestCase):
+    """UnitTest of the If-None-Match GETs of documents."""
+
+    def setUp(self):
+        """Creates a temporary git repo to serve as a shard, holding the study ot_1"""
+        _GitRepoTestCase.setUp(self)
+        self._commit_doc('ot_1', {'nexml': {}})
+        self.config = testing.setUp()
+        self.config.registry.settings['phylesystem'] = _FakeStudyStore(self.repo_path)
+
+    def tearDown(self):
+        """Removes the temporary repo"""
+        testing.tearDown()
+        _GitRepoTestCase.tearDown(self)
+
+    def _commit_doc(self, doc_id, document):
+        """Commits `document` to the shard"""
+        with open(os.path.join(self.repo_path, doc_id + '.json'), 'w') as outp:
+            json.dump(document, outp)
+        self._git('add', doc_id + '.json')
+        self._git('commit', '-q', '-m', doc_id)
+
+    def _get(self, if_none_match=None):
+        """Returns the response of get_document for a GET of the data and SHA of ot_1"""
+        from phylesystem_api.views import get_document
+        headers = {} if if_none_match is None else {'If-None-Match': '"{}"'.format(if_none_match)}
+        request = Request.blank('/v3/study/ot_1?fields=data,sha', headers=headers)
+        request.registry = self.config.registry
+        request.matchdict = {'api_version': 'v3', 'resource_type': 'study', 'doc_id': 'ot_1'}
+        return get_document(request)
+
+    def test_not_modified(self):
+        """A GET with the ETag of the document should get a 304 with an empty body"""
+        from pyramid.httpexceptions import HTTPNotModified
+        etag = self._get().etag
+        self.assertTrue(etag)
+        try:
+            self._get(if_none_match=etag)
+        except HTTPNotModified, x:
+            self.assertEquals((x.status_int, x.body, x.etag), (304, '', etag))
+        else:
+            self.fail('Expecting a 304 response')
+
+    def test_write_to_shard_changes_etag(self):
+        """A write to another document of the shard should change the ETag of the document"""
+        etag = self._get().etag
+        self._commit_doc('ot_2', {'nexml': {}})
+        response = self._get(if_none_match=etag)
+        self.assertEquals(response.status_int, 200)
+        self.assertNotEquals(response.etag, etag)
+        self.assertEquals(json.loads(''.join(response.app_iter))['data'], {'nexml': {}})
+
+
+class StreamingJSONTests(unittest.TestCase):
+    """UnitTest of the chunked JSON encoding used for streamed responses."""
+
+    def test_round_trip(self):
+        """The concatenated chunks should decode to the encoded object"""
+        doc = {'sha': 'abc',
+               'data': {'nexml': {'otus': [{'@label': u'\u00e9t\u00e9', 'n': i}
+                                           for i in range(50)],
+                                  'empty': {}, 'deep': [[[[[[1, None, True]]]]]]}},
+               'version_history': []}
+        chunks = list(iter_json_chunks(doc, chunk_size=100))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(json.loads(''.join(chunks)), doc)
+        self.assertEquals(''.join(iter_json_chunks(doc)), json.dumps(doc))
+
+
+class CompressionTests(unittest.TestCase):
+    """UnitTest of the negotiated compression of responses."""
+
+    @staticmethod
+    def _respond(response, accept_encoding, cache_key=None):
+        """Runs the compression callback for a request with `accept_encoding` on `response`"""
+        request = Request.blank('/v3/study/x_1', headers={'Accept-Encoding': accept_encoding})
+        compress_response(request, cache_key=cache_key)
+        request._process_response_callbacks(response)  # pylint: disable=W0212
+        return response
+
+    def test_gzip_body_and_stream(self):
+        """Bodies and streams should be gzipped (and cached) only if the client accepts gzip"""
+        body = json.dumps({'data': ['x' * 20] * 200})
+        r = self._respond(Response(body=body), 'identity')
+        self.assertIsNone(r.content_encoding)
+        self.assertIn('Accept-Encoding', r.vary)
+        r = self._respond(Response(body=body), 'gzip')
+        self.assertEquals(r.content_encoding, 'gzip')
+        self.assertEquals(zlib.decompress(r.body, 16 + zlib.MAX_WBITS), body)
+        for _ in range(2):
+            streamed = Response()
+            streamed.app_iter = iter([body[:100], body[100:]])
+            streamed.etag = 'abc'
+            r = self._respond(streamed, 'gzip, deflate', cache_key='abc')
+            self.assertEquals(r.etag, 'abc-gzip')
+            self.assertEquals(zlib.decompress(''.join(r.app_iter), 16 + zlib.MAX_WBITS), body)
+        self.assertTrue(cache_stats()['compressed_body']['hits'] >= 1)
+
+
+class MarkdownRenderingTests(unittest.TestCase):
+    """UnitTest of the cached markdown -> HTML rendering."""
+
+    def test_cached_rendering(self):
+        """A second rendering of the same source should be a cache hit with the same HTML"""
+        src = 'a *comment* with a link to http://opentreeoflife.org'
+        html = render_markdown_html(src)
+        self.assertIn('<em>comment</em>', html)
+        self.assertIn('target="_blank"', html)
+        hits = cache_stats()['markdown_html']['hits']
+        self.assertEquals(render_markdown_html(src), html)
+        self.assertEquals(cache_stats()['markdown_html']['hits'], hits + 1)
+        self.assertEquals(render_markdown_html(None), '')
+
+
+class _FakeStudyStore(object):
+    """Stands in for the phylesystem: one shard at `repo_path` holding "{study_id}.json" files."""
+
+    document_type = 'study'
+
+    def __init__(self, repo_path):
+        """Wraps the repo at `repo_path`"""
+        self.repo_path = repo_path
+
+    def get_configuration_dict(self):
+        """Describes the single shard"""
+        return {'shards': [{'path': self.repo_path}]}
+
+    def return_document(self, doc_id):
+        """Returns (blob, None) for `doc_id` (raises IOError if there is no such file)"""
+        with open(os.path.join(self.repo_path, doc_id + '.json')) as inp:
+            return json.load(inp), None
+
+    def iter_doc_objs(self):
+        """Yields (study_id, blob) pairs"""
+        for filename in sorted(os.listdir(self.repo_path)):
+            if filename.endswith('.json'):
+                yield filename[:-5], self.return_document(filename[:-5])[0]
+
+    def get_shard(self, doc_id):  # pylint: disable=W0613
+        """Returns an object with the `path` of the single shard"""
+        return type('_FakeShard', (object,), {'path': self.repo_path})()
+
+    def get_repo_and_path_fragment(self, doc_id):
+        """Returns the shard name and the path of `doc_id` in the shard"""
+        return 'shard', doc_id + '.json'
+
+    @staticmethod
+    def is_plausible_transformation(subresource_req_dict):  # pylint: disable=W0613
+        """Only the whole document in JSON is supported"""
+        return True, None, 'JSON'
+
+
+class StudyDOIIndexTests(_GitRepoTestCase):
+    """UnitTest of the local DOI -> study ID index."""
+
+    def _commit_study(self, study_id, doi):
+        """Writes and commits a minimal study with publication `doi` (or removes it if None)"""
+        fp = os.path.join(self.repo_path, study_id + '.json')
+        if doi is None:
+            self._git('rm', '-q', fp)
+        else:
+            with open(fp, 'w') as outp:
+                json.dump({'nexml': {'^ot:studyPublication': {'@href': doi}}}, outp)
+            self._git('add', fp)
+        self._git('commit', '-q', '-m', study_id)
+
+    def test_build_and_sync(self):
+        """Duplicates should be found by normalized DOI, and commits should be picked up"""
+        self._commit_study('ot_1', 'http://dx.doi.org/10.1/ABC')
+        self._commit_study('ot_2', 'doi:10.1/abc')
+        store = _FakeStudyStore(self.repo_path)
+        doi_index = StudyDOIIndex(lambda: store)
+        self.assertEquals(doi_index.status, 'pending')
+        doi_index.ensure_built()
+        self.assertEquals(doi_index.find_studies('https://doi.org/10.1/abc'), ['ot_1', 'ot_2'])
+        self._commit_study('ot_2', 'http://dx.doi.org/10.2/xyz')
+        self._commit_study('ot_3', 'http://dx.doi.org/10.1/abc')
+        self.assertEquals(doi_index.find_studies('10.1/abc'), ['ot_1', 'ot_3'])
+        self._commit_study('ot_1', None)
+        self.assertEquals(doi_index.find_studies('10.1/abc'), ['ot_3'])
+        self.assertEquals(doi_index.find_studies('10.2/xyz'), ['ot_2'])
+
+
+class StudyStructureTests(unittest.TestCase):
+    """UnitTest of the structure index and skeletons of study files."""
+
+    _STUDY = {'nexml': {'^ot:studyId': 'ot_9',
+                        '^ot:comment': 'a "quoted" {brace}',
+                        'otusById': {'otus1': {'otuById': {'otu1': {'^ot:ottId': 1}}},
+                                     'otus2': {'otuById': {'otu2': {'^ot:ottId': 2}}}},
+                        'treesById': {'trees1': {'@otus': 'otus1',
+                                                 'treeById': {'tree1': {'nodeById': {}},
+                                                              'tree2': {'nodeById': {}}}},
+                                      'trees2': {'@otus': 'otus2',
+                                                 'treeById': {'tree3': {'@label': 'x'}}}}},
+              'extra': [1, 2]}
+
+    def test_index(self):
+        """The spans of the index should decode to the members of the study"""
+        text = json.dumps(self._STUDY, indent=1)
+        index = build_structure_index(text)
+        self.assertEquals(index['tree_to_group'], {'tree1': 'trees1', 'tree2': 'trees1',
+                                                   'tree3': 'trees2'})
+        start, end = index['otus']['otus2']
+        self.assertEquals(json.loads(text[start:end]), self._STUDY['nexml']['otusById']['otus2'])
+        self.assertEquals([m[0] for m in index['top']], ['extra'])
+
+    def test_skeleton(self):
+        """Skeletons should hold the metadata and only the needed trees and otus"""
+        text = json.dumps(self._STUDY)
+        skeleton = build_skeleton_study(text, 'tree', 'tree3')
+        nexml = skeleton['nexml']
+        self.assertEquals(nexml['^ot:comment'], 'a "quoted" {brace}')
+        self.assertEquals(nexml['treesById'], {'trees2': self._STUDY['nexml']['treesById']
+                                               ['trees2']})
+        self.assertEquals(nexml['otusById'].keys(), ['otus2'])
+        self.assertEquals(skeleton['extra'], [1, 2])
+        skeleton = build_skeleton_study(text, 'subtree', ('tree1', 'node1'))
+        self.assertEquals(skeleton['nexml']['treesById']['trees1']['treeById'].keys(), ['tree1'])
+        skeleton = build_skeleton_study(text, 'otus')
+        self.assertEquals(skeleton['nexml']['otusById'], self._STUDY['nexml']['otusById'])
+        self.assertEquals(skeleton['nexml']['treesById'], {})
+        self.assertRaises(KeyError, build_skeleton_study, text, 'tree', 'tree4')
+        self.assertRaises(ValueError, build_skeleton_study, text, 'meta')
+
+    def test_skeleton_conversion(self):
+        """Skeletons of studies with several trees should convert to the other NexSON syntaxes"""
+        from peyotl.nexson_syntax import convert_nexson_format
+
+        def tree(node_id, otu_id):
+            """Returns a tree of one node"""
+            return {'nodeById': {node_id: {'@otu': otu_id}}, 'edgeBySourceId': {},
+                    '^ot:rootNodeId': node_id}
+
+        study = {'nexml': {'@id': 'study', '@nexml2json': '1.2.1',
+                           '^ot:otusElementOrder': ['otus1', 'otus2'],
+                           'otusById': {'otus1': {'otuById': {'otu1': {}}},
+                                        'otus2': {'otuById': {'otu2': {}}}},
+                           '^ot:treesElementOrder': ['trees1', 'trees2'],
+                           'treesById': {'trees1': {'@otus': 'otus1',
+                                                    '^ot:treeElementOrder': ['tree1', 'tree2'],
+                                                    'treeById': {'tree1': tree('node1', 'otu1'),
+                                                                 'tree2': tree('node2', 'otu1')}},
+                                         'trees2': {'@otus': 'otus2',
+                                                    '^ot:treeElementOrder': ['tree3'],
+                                                    'treeById': {'tree3': tree('node3', 'otu2')}}}}}
+        text = json.dumps(study)
+        for tree_id, otus_id in (('tree2', 'otus1'), ('tree3', 'otus2')):
+            nexml = convert_nexson_format(build_skeleton_study(text, 'tree', tree_id),
+                                          '1.0.0')['nexml']
+            self.assertEquals([t['@id'] for g in nexml['trees'] for t in g['tree']], [tree_id])
+            self.assertEquals([o['@id'] for o in nexml['otus']], [otus_id])
+        nexml = convert_nexson_format(build_skeleton_study(text, 'otus'), '1.0.0')['nexml']
+        self.assertEquals([o['@id'] for o in nexml['otus']], ['otus1', 'otus2'])
+        self.assertEquals(nexml['trees'], [])
+
+
+class RawDocumentTests(_GitRepoTestCase):
+    """UnitTest of the raw=1 GET of the stored form of a document."""
+
+    def setUp(self):
+        """Creates a temporary git repo to serve as a shard"""
+        _GitRepoTestCase.setUp(self)
+        self.store = _FakeStudyStore(self.repo_path)
+
+    def test_raw_document(self):
+        """The committed bytes should be sent with the SHA of master, even during a write"""
+        request = testing.DummyRequest()
+        response = raw_document_response(request, self.store, 'x')
+        self.assertEquals(response.body, '{}')
+        self.assertEquals(response.content_length, 2)
+        self.assertEquals(response.headers['X-Commit-SHA'], read_head_sha(self.repo_path))
+        # peyotl rewrites the file in place (on master if the parent is master's HEAD)
+        with open(os.path.join(self.repo_path, 'x.json'), 'w') as outp:
+            outp.write('{"edited": ')
+        response = raw_document_response(request, self.store, 'x')
+        self.assertEquals(response.body, '{}')
+        subprocess.check_call(['git', 'checkout', '-q', '-b', 'tester_study_x_0'],
+                              cwd=self.repo_path)
+        response = raw_document_response(request, self.store, 'x')
+        self.assertEquals(response.body, '{}')
+        self.assertRaises(HTTPNotFound, raw_document_response, request, self.store, 'y')
+
+
+class CatFilePoolTests(_GitRepoTestCase):
+    """UnitTest of the reads of documents from the git object database."""
+
+    def test_read_blob(self):
+        """Blobs and other objects should be read; missing ones should give None"""
+        pool = CatFilePool(self.repo_path, max_processes=1)
+        sha = read_head_sha(self.repo_path)
+        self.assertEquals(pool.read_blob(sha, 'x.json'), '{}')
+        self.assertEquals(pool.read_blob(sha, 'y.json'), None)
+        self.assertEquals(pool.read_object(sha)[0], 'commit')
+        self.assertEquals(pool.read_blob(sha, 'x.json'), '{}')
+        pool.close()
+
+    def test_fetch_document(self):
+        """fetch_document should read master or an older commit, with the WIP branches"""
+        first_sha = read_head_sha(self.repo_path)
+        with open(os.path.join(self.repo_path, 'x.json'), 'w') as outp:
+            outp.write('{"v": 2}')
+        self._git('commit', '-q', '-a', '-m', 'second')
+        subprocess.check_call(['git', 'branch', 'tester_study_x_0', first_sha],
+                              cwd=self.repo_path)
+        second_sha = read_head_sha(self.repo_path)
+        store = _FakeStudyStore(self.repo_path)
+        blob, head_sha, wip_map, history = fetch_document(store, 'x')
+        self.assertEquals((blob, head_sha, history), ({'v': 2}, second_sha, None))
+        self.assertEquals(wip_map, {'master': second_sha, 'tester_study_x_0': first_sha})
+        blob, head_sha = fetch_document(store, 'x', commit_sha=first_sha)[:2]
+        self.assertEquals((blob, head_sha), ({}, first_sha))
+
+
+class _FakeGitHubSession(object):
+    """Stands in for the requests.Session used for GitHub: knows one valid token."""
+
+    def __init__(self):
+        """Starts with no calls"""
+        self.calls = 0
+
+    def get(self, url, headers=None, timeout=None):  # pylint: disable=W0613
+        """Returns a response for the GitHub /user endpoint"""
+        self.calls += 1
+        user = {'login': 'curator', 'name': 'A Curator', 'email': None}
+        status_code = 200 if headers['Authorization'] == 'token good' else 401
+        return type('_FakeResponse', (object,), {'status_code': status_code,
+                                                 'json': lambda _: user})()
+
+
+class AuthenticationCacheTests(unittest.TestCase):
+    """UnitTest of the caching of the GitHub users of auth tokens."""
+
+    def setUp(self):
+        """Replaces the GitHub session with a fake one"""
+        self.session = _FakeGitHubSession()
+        self._real_session = utility._github_session
+        utility._github_session = lambda: self.session
+        utility._GITHUB_AUTH_CACHE.clear()
+
+    def tearDown(self):
+        """Restores the GitHub session"""
+        utility._github_session = self._real_session
+        utility._GITHUB_AUTH_CACHE.clear()
+
+    def test_cached_lookups(self):
+        """Valid and rejected tokens should only be sent to GitHub once"""
+        for _ in range(3):
+            auth_info = utility.authenticate(auth_token='good', author_email='c@example.org')
+            self.assertEquals(auth_info, {'login': 'curator', 'name': 'A Curator',
+                                          'email': 'c@example.org'})
+            self.assertRaises(HTTPForbidden, utility.authenticate, auth_token='bad')
+        self.assertEquals(self.session.calls, 2)
+        self.assertRaises(HTTPForbidden, utility.authenticate, auth_token='')
+
+
+class _UnpicklableError(Exception):
+    """Like GitWorkflowError: its pickle cannot be loaded, as __init__ needs an argument."""
+
+    def __init__(self, msg):
+        """Keeps msg as an attribute, not in args"""
+        Exception.__init__(self)
+        self.msg = msg
+
+    def __str__(self):
+        """Returns the message"""
+        return self.msg
+
+
+class _FakeValidatingStore(object):
+    """Stands in for an umbrella: validation records the pid of the process that did it."""
+
+    document_type = 'fake'
+
+    def __init__(self):
+        """Starts with no validations"""
+        self.num_calls = 0
+
+    def validate_and_convert_doc(self, document, put_args):
+        """Returns (copy of document with "pid", errors, annotation, adaptor)"""
+        self.num_calls += 1
+        if 'raise' in put_args:
+            raise _UnpicklableError(put_args['raise'])
+        processed = dict(document)
+        processed['pid'] = os.getpid()
+        return processed, put_args.get('errors', []), None, None
+
+
+class ValidationPoolTests(unittest.TestCase):
+    """UnitTest of the validation of documents in a process pool."""
+
+    def tearDown(self):
+        """Shuts the pool down"""
+        utility.close_validation_process_pool()
+
+    def test_validation_in_pool(self):
+        """Documents should be validated in another process only if the pool is configured"""
+        store = _FakeValidatingStore()
+        settings = {'phylesystem': store, 'taxon_amendments': None, 'tree_collections': None}
+        utility.start_validation_process_pool(settings)
+        bundle = utility.validate_and_convert_doc(settings, store, {'a': 1}, {})
+        self.assertEquals(bundle, ({'a': 1, 'pid': os.getpid()}, [], None, None))
+        settings['validation_processes'] = '1'
+        utility.start_validation_process_pool(settings)
+        processed, errors = utility.validate_and_convert_doc(settings, store, {'a': 1},
+                                                             {'errors': ['e']})[:2]
+        self.assertNotEquals(processed['pid'], os.getpid())
+        self.assertEquals(errors, ['e'])
+
+    def test_exception_in_pool(self):
+        """An exception of the validator should be an HTTP error, and not break the pool"""
+        store = _FakeValidatingStore()
+        settings = {'phylesystem': store, 'taxon_amendments': None, 'tree_collections': None,
+                    'validation_processes': '1', 'validation_timeout': '10'}
+        utility.start_validation_process_pool(settings)
+        with self.assertRaises(HTTPBadRequest) as context:
+            utility.validate_and_convert_doc(settings, store, {'a': 1}, {'raise': 'bad doc'})
+        self.assertIn('bad doc', context.exception.body)
+        self.assertEquals(store.num_calls, 0)
+        processed = utility.validate_and_convert_doc(settings, store, {'a': 1}, {})[0]
+        self.assertNotEquals(processed['pid'], os.getpid())
+
+
+class _FakeNexsonValidatingStore(_FakeStudyStore):
+    """Stands in for the phylesystem with a validator that records the trees that it sees.
+
+    Nodes with a "@label" get a warning, and nodes with an "@otu" that is not in the otus group
+    of their tree are errors.
+    """
+
+    repo_nexml2json = '1.2.1'
+
+    def __init__(self, repo_path=None):
+        """Starts with no validations"""
+        _FakeStudyStore.__init__(self, repo_path)
+        self.validated_trees = []
+
+    def validate_and_convert_doc(self, document, put_args):  # pylint: disable=W0613
+        """Returns (document, errors, annotation, adaptor)"""
+        nexml = document['nexml']
+        messages, errors, tree_ids = [], [], []
+        for group in nexml['treesById'].values():
+            otus = nexml['otusById'].get(group['@otus'], {}).get('otuById', {})
+            for tree_id, tree in group['treeById'].items():
+                tree_ids.append(tree_id)
+                for node_id, node in tree['nodeById'].items():
+                    if '@label' in node:
+                        messages.append({'@code': 'PROPERTY_VALUE_NOT_USEFUL',
+                                         '@severity': 'WARNING',
+                                         'refersTo': {'@idref': node_id},
+                                         'data': node['@label']})
+                    if node.get('@otu') not in otus:
+                        errors.append('node {} refers to a missing otu'.format(node_id))
+        messages.append({'@code': 'NO_TREES', '@severity': 'WARNING'} if not tree_ids else
+                        {'@code': 'MULTIPLE_TREES', '@severity': 'WARNING'})
+        self.validated_trees.append(sorted(tree_ids))
+        # like peyotl: by the ID that they refer to, and the others last
+        messages.sort(key=lambda m: ('refersTo' not in m, m.get('refersTo', {}).get('@idref')))
+        event = {'@wasAssociatedWithAgentId': 'peyotl-validator',
+                 '@passedChecks': not errors,
+                 'message': messages}
+        annotation = {'annotationEvent': event, 'agent': {'@id': 'peyotl-validator'}}
+        return document, errors, annotation, None
+
+
+def _validated_study(store, study):
+    """Returns a copy of `study` with the annotation of its validation by `store`."""
+    study = copy.deepcopy(study)
+    annotation = store.validate_and_convert_doc(study, {})[2]
+    study['nexml']['^ot:annotationEvents'] = {'annotation': [annotation['annotationEvent']]}
+    return study
+
+
+class IncrementalValidationTests(_GitRepoTestCase):
+    """UnitTest of the validation of edits of studies as changes to their starting version."""
+
+    _STUDY = {'nexml': {'@id': 'study', '@nexml2json': '1.2.1', '^ot:studyId': 'ot_9',
+                        '^ot:otusElementOrder': ['otus1', 'otus2'],
+                        'otusById': {'otus1': {'otuById': {'otu1': {'^ot:ottId': 1}}},
+                                     'otus2': {'otuById': {'otu2': {'^ot:ottId': 2}}}},
+                        '^ot:treesElementOrder': ['trees1', 'trees2'],
+                        'treesById': {'trees1': {'@otus': 'otus1',
+                                                 '^ot:treeElementOrder': ['tree1', 'tree2'],
+                                                 'treeById': {
+                                                     'tree1': {'nodeById': {'node1': {
+                                                         '@otu': 'otu1'}}},
+                                                     'tree2': {'nodeById': {'node2': {
+                                                         '@otu': 'otu1'}}}}},
+                                      'trees2': {'@otus': 'otus2',
+                                                 '^ot:treeElementOrder': ['tree3'],
+                                                 'treeById': {
+                                                     'tree3': {'nodeById': {'node3': {
+                                                         '@otu': 'otu2',
+                                                         '@label': 'x'}}}}}}}}
+
+    def setUp(self):
+        """Validates the starting version of the study"""
+        _GitRepoTestCase.setUp(self)
+        self.store = _FakeNexsonValidatingStore()
+        self.parent = _validated_study(self.store, self._STUDY)
+
+    def _check_merged(self, document, validated_trees):
+        """Checks that only `validated_trees` are validated, and that the merged annotation is
+        that of the whole document"""
+        plan = plan_incremental_validation(document, self.parent, '1.2.1')
+        del self.store.validated_trees[:]
+        annotation = self.store.validate_and_convert_doc(plan.skeleton, {})[2]
+        self.assertEquals(self.store.validated_trees, [validated_trees])
+        merged = plan.merge_annotation(annotation)
+        full = self.store.validate_and_convert_doc(document, {})[2]
+        self.assertEquals(merged['annotationEvent']['message'],
+                          full['annotationEvent']['message'])
+        return plan.skeleton
+
+    def test_changed_tree(self):
+        """Only a changed tree (and its otus group) should be validated"""
+        document = copy.deepcopy(self.parent)
+        document['nexml']['treesById']['trees1']['treeById']['tree2']['nodeById']['node2'][
+            '@label'] = 'y'
+        skeleton = self._check_merged(document, ['tree2'])['nexml']
+        self.assertEquals(skeleton['^ot:otusElementOrder'], ['otus1'])
+        self.assertEquals(skeleton['^ot:treesElementOrder'], ['trees1'])
+        self.assertEquals(skeleton['treesById']['trees1']['^ot:treeElementOrder'], ['tree2'])
+        self.assertEquals(self.parent, _validated_study(self.store, self._STUDY))
+        # the label of node3 was dropped: its warning is replaced
+        del document['nexml']['treesById']['trees2']['treeById']['tree3']['nodeById']['node3'][
+            '@label']
+        self._check_merged(document, ['tree2', 'tree3'])
+
+    def test_changed_otus(self):
+        """The trees that use a changed otus group should be validated"""
+        document = copy.deepcopy(self.parent)
+        document['nexml']['otusById']['otus1']['otuById']['otu1']['^ot:ottId'] = 3
+        self._check_merged(document, ['tree1', 'tree2'])
+        self._check_merged(copy.deepcopy(self.parent), [])
+
+    def test_whole_study_needed(self):
+        """The whole study should be validated when the result could differ"""
+        document = copy.deepcopy(self.parent)
+        self.assertIsNotNone(plan_incremental_validation(document, self.parent, '1.2.1'))
+        self.assertIsNone(plan_incremental_validation(document, self.parent, '1.0.0'))
+        document['nexml']['^ot:studyId'] = 'ot_10'
+        self.assertIsNone(plan_incremental_validation(document, self.parent, '1.2.1'))
+        document = copy.deepcopy(self.parent)
+        del document['nexml']['treesById']['trees2']['treeById']['tree3']
+        self.assertIsNone(plan_incremental_validation(document, self.parent, '1.2.1'))
+        document = copy.deepcopy(self.parent)
+        document['nexml']['treesById']['trees2']['treeById']['tree3']['nodeById']['node1'] = {}
+        self.assertIsNone(plan_incremental_validation(document, self.parent, '1.2.1'))
+        # the starting version did not pass the checks
+        document = copy.deepcopy(self.parent)
+        plan = plan_incremental_validation(document, self.parent, '1.2.1')
+        annotation = self.store.validate_and_convert_doc(plan.skeleton, {})[2]
+        self.parent['nexml']['^ot:annotationEvents']['annotation'][0]['@passedChecks'] = False
+        self.assertIsNone(plan.merge_annotation(annotation))
+        del self.parent['nexml']['^ot:annotationEvents']
+        self.assertIsNone(plan.merge_annotation(annotation))
+
+    def test_validate_and_convert_doc(self):
+        """Edits should be validated against the stored starting version"""
+        with open(os.path.join(self.repo_path, 'x.json'), 'w') as outp:
+            json.dump(self.parent, outp)
+        self._git('commit', '-q', '-a', '-m', 'second')
+        store = _FakeNexsonValidatingStore(self.repo_path)
+        settings = {'incremental_validation': 'true'}
+        put_args = {'doc_id': 'x', 'starting_commit_SHA': read_head_sha(self.repo_path)}
+        document = copy.deepcopy(self.parent)
+        document['nexml']['treesById']['trees2']['treeById']['tree3']['nodeById']['node3'][
+            '@label'] = 'z'
+        bundle = utility.validate_and_convert_doc(settings, store, document, put_args)
+        self.assertEquals(store.validated_trees, [['tree3']])
+        self.assertIs(bundle[0], document)
+        self.assertEquals(bundle[1], [])
+        # with errors, the whole document is validated to report them
+        document['nexml']['treesById']['trees2']['treeById']['tree3']['nodeById']['node3'][
+            '@otu'] = 'otu1'
+        errors = utility.validate_and_convert_doc(settings, store, document, put_args)[1]
+        self.assertEquals(store.validated_trees[1:], [['tree3'], ['tree1', 'tree2', 'tree3']])
+        self.assertEquals(len(errors), 1)
+
+
+class _FakeWritingStore(object):
+    """Stands in for an umbrella with two shards ("a_*" and "b_*" IDs) that records writes."""
+
+    document_type = 'tree_collection'
+
+    def __init__(self):
+        """Starts with no writes"""
+        self.written = []
+
+    def get_shard(self, doc_id):
+        """Returns an object with the `path` of the shard of `doc_id`"""
+        return type('_FakeShard', (object,), {'path': '/shards/' + doc_id[0]})()
+
+    def validate_and_convert_doc(self, document, put_args):  # pylint: disable=W0613
+        """Documents with a "bad" member are invalid"""
+        return document, (['bad document'] if 'bad' in document else []), None, None
+
+    def annotate_and_write(self, document, doc_id, **kwargs):  # pylint: disable=W0613
+        """Records the write and returns an annotated commit"""
+        self.written.append(doc_id)
+        return {'error': 0, 'resource_id': doc_id, 'sha': 'f' * 40, 'merge_needed': False}
+
+    def add_new_doc(self, json_repr, auth_info, commit_msg):  # pylint: disable=W0613
+        """Records the write of a new document in the "b" shard"""
+        doc_id = 'b_new'
+        return doc_id, self.annotate_and_write(json_repr, doc_id)
+
+
+class BulkWriteTests(unittest.TestCase):
+    """UnitTest of the bulk write view."""
+
+    def setUp(self):
+        """Replaces the GitHub session with a fake one"""
+        self.config = testing.setUp()
+        self._real_session = utility._github_session
+        utility._github_session = _FakeGitHubSession
+        utility._GITHUB_AUTH_CACHE.clear()
+
+    def tearDown(self):
+        """Restores the GitHub session"""
+        testing.tearDown()
+        utility._github_session = self._real_session
+        utility._GITHUB_AUTH_CACHE.clear()
+
+    def test_bulk_write(self):
+        """Documents should get results in order, and one push should be queued per shard"""
+        from phylesystem_api.views import bulk_write
+        from Queue import Queue
+        from threading import Lock
+        store = _FakeWritingStore()
+        documents = [{'doc_id': 'a_1', 'starting_commit_SHA': 'abc', 'document': {'n': 1}},
+                     {'doc_id': 'a_2', 'starting_commit_SHA': 'abc', 'json': {'bad': 1}},
+                     {'doc_id': 'b_1', 'starting_commit_SHA': 'abc', 'document': {'n': 3}},
+                     {'document': {'n': 4}},
+                     {'doc_id': 'a_3', 'starting_commit_SHA': 'abc', 'document': {'n': 5}}]
+        request = testing.DummyRequest(body=json.dumps({'auth_token': 'good',
+                                                        'documents': documents}))
+        request.matchdict['resource_type'] = 'collection'
+        settings = request.registry.settings
+        settings.update({'tree_collections': store, 'job_queue': Queue(),
+                         'push_failure_lock': Lock(), 'doc_type_to_push_failure_list': {}})
+        response = bulk_write(request)
+        self.assertEquals(response['error'], 1)
+        results = response['results']
+        self.assertEquals([r['error'] for r in results], [0, 1, 0, 0, 0])
+        self.assertEquals([r['resource_id'] for r in results],
+                          ['a_1', 'a_2', 'b_1', 'b_new', 'a_3'])
+        self.assertIn('bad document', results[1]['description'])
+        self.assertLess(store.written.index('a_1'), store.written.index('a_3'))
+        pushed = []
+        while not settings['job_queue'].empty():
+            pushed.append(settings['job_queue'].get().doc_id[0])
+        self.assertEquals(sorted(pushed), ['a', 'b'])
+        del documents[0]['starting_commit_SHA']
+        request = testing.DummyRequest(body=json.dumps({'auth_token': 'good',
+                                                        'documents': documents}))
+        request.matchdict['resource_type'] = 'collection'
+        self.assertRaises(HTTPBadRequest, bulk_write, request)
+
+
+class PushGroupingTests(unittest.TestCase):
+    """UnitTest of the folding of pushes of a shard into one push."""
+
+    def setUp(self):
+        """Creates the store and settings of the pushes"""
+        from threading import Lock
+        self.store = _FakeWritingStore()
+        self.settings = {'push_failure_lock': Lock(), 'doc_type_to_push_failure_list': {}}
+
+    def tearDown(self):
+        """Turns the grouping off"""
+        utility.configure_push_grouping({})
+
+    def _job(self, doc_id):
+        """Returns a GitPushJob of `doc_id`"""
+        return utility.GitPushJob(None, self.store, doc_id, 'EDIT', settings=self.settings)
+
+    def test_grouping(self):
+        """Pushes of a shard should be folded until the waiting push is started"""
+        for window, expected_size in (('0', 4), ('20', 2)):
+            utility.configure_push_grouping({'push_group_window_ms': window})
+            queue = utility.JobQueue()
+            for doc_id in ('a_1', 'b_1', 'a_2', 'a_1'):
+                queue.put(self._job(doc_id))
+            self.assertEquals(queue.qsize(), expected_size)
+        start = time.time()
+        first = queue.get()
+        self.assertGreaterEqual(time.time() - start, 0.015)
+        self.assertEquals((first.doc_id, first.folded_doc_ids), ('a_1', ['a_2', 'a_1']))
+        queue.put(self._job('a_3'))
+        self.assertEquals(queue.qsize(), 2)
+
+    def test_shards_come_due_independently(self):
+        """A push of a shard should not wait for the window of a push of another shard"""
+        queue = utility.JobQueue()
+        utility.configure_push_grouping({'push_group_window_ms': '300'})
+        queue.put(self._job('a_1'))
+        self.assertRaises(Empty, queue.get, False)
+        self.assertRaises(Empty, queue.get, True, 0.01)
+        # the window of the push of "b" ends before that of "a"
+        utility.configure_push_grouping({'push_group_window_ms': '20'})
+        start = time.time()
+        queue.put(self._job('b_1'))
+        self.assertEquals(queue.get().doc_id, 'b_1')
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEquals(queue.get().doc_id, 'a_1')
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+
+class _RecordingJobQueue(object):
+    """Stands in for the push owner's JobQueue, recording the jobs put on it."""
+
+    def __init__(self):
+        """Starts with no jobs"""
+        self.jobs = []
+        self.put_event = Event()
+
+    def put(self, job):
+        """Records `job`"""
+        self.jobs.append(job)
+        self.put_event.set()
+
+
+class PreforkTests(unittest.TestCase):
+    """UnitTest of the push owner protocol and the supervision of the prefork workers."""
+
+    def setUp(self):
+        """Creates a push owner Listener on an AF_UNIX socket"""
+        from threading import Lock
+        self.tmp_dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmp_dir, 'push-owner')
+        self.authkey = 'k' * 16
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        self.umbrellas = {key: _FakeWritingStore()
+                          for key in ('phylesystem', 'taxon_amendments', 'tree_collections')}
+        self.owner_settings = dict(self.umbrellas)
+        self.owner_settings.update({'job_queue': _RecordingJobQueue(),
+                                    'push_failure_lock': Lock(),
+                                    'doc_type_to_push_failure_list': {
+                                        'tree_collection': ['failed push']}})
+
+    def tearDown(self):
+        """Removes the Listener"""
+        self.listener.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_push_through_owner(self):
+        """A worker's push should be queued by the push owner, with the umbrella of the owner"""
+        from phylesystem_api.prefork import _serve_push_owner_connection, PushOwnerClient
+
+        def serve():
+            """Serves one worker connection"""
+            _serve_push_owner_connection(self.listener.accept(), self.owner_settings)
+
+        server = Thread(target=serve)
+        server.start()
+        worker_umbrellas = {key: _FakeWritingStore() for key in self.umbrellas}
+        client = PushOwnerClient(worker_umbrellas, self.address, self.authkey)
+        job = utility.GitPushJob(None, worker_umbrellas['tree_collections'], 'a_1', 'EDIT',
+                                 auth_info={'login': 'tester'},
+                                 settings=dict(self.owner_settings))
+        client.put(job)
+        self.assertTrue(self.owner_settings['job_queue'].put_event.wait(5))
+        queued = self.owner_settings['job_queue'].jobs[0]
+        self.assertEquals((queued.doc_id, queued.operation, queued.auth_info),
+                          ('a_1', 'EDIT', {'login': 'tester'}))
+        self.assertIs(queued.umbrella, self.umbrellas['tree_collections'])
+        failures = client.copy_of_push_failures(worker_umbrellas['tree_collections'])
+        self.assertEquals(failures, ['failed push'])
+        client._conn.close()
+        server.join(5)
+        self.assertFalse(server.is_alive())
+
+    def test_dead_worker_is_replaced(self):
+        """A worker that dies should be replaced, unless the server is shutting down"""
+        from phylesystem_api.prefork import _supervise_workers
+        children, shutting_down, spawned = set(), [], []
+
+        def spawn():
+            """Forks a worker that dies at once (and asks for the shutdown after a restart)"""
+            spawned.append(len(spawned))
+            if len(spawned) > 1:
+                shutting_down.append('SIGTERM')
+            pid = os.fork()
+            if pid == 0:
+                os._exit(1)
+            children.add(pid)
+
+        spawn()
+        _supervise_workers(spawn, children, shutting_down)
+        self.assertEquals(len(spawned), 2)
+        self.assertEquals(children, set())
+
+
+class JSONPatchTests(unittest.TestCase):
+    """UnitTest of the application of JSON Patch documents."""
+
+    def test_operations(self):
+        """The RFC 6902 operations should apply to a copy of the document"""
+        base = {'a': {'b': [1, 2]}, 'c/d': 'x', 'e': None}
+        patch = [{'op': 'add', 'path': '/a/b/1', 'value': 5},
+                 {'op': 'add', 'path': '/a/b/-', 'value': 6},
+                 {'op': 'remove', 'path': '/e'},
+                 {'op': 'replace', 'path': '/c~1d', 'value': 'y'},
+                 {'op': 'copy', 'from': '/a/b', 'path': '/f'},
+                 {'op': 'move', 'from': '/a/b/0', 'path': '/g'},
+                 {'op': 'test', 'path': '/a/b', 'value': [5, 2, 6]}]
+        patched = apply_json_patch(base, patch)
+        self.assertEquals(patched, {'a': {'b': [5, 2, 6]}, 'c/d': 'y', 'f': [1, 5, 2, 6], 'g': 1})
+        self.assertEquals(base, {'a': {'b': [1, 2]}, 'c/d': 'x', 'e': None})
+
+    def test_errors(self):
+        """Bad patches should raise JSONPatchError, and failed tests JSONPatchTestFailed"""
+        base = {'a': [1]}
+        for patch in ({'op': 'add'},
+                      [{'op': 'remove', 'path': '/b'}],
+                      [{'op': 'add', 'path': '/a/2', 'value': 0}],
+                      [{'op': 'replace', 'path': '/a/01', 'value': 0}],
+                      [{'op': 'move', 'from': '/a', 'path': '/a/0'}],
+                      [{'op': 'add', 'path': 'a', 'value': 0}],
+                      [{'op': 'frobnicate', 'path': '/a'}],
+                      [{'op': 'move', 'from': '/a', 'path': 5}],
+                      [{'op': 'copy', 'from': None, 'path': '/b'}]):
+            self.assertRaises(JSONPatchError, apply_json_patch, base, patch)
+        for value in (2, True, [True], 1.5):
+            patch = [{'op': 'test', 'path': '/a/0', 'value': value}]
+            self.assertRaises(JSONPatchTestFailed, apply_json_patch, base, patch)
+        patch = [{'op': 'test', 'path': '/a', 'value': [1.0]},
+                 {'op': 'move', 'from': '/a', 'path': '/ab'}]
+        self.assertEquals(apply_json_patch(base, patch), {'ab': [1]})
+
+
+class _FakeAmendmentStore(_FakeStudyStore):
+    """Stands in for the taxon amendments, with documents in the repo at `repo_path`, and
+    records the writes."""
+
+    document_type = 'taxon_amendment'
+
+    def __init__(self, repo_path):
+        """Starts with no writes"""
+        _FakeStudyStore.__init__(self, repo_path)
+        self.written = []
+
+    def validate_and_convert_doc(self, document, put_args):  # pylint: disable=W0613
+        """Every document is valid"""
+        return document, [], None, None
+
+    def annotate_and_write(self, document, doc_id, parent_sha, **kwargs):  # pylint: disable=W0613
+        """Records the write and returns an annotated commit"""
+        self.written.append((doc_id, document, parent_sha))
+        return {'error': 0, 'resource_id': doc_id, 'sha': 'f' * 40, 'merge_needed': False}
+
+
+class PatchDocumentTests(_GitRepoTestCase):
+    """UnitTest of the PATCH view."""
+
+    def setUp(self):
+        """Commits a second version of x.json and replaces the GitHub session with a fake one"""
+        from Queue import Queue
+        from threading import Lock
+        _GitRepoTestCase.setUp(self)
+        self.first_sha = read_head_sha(self.repo_path)
+        with open(os.path.join(self.repo_path, 'x.json'), 'w') as outp:
+            outp.write('{"a": 2}')
+        self._git('commit', '-q', '-a', '-m', 'second')
+        self.second_sha = read_head_sha(self.repo_path)
+        self.store = _FakeAmendmentStore(self.repo_path)
+        self.config = testing.setUp()
+        self.config.registry.settings.update({'taxon_amendments': self.store,
+                                              'job_queue': Queue(),
+                                              'push_failure_lock': Lock(),
+                                              'doc_type_to_push_failure_list': {}})
+        self._real_session = utility._github_session
+        utility._github_session = _FakeGitHubSession
+        utility._GITHUB_AUTH_CACHE.clear()
+
+    def tearDown(self):
+        """Restores the GitHub session and removes the repo"""
+        testing.tearDown()
+        utility._github_session = self._real_session
+        utility._GITHUB_AUTH_CACHE.clear()
+        _GitRepoTestCase.tearDown(self)
+
+    def _patch(self, patch, starting_commit_sha=None):
+        """Returns the response of a PATCH of x.json"""
+        from phylesystem_api.views import patch_amendment_document
+        body = {'auth_token': 'good', 'starting_commit_SHA': starting_commit_sha or self.second_sha,
+                'patch': patch}
+        request = testing.DummyRequest(body=json.dumps(body))
+        request.matchdict['doc_id'] = 'x'
+        return patch_amendment_document(request)
+
+    def test_patch_of_starting_version(self):
+        """The patch should be applied to the version at starting_commit_SHA"""
+        response = self._patch([{'op': 'add', 'path': '/b', 'value': 1}])
+        self.assertEquals(response['resource_id'], 'x')
+        response = self._patch([{'op': 'add', 'path': '/b', 'value': 1}],
+                               starting_commit_sha=self.first_sha)
+        self.assertEquals(response['error'], 0)
+        self.assertEquals(self.store.written, [('x', {'a': 2, 'b': 1}, self.second_sha),
+                                               ('x', {'b': 1}, self.first_sha)])
+        self.assertEquals(self.config.registry.settings['job_queue'].qsize(), 2)
+
+    def test_failed_test_and_bad_patch(self):
+        """A failed "test" should get a 409, and a malformed patch a 400"""
+        from pyramid.httpexceptions import HTTPConflict
+        self.assertRaises(HTTPConflict, self._patch, [{'op': 'test', 'path': '/a', 'value': 3}])
+        for patch in ([{'op': 'bogus', 'path': '/a'}], [{'op': 'remove', 'path': '/nope'}],
+                      {'op': 'add'}):
+            self.assertRaises(HTTPBadRequest, self._patch, patch)
+        self.assertEquals(self.store.written, [])
+
+
+class ParsedJSONBodyTests(unittest.TestCase):
+    """UnitTest of the single decoding of request bodies."""
+
+    def test_parsed_once(self):
+        """The body should be decoded once, and bad bodies should raise ValueError"""
+        request = testing.DummyRequest(body='{"a": [1]}')
+        first = parsed_json_body(request)
+        self.assertEquals(first, {'a': [1]})
+        self.assertTrue(parsed_json_body(request) is first)
+        for body in ('', '{"a":'):
+            self.assertRaises(ValueError, parsed_json_body, testing.DummyRequest(body=body))
+
+    def test_codec_selection(self):
+        """Unknown or missing codecs should be rejected"""
+        configure_json_codec({'json_codec': 'json'})
+        self.assertEquals(json_codec.loads(json_codec.dumps({'a': u'/'})), {'a': u'/'})
+        self.assertRaises(ValueError, configure_json_codec, {'json_codec': 'pickle'})
+        self.assertRaises(ValueError, configure_json_codec, {'json_codec': 'ujson'})
+
+    def test_float_round_trip(self):
+        """Floats with 17 significant digits should survive decoding and encoding"""
+        for name in ('json', 'simplejson'):
+            try:
+                configure_json_codec({'json_codec': name})
+            except ValueError:
+                continue  # not installed
+            try:
+                values = [0.12345678901234568, 1.2345678901234567e-08, 123456.78901234567]
+                text = json_codec.dumps(values)
+                self.assertEquals(json_codec.loads(text), values)
+                self.assertEquals(json_codec.load(StringIO(text)), values)
+                self.assertEquals(json.loads(json_codec.renderer_serializer(values)), values)
+            finally:
+                configure_json_codec({})
+
+    def test_spooled_body(self):
+        """A large body should be decoded from its spooled copy and still be readable"""
+        doc = {'nexml': {'otus': [{'@label': u'\u00e9t\u00e9', 'n': i} for i in range(5000)]}}
+        body = json.dumps(doc)
+        request = Request.blank('/', method='POST', body=body)
+        self.assertTrue(len(body) > request.request_body_tempfile_limit)
+        self.assertEquals(parsed_json_body(request), doc)
+        self.assertEquals(request.body, body)
+        request = Request.blank('/', method='POST', body='{"a": 1} x')
+        self.assertRaises(ValueError, parsed_json_body, request)
+
+    def test_incremental_parsing(self):
+        """Incremental parsing (if ijson is installed) should decode floats as floats"""
+        try:
+            configure_json_codec({'json_incremental_parsing': 'true'})
+        except ValueError:
+            return  # ijson is not installed
+        try:
+            text = '{"a": [1, 0.5, {"b": [[], {}, null, true, "\\u00e9"]}], "c": -2e3}'
+            self.assertEquals(json_codec.load(StringIO(text)), json.loads(text))
+            for text in ('{"a": [1, 0.5]', '{"a": 1} x', ''):
+                self.assertRaises(Exception, json_codec.load, StringIO(text))
+        finally:
+            configure_json_codec({})
+
+    def test_nexson_body_checks(self):
+        """Bodies of study writes with an unusable structure should be rejected with a 400"""
+        from pyramid.httpexceptions import HTTPBadRequest
+        route = testing.DummyResource(name='put_study_via_id')
+        for body, ok in (('{"nexml": {"@nexml2json": "1.2.1"}}', True),
+                         ('{"nexson": {"nexml": {}}, "commit_msg": "m"}', True),
+                         ('{"nexson": "{}"}', True),
+                         ('{"nexml": {"@nexml2json": "2.0"}}', False),
+                         ('{"nexml": []}', False),
+                         ('{"commit_msg": "m"}', False),
+                         ('[]', False)):
+            request = testing.DummyRequest(body=body, matched_route=route)
+            if ok:
+                self.assertEquals(parsed_json_body(request), json.loads(body))
+            else:
+                self.assertRaises(HTTPBadRequest, parsed_json_body, request)
+                self.assertRaises(HTTPBadRequest, parsed_json_body, request)
+        route.name = 'post_study'
+        request = testing.DummyRequest(body='{"import_method": "x"}', matched_route=route)
+        self.assertEquals(parsed_json_body(request), {'import_method': 'x'})
+        route.name = 'put_tree_collection_via_id'
+        request = testing.DummyRequest(body='[]', matched_route=route)
+        self.assertEquals(parsed_json_body(request), [])
+
+    def test_nexson_check_stops_the_parse(self):
+        """A failed check of the event stream should stop the parse"""
+        consumed = []
+
+        def events():
+            """The events of a study with an unsupported version and many OTUs"""
+            for event in ([('start_map', None), ('map_key', 'nexml'), ('start_map', None),
+                           ('map_key', '@nexml2json'), ('string', '2.0'),
+                           ('map_key', 'otus'), ('start_array', None)] +
+                          [('number', i) for i in range(1000)]):
+                consumed.append(event)
+                yield event
+
+        check = utility._NexsonBodyCheck(True)
+        self.assertRaises(ValueError, json_codec._build_from_events, events(), check)
+        self.assertEquals(len(consumed), 5)
+
+
+class RequestLimitTests(unittest.TestCase):
+    """UnitTest of the rejection of requests with large bodies."""
+
+    def test_body_size_limit(self):
+        """Requests with a Content-Length over the limit should get a 413"""
+        from phylesystem_api.request_limits import body_size_limit_tween_factory
+        registry = type('_FakeRegistry', (object,), {'settings': {}})()
+
+        def handler(request):  # pylint: disable=W0613
+            """Stands in for the rest of the app"""
+            return 'handled'
+
+        self.assertTrue(body_size_limit_tween_factory(handler, registry) is handler)
+        registry.settings['max_request_body_bytes'] = '10'
+        tween = body_size_limit_tween_factory(handler, registry)
+        self.assertEquals(tween(Request.blank('/', method='POST', body='{"a": 1}')), 'handled')
+        response = tween(Request.blank('/', method='POST', body='{"a": 1000000}'))
+        self.assertEquals(response.status_int, 413)
+        self.assertEquals(json.loads(response.body)['error'], 1)
+
+
 if __name__ == '__main__':
     unittest.main()
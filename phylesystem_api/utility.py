@@ -4,28 +4,54 @@ Functions that are called by views.py, but which are too esoteric or ws-specific
 peyotl.
 """
 import copy
+import functools
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
+import re
+import time
 import traceback
-from Queue import Queue
-from threading import Lock, Thread
+from multiprocessing.pool import ThreadPool
+from Queue import Empty, Queue
+from threading import local, Lock, Thread
 
+import markdown
 import requests
-# noinspection PyPackageRequirements
-from github import Github, BadCredentialsException
+from bleach.linkifier import Linker
+from bleach.sanitizer import Cleaner
 from peyotl import (create_doc_store_wrapper,
                     get_logger, GitWorkflowError,
                     NexsonDocSchema,
                     OTI,
                     SafeConfigParser, StringIO)
-from pyramid.httpexceptions import (HTTPNotFound, HTTPBadRequest, HTTPForbidden,
-                                    HTTPConflict, HTTPGatewayTimeout, HTTPInternalServerError)
+from pyramid.httpexceptions import (HTTPException, HTTPNotFound, HTTPBadRequest, HTTPForbidden,
+                                    HTTPConflict, HTTPGatewayTimeout, HTTPInternalServerError,
+                                    HTTPServiceUnavailable)
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+from phylesystem_api.caching import configure_caches, LRUCache
+from phylesystem_api.doi_index import StudyDOIIndex
+from phylesystem_api.git_blobs import configure_cat_file_pools, get_cat_file_pool
+from phylesystem_api.git_refs import read_branch_shas, shard_state_token
+from phylesystem_api.history_index import get_shard_history_index
+from phylesystem_api.incremental_validation import plan_incremental_validation
+from phylesystem_api.index_snapshot import DocIndexSnapshot
+from phylesystem_api import json_codec
+from phylesystem_api.study_structure import (build_skeleton_study, get_structure_index,
+                                             SKELETON_SUBRESOURCE_TYPES)
 
 # LOCAL_TESTING_MODE=1 in env can used for situations in which you are offline
 #   and cannot use methods associated with the GitHub webservices
 _LOCAL_TESTING_MODE = os.environ.get('LOCAL_TESTING_MODE', '0') == '1'
 _LOG = get_logger(__name__)
 _DOC_STORE = None
+_DOC_STORE_LOCK = Lock()
+_DOC_STORE_INIT_MODES = ('eager', 'lazy', 'background')
+_DUPLICATE_STUDY_DETECTION_MODES = ('local', 'otindex')
 _API_VERSIONS = frozenset(['v1', 'v2', 'v3'])
 _RESOURCE_TYPE_2_SETTINGS_UMBRELLA_KEY = {'phylesystem': 'phylesystem',
                                           'study': 'phylesystem',
@@ -40,6 +66,12 @@ _RESOURCE_TYPE_2_SETTINGS_UMBRELLA_KEY = {'phylesystem': 'phylesystem',
                                           'collection': 'tree_collections',
                                           }
 
+_UMBRELLA_SETTINGS_KEYS = ('phylesystem', 'taxon_amendments', 'tree_collections')
+# Used to configure the routes before an umbrella (and its id_regex) exists
+_UNBUILT_UMBRELLA_ID_PATTERNS = {'phylesystem': '[a-zA-Z][a-zA-Z0-9]*_[0-9]+',
+                                 'taxon_amendments': 'additions-[0-9]+-[0-9]+',
+                                 'tree_collections': '[a-zA-Z0-9-]+/[a-zA-Z0-9-]+'}
+
 _RESOURCE_TYPE_2_DATA_JSON_ARG = {'study': 'nexson',
                                   'taxon_amendments': 'json',
                                   'tree_collections': 'json'}
@@ -50,18 +82,53 @@ _RESOURCE_TYPE_2_DATA_JSON_ARG = {'study': 'nexson',
 
 def fill_app_settings(settings):
     """Fills a settings dict with:
-    * 'phylesystem', 'taxon_amendments', 'tree_collections' ==> umbrella
+    * 'phylesystem', 'taxon_amendments', 'tree_collections' ==> umbrella (or DocStoreHandle)
     * 'doc_type_to_push_failure_list' ==> {}
     * 'push_failure_lock' ==> mutex Lock for doc_type_to_push_failure_list
     * 'job_queue' ==> a thread safe queue to hold deferred jobs
+    * 'study_doi_index' ==> StudyDOIIndex (or None if 'duplicate_study_detection' is "otindex")
+
+    The optional 'doc_store_initialization' setting controls when the umbrellas are built:
+        "eager" (the default) builds all of them before this function returns,
+        "lazy" builds each one the first time that a request needs it, and
+        "background" builds them in parallel threads that are launched by this function.
+    In the "lazy" and "background" modes the settings hold a DocStoreHandle for each umbrella;
+    use `umbrella_from_request` (or the get_..._doc_store functions) to get the umbrella.
 
     As a side effect, launches a worker thread to deal with pushes
     """
+    init_mode = settings.get('doc_store_initialization', 'eager')
+    if init_mode not in _DOC_STORE_INIT_MODES:
+        msg = 'doc_store_initialization must be one of {}'.format(', '.join(_DOC_STORE_INIT_MODES))
+        raise ValueError(msg)
+    for key in _UMBRELLA_SETTINGS_KEYS:
+        if init_mode == 'eager':
+            settings[key] = _build_umbrella(settings, key)
+        else:
+            handle = DocStoreHandle(key, build_fn=functools.partial(_build_umbrella, settings, key))
+            settings[key] = handle
+    # forked before any thread is started (and after the eager umbrellas are built, to share them)
+    start_validation_process_pool(settings)
     start_worker(1)
-    wrapper = _create_doc_store_wrapper(settings)
-    settings['phylesystem'] = wrapper.phylesystem
-    settings['taxon_amendments'] = wrapper.taxon_amendments
-    settings['tree_collections'] = wrapper.tree_collections
+    if init_mode == 'background':
+        for key in _UMBRELLA_SETTINGS_KEYS:
+            settings[key].start_background_build()
+    dup_mode = settings.get('duplicate_study_detection', 'local')
+    if dup_mode not in _DUPLICATE_STUDY_DETECTION_MODES:
+        msg = 'duplicate_study_detection must be one of {}'
+        raise ValueError(msg.format(', '.join(_DUPLICATE_STUDY_DETECTION_MODES)))
+    if dup_mode == 'local':
+        doi_index = StudyDOIIndex(functools.partial(resolve_umbrella, settings, 'phylesystem'))
+        settings['study_doi_index'] = doi_index
+        if init_mode != 'lazy':
+            doi_index.start_background_build()
+    else:
+        settings['study_doi_index'] = None
+    configure_caches(settings)
+    configure_cat_file_pools(settings)
+    configure_github_auth_cache(settings)
+    json_codec.configure_json_codec(settings)
+    configure_push_grouping(settings)
     # Thread-safe dict that map doc type to lists of push failure messages.
     settings['doc_type_to_push_failure_list'] = {}
     settings['push_failure_lock'] = Lock()
@@ -71,13 +138,120 @@ def fill_app_settings(settings):
 def _create_doc_store_wrapper(settings):
     """Uses the (configuration-dependent) settings dict to create a doc store wrapper."""
     global _DOC_STORE
-    if _DOC_STORE is not None:
+    with _DOC_STORE_LOCK:
+        if _DOC_STORE is not None:
+            return _DOC_STORE
+        repo_parent = settings['repo_parent']
+        _LOG.debug('creating Doc Store Wrapper from repo_parent="{}"'.format(repo_parent))
+        snapshot_filepath = settings.get('doc_store_index_snapshot')
+        if not snapshot_filepath:
+            _DOC_STORE = create_doc_store_wrapper(repo_parent)
+            return _DOC_STORE
+        snapshot = DocIndexSnapshot(snapshot_filepath)
+        snapshot.activate()
+        try:
+            _DOC_STORE = create_doc_store_wrapper(repo_parent)
+        finally:
+            snapshot.deactivate()
+        snapshot.write()
         return _DOC_STORE
-    repo_parent = settings['repo_parent']
-    _LOG.debug('creating Doc Store Wrapper from repo_parent="{}"'.format(repo_parent))
-    _DOC_STORE = create_doc_store_wrapper(repo_parent)
-    _LOG.debug('repo_nexml2json = {}'.format(_DOC_STORE.phylesystem.repo_nexml2json))
-    return _DOC_STORE
+
+
+def _build_umbrella(settings, key):
+    """Returns the umbrella for settings `key` from the doc store wrapper."""
+    umbrella = getattr(_create_doc_store_wrapper(settings), key)
+    if key == 'phylesystem':
+        _LOG.debug('repo_nexml2json = {}'.format(umbrella.repo_nexml2json))
+    return umbrella
+
+
+class DocStoreHandle(object):
+    """Stands in for a doc store umbrella in the settings until the umbrella has been built.
+
+    `get` builds the umbrella (if no other thread has done so) and blocks until it is ready.
+    If the build fails, the error is logged, an HTTPServiceUnavailable is raised, and the next
+    call to `get` will retry the build.
+    """
+
+    def __init__(self, name, build_fn):
+        """:param name: settings key of the umbrella (used in messages)
+        :param build_fn: callable that takes no arguments and returns the umbrella.
+        """
+        self.name = name
+        self._build_fn = build_fn
+        self._build_lock = Lock()
+        self._umbrella = None
+        self._failed = False
+
+    def start_background_build(self):
+        """Launches a daemon thread that builds the umbrella."""
+        t = Thread(target=self._build_quietly, name='build-{}'.format(self.name))
+        t.setDaemon(True)
+        t.start()
+
+    def _build_quietly(self):
+        """Calls `get` for its side effects, swallowing the HTTP error raised on failures."""
+        try:
+            self.get()
+        except:
+            pass
+
+    @property
+    def status(self):
+        """Returns "ready", "failed", or "pending" without blocking."""
+        if self._umbrella is not None:
+            return 'ready'
+        return 'failed' if self._failed else 'pending'
+
+    def get(self):
+        """Returns the umbrella, building it first if needed."""
+        umbrella = self._umbrella
+        if umbrella is not None:
+            return umbrella
+        with self._build_lock:
+            if self._umbrella is None:
+                try:
+                    self._umbrella = self._build_fn()
+                    self._failed = False
+                except:
+                    self._failed = True
+                    msg = 'Initialization of the {} document store failed'.format(self.name)
+                    _LOG.exception(msg)
+                    raise httpexcept(HTTPServiceUnavailable, msg)
+            return self._umbrella
+
+
+def resolve_umbrella(settings, key):
+    """Returns the umbrella stored in settings[key], waiting for it if a DocStoreHandle is held."""
+    umbrella = settings[key]
+    if isinstance(umbrella, DocStoreHandle):
+        return umbrella.get()
+    return umbrella
+
+
+def doc_store_status(settings):
+    """Returns a dict of umbrella settings key -> "ready", "pending" or "failed" without blocking.
+    """
+    status = {}
+    for key in _UMBRELLA_SETTINGS_KEYS:
+        umbrella = settings.get(key)
+        if isinstance(umbrella, DocStoreHandle):
+            status[key] = umbrella.status
+        else:
+            status[key] = 'pending' if umbrella is None else 'ready'
+    return status
+
+
+def get_doc_id_pattern(settings, key):
+    """Returns the regex pattern (a string) for IDs of the documents in the umbrella `key`.
+
+    If the umbrella has not been built (lazy or background initialization), a permissive pattern
+    is returned so that the routes can be configured without waiting for the doc store.
+    """
+    umbrella = settings[key]
+    if isinstance(umbrella, DocStoreHandle):
+        return _UNBUILT_UMBRELLA_ID_PATTERNS[key]
+    return umbrella.id_regex.pattern
 
 
 def get_taxonomy_api_base_url(request):
@@ -93,17 +267,17 @@ def get_otindex_base_url(request):  # pylint: disable=W0613
 
 def get_phylesystem_doc_store(request):
     """Returns the phylesystem doc store that was created during server initialization."""
-    return request.registry.settings["phylesystem"]
+    return resolve_umbrella(request.registry.settings, "phylesystem")
 
 
 def get_taxon_amendments_doc_store(request):
     """Returns the taxonomic amendments doc store that was created during server initialization."""
-    return request.registry.settings["taxon_amendments"]
+    return resolve_umbrella(request.registry.settings, "taxon_amendments")
 
 
 def get_tree_collections_doc_store(request):
     """Returns the tree collections doc store that was created during server initialization."""
-    return request.registry.settings["tree_collections"]
+    return resolve_umbrella(request.registry.settings, "tree_collections")
 
 
 def get_resource_type_to_umbrella_name_copy():
@@ -119,11 +293,18 @@ def umbrella_from_request(request):
     dict, then a 404 is raised. Otherwise the appropriate "umbrella" is located
     in the global settings, and the view function is called with the
     request and the umbrella object as the first 2 arguments"""
-    rtstr = request.matchdict.get('resource_type')
+    return umbrella_for_resource_type(request.registry.settings,
+                                      request.matchdict.get('resource_type'))
+
+
+def umbrella_for_resource_type(settings, rtstr):
+    """Returns the umbrella for the resource type string `rtstr` (e.g. "study" or "collection").
+
+    Raises HTTPNotFound if `rtstr` is not a known resource type."""
     key_name = _RESOURCE_TYPE_2_SETTINGS_UMBRELLA_KEY.get(rtstr)
     if key_name is None:
         raise httpexcept(HTTPNotFound, 'Resource type "{}" is not supported'.format(rtstr))
-    return request.registry.settings[key_name]
+    return resolve_umbrella(settings, key_name)
 
 
 def doc_id_from_request(request):
@@ -145,6 +326,89 @@ def umbrella_with_id_from_request(request):
 
 ######################################################################################
 # Helpers for general request/response manipulation
+_JSON_STREAM_CHUNK_SIZE = 64 * 1024
+# containers nested deeper than this are encoded in one json_codec.dumps call
+_JSON_STREAM_MAX_DEPTH = 5
+
+
+def _iter_json_pieces(obj, depth):
+    """Yields strings that concatenate to the JSON encoding of `obj`, splitting the outer
+    containers."""
+    if depth <= 0 or not isinstance(obj, (dict, list, tuple)) or not obj:
+        yield json_codec.dumps(obj)
+    elif isinstance(obj, dict):
+        sep = '{'
+        for key, value in obj.items():
+            yield sep + json.dumps(key) + ': '
+            for piece in _iter_json_pieces(value, depth - 1):
+                yield piece
+            sep = ', '
+        yield '}'
+    else:
+        sep = '['
+        for value in obj:
+            yield sep
+            for piece in _iter_json_pieces(value, depth - 1):
+                yield piece
+            sep = ', '
+        yield ']'
+
+
+def iter_json_chunks(obj, chunk_size=_JSON_STREAM_CHUNK_SIZE):
+    """Yields the JSON serialization of `obj` as a series of byte strings of ~`chunk_size`.
+
+    Suitable as the app_iter of a Response: neither the whole encoding, nor an encoding of any
+    container in the top _JSON_STREAM_MAX_DEPTH levels of `obj` is held in memory at once.
+    """
+    buf, buf_len = [], 0
+    for piece in _iter_json_pieces(obj, _JSON_STREAM_MAX_DEPTH):
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        buf.append(piece)
+        buf_len += len(piece)
+        if buf_len >= chunk_size:
+            yield ''.join(buf)
+            buf, buf_len = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def streaming_json_response(request, obj):
+    """Returns `request.response` set up to stream the JSON encoding of `obj`."""
+    response = request.response
+    response.content_type = 'application/json'
+    response.charset = 'UTF-8'
+    response.app_iter = iter_json_chunks(obj)
+    return response
+
+
+def json_body_response(request, body):
+    """Returns `request.response` with `body` (a serialized JSON string) as its body."""
+    response = request.response
+    response.content_type = 'application/json'
+    response.charset = 'UTF-8'
+    response.body = body
+    return response
+
+
+class SerializeOnce(object):
+    """Holds the result of a view that may be shared by several requests, and serializes it to
+    JSON (once) when it is first needed."""
+
+    def __init__(self, value):
+        """Wraps `value` (which must not be modified afterwards)."""
+        self.value = value
+        self._lock = Lock()
+        self._json = None
+
+    def json_body(self):
+        """Returns the JSON encoding of the value as a UTF-8 byte string."""
+        with self._lock:
+            if self._json is None:
+                self._json = json_codec.dumps(self.value)
+            return self._json
+
+
 def httpexcept(except_class, message):
     """Returns an instance of `except_class` with a body that hos phylesystem API's error body.
 
@@ -159,6 +423,69 @@ def err_body(description):
     return json.dumps(err)
 
 
+_GITHUB_USER_URL = 'https://api.github.com/user'
+# GitHub users looked up by the SHA-256 of their auth_token -> (expiration time, user or None)
+_GITHUB_AUTH_CACHE = LRUCache('github_auth', max_entries=1024)
+_GITHUB_AUTH_TTL = 300  # seconds for which a valid token is trusted without asking GitHub
+_GITHUB_AUTH_REJECTED_TTL = 30  # seconds for which a rejected token is not retried
+_GITHUB_SESSION = None
+_GITHUB_SESSION_PID = None
+_GITHUB_SESSION_LOCK = Lock()
+
+
+def configure_github_auth_cache(settings):
+    """Applies the "github_auth_ttl" and "github_auth_rejected_ttl" settings (in seconds)."""
+    global _GITHUB_AUTH_TTL, _GITHUB_AUTH_REJECTED_TTL
+    _GITHUB_AUTH_TTL = int(settings.get('github_auth_ttl', _GITHUB_AUTH_TTL))
+    _GITHUB_AUTH_REJECTED_TTL = int(settings.get('github_auth_rejected_ttl',
+                                                 _GITHUB_AUTH_REJECTED_TTL))
+
+
+def _github_session():
+    """Returns the requests.Session (with its pool of keep-alive connections) used for calls to
+    GitHub. A process gets its own session after a fork."""
+    global _GITHUB_SESSION, _GITHUB_SESSION_PID
+    with _GITHUB_SESSION_LOCK:
+        if _GITHUB_SESSION is None or _GITHUB_SESSION_PID != os.getpid():
+            session = requests.Session()
+            session.headers['Accept'] = 'application/vnd.github.v3+json'
+            _GITHUB_SESSION, _GITHUB_SESSION_PID = session, os.getpid()
+        return _GITHUB_SESSION
+
+
+def _fetch_github_user(auth_token):
+    """Returns {'login', 'name', 'email'} for the GitHub user of `auth_token`, or None if
+    GitHub rejects the token. Raises HTTPServiceUnavailable if GitHub cannot be asked."""
+    try:
+        resp = _github_session().get(_GITHUB_USER_URL,
+                                     headers={'Authorization': 'token ' + auth_token},
+                                     timeout=30)
+    except requests.RequestException:
+        _LOG.exception('GitHub user lookup failed')
+        raise httpexcept(HTTPServiceUnavailable, 'Could not reach GitHub to authenticate')
+    if resp.status_code == 401:
+        return None
+    if resp.status_code != 200:
+        msg = 'GitHub user lookup failed with status {}'.format(resp.status_code)
+        _LOG.error(msg)
+        raise httpexcept(HTTPServiceUnavailable, msg)
+    user = resp.json()
+    return {'login': user['login'], 'name': user.get('name'), 'email': user.get('email')}
+
+
+def _lookup_github_user(auth_token):
+    """Returns the (cached) result of `_fetch_github_user` for `auth_token`."""
+    key = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+    cached = _GITHUB_AUTH_CACHE.get(key)
+    now = time.time()
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    user = _fetch_github_user(auth_token)
+    ttl = _GITHUB_AUTH_TTL if user is not None else _GITHUB_AUTH_REJECTED_TTL
+    _GITHUB_AUTH_CACHE.put(key, (now + ttl, user))
+    return user
+
+
 def authenticate(**kwargs):
     """Raises an HTTPForbidden error if `auth_token` is not a kwarg or it isn't a GitHub username
 
@@ -166,6 +493,8 @@ def authenticate(**kwargs):
        `login` is the GitHub username
        `name` is kwargs.get('author_name', or the name associated w/ the GitHub user).
        `email` is kwargs.get('author_email', or the email address associated w/ the GitHub user).
+    The GitHub user of a token is cached for "github_auth_ttl" seconds (and a rejected token
+    is rejected for "github_auth_rejected_ttl" seconds without asking GitHub again).
     """
     # this is the GitHub API auth-token for a logged-in curator
     auth_token = kwargs.get('auth_token', '')
@@ -174,23 +503,18 @@ def authenticate(**kwargs):
         raise httpexcept(HTTPForbidden, msg)
     if _LOCAL_TESTING_MODE:
         return {'login': 'fake_gh_login', 'name': 'Fake Name', 'email': 'fake@bogus.com'}
-    gh = Github(auth_token)
-    gh_user = gh.get_user()
-    auth_info = {}
-    try:
-        auth_info['login'] = gh_user.login
-    except BadCredentialsException:
+    gh_user = _lookup_github_user(auth_token)
+    if gh_user is None:
         msg = "You have provided an invalid or expired authentication token"
         raise httpexcept(HTTPForbidden, msg)
-    auth_info['name'] = kwargs.get('author_name')
-    auth_info['email'] = kwargs.get('author_email')
-    # use the Github Oauth token to get a name/email if not specified
-    # we don't provide these as default values above because they would
-    # generate API calls regardless of author_name/author_email being specifed
+    auth_info = {'login': gh_user['login'],
+                 'name': kwargs.get('author_name'),
+                 'email': kwargs.get('author_email')}
+    # use the name/email of the GitHub user if they are not specified
     if auth_info['name'] is None:
-        auth_info['name'] = gh_user.name
+        auth_info['name'] = gh_user['name']
     if auth_info['email'] is None:
-        auth_info['email'] = gh_user.email
+        auth_info['email'] = gh_user['email']
     return auth_info
 
 
@@ -202,6 +526,120 @@ def check_api_version(request):
     return vstr
 
 
+_PARSED_JSON_BODY_KEY = 'phylesystem_api.parsed_json_body'
+# the versions of NexSON (and their aliases) that peyotl reads
+_NEXSON_VERSIONS = frozenset(['0', '0.0', '0.0.0', '1.0', '1.0.0', '1.2', '1.2.1'])
+# routes of the writes of studies, and whether the body must hold the NexSON
+_NEXSON_BODY_ROUTES = {'put_study_via_id': True, 'post_study': False}
+
+
+class _NexsonBodyError(ValueError):
+    """Raised by a _NexsonBodyCheck."""
+
+
+class _NexsonBodyCheck(object):
+    """Cheap checks of the structure of the JSON body of a write of a study (see
+    json_codec.load), that reject an invalid body before all of it has been decoded.
+
+    The NexSON is the body or its "nexson" member. The body must be an object, and the "nexml"
+    of the NexSON must be an object with a "@nexml2json" (if any) that peyotl reads. Sorted
+    NexSON starts with "@nexml2json", so a body with an unsupported version is rejected as soon
+    as it is reached. If `require_nexml`, a body without "nexml" is rejected when it ends.
+    """
+
+    max_depth = 3  # ("nexson", "nexml", "@nexml2json")
+
+    def __init__(self, require_nexml):
+        """`require_nexml` is True if the body must hold the NexSON."""
+        self.require_nexml = require_nexml
+
+    def check_member(self, path, value):
+        """Checks one of the values near the root of the body."""
+        if path == ():
+            if not isinstance(value, dict):
+                raise _NexsonBodyError('Expecting the body to be a JSON object')
+            return
+        if path[0] == 'nexson':
+            if len(path) == 1:
+                return  # an object, or a string that holds the NexSON
+            path = path[1:]
+        if path == ('nexml',) and not isinstance(value, dict):
+            raise _NexsonBodyError('Expecting "nexml" to be a JSON object')
+        if path == ('nexml', '@nexml2json') and value not in _NEXSON_VERSIONS:
+            raise _NexsonBodyError('NexSON version "{}" is not supported'.format(value))
+
+    def check_value(self, value):
+        """Checks the decoded body."""
+        self.check_member((), value)
+        nexson = value.get('nexson', value)
+        if not isinstance(nexson, dict):
+            return  # NexSON sent as a string
+        nexml = nexson.get('nexml')
+        if nexml is None:
+            if self.require_nexml:
+                raise _NexsonBodyError('Expecting the NexSON of the study to have "nexml"')
+            return
+        self.check_member(('nexml',), nexml)
+        if '@nexml2json' in nexml:
+            self.check_member(('nexml', '@nexml2json'), nexml['@nexml2json'])
+
+
+def _json_body_check(request):
+    """Returns the check of the structure of the JSON body of `request` (or None)."""
+    route = getattr(request, 'matched_route', None)
+    require_nexml = _NEXSON_BODY_ROUTES.get(getattr(route, 'name', None))
+    if require_nexml is None:
+        return None
+    return _NexsonBodyCheck(require_nexml)
+
+
+def parsed_json_body(request):
+    """Returns the JSON-decoded body of `request` (decoded with `json_codec` once per request).
+
+    The body is decoded from webob's seekable copy of it (which is spooled to a temporary file
+    if it is large) rather than from a string holding all of it, and UTF-8 bodies are not
+    converted to unicode before they are decoded.
+    Raises ValueError if the body is empty or is not JSON, and an HTTPBadRequest if the body of
+    a write of a study fails the checks of a _NexsonBodyCheck.
+    """
+    env = request.environ
+    if _PARSED_JSON_BODY_KEY not in env:
+        body_file = _seekable_body_file(request)
+        if not body_file.read(1):
+            env[_PARSED_JSON_BODY_KEY] = (False, 'empty body')
+        else:
+            body_file.seek(0)
+            charset = (request.charset or 'UTF-8').upper()
+            check = _json_body_check(request)
+            try:
+                if charset in ('UTF-8', 'UTF8'):
+                    value = json_codec.load(body_file, check)
+                else:
+                    value = json_codec.loads(body_file.read().decode(charset), check)
+                env[_PARSED_JSON_BODY_KEY] = (True, value)
+            except _NexsonBodyError, x:
+                env[_PARSED_JSON_BODY_KEY] = (False, x)
+            except Exception, x:
+                env[_PARSED_JSON_BODY_KEY] = (False, str(x))
+        body_file.seek(0)
+    parsed, value = env[_PARSED_JSON_BODY_KEY]
+    if not parsed:
+        if isinstance(value, _NexsonBodyError):
+            raise httpexcept(HTTPBadRequest, str(value))
+        raise ValueError('request body is not JSON: {}'.format(value))
+    return value
+
+
+def _seekable_body_file(request):
+    """Returns a file holding the body of `request`, positioned at its start."""
+    try:
+        body_file = request.body_file_seekable
+    except AttributeError:  # e.g. a pyramid.testing.DummyRequest, which only has `body`
+        return StringIO(request.body)
+    body_file.seek(0)
+    return body_file
+
+
 def extract_posted_data(request):
     """Helper - returns a dict from a POST request, by checking the cascade: POST, params, text."""
     if request.POST:
@@ -209,7 +647,7 @@ def extract_posted_data(request):
     if request.params:
         return request.params
     if request.text:
-        return json.loads(request.text)
+        return parsed_json_body(request)
     raise httpexcept(HTTPBadRequest, "no POSTed data")
 
 
@@ -228,14 +666,32 @@ def finish_write_operation(request, umbrella, document, put_args):
     If `put_args["doc_id"]` is empty, this function treats the document as a new resource,
         otherwise it is considered to be an edit.
     Before the annotate_and_write is called, umbrella.validate_and_convert_doc will be called
-        to validate (and possibly transform) the `document`
+        to validate (and possibly transform) the `document` (see `validate_and_convert_doc`)
         Raises as HTTPBadRequest or returns an annotated commit object. If a manual merge is not
         needed a push to GitHub will be triggered.
     """
     auth_info = put_args['auth_info']
     doc_id = put_args.get('doc_id')
+    bundle = validate_and_convert_doc(request.registry.settings, umbrella, document, put_args)
+    annotated_commit = _commit_validated_doc(umbrella, bundle, put_args)
+    mn = annotated_commit.get('merge_needed')
+    if (mn is not None) and (not mn):
+        if doc_id is not None and umbrella.document_type == 'study':
+            warm_study_structure_index(umbrella, doc_id)
+        sync_study_doi_index(request.registry.settings)
+        trigger_push(request, umbrella, doc_id, 'EDIT', auth_info)
+    return annotated_commit
+
+
+def _commit_validated_doc(umbrella, bundle, put_args):
+    """Writes a document given the `bundle` returned by `validate_and_convert_doc`.
+
+    Returns the annotated commit (without triggering a push).
+    Raises HTTPBadRequest if the document failed validation or could not be written.
+    """
+    auth_info = put_args['auth_info']
+    doc_id = put_args.get('doc_id')
     commit_msg = put_args.get('commit_msg')
-    bundle = umbrella.validate_and_convert_doc(document, put_args)
     processed_doc, errors, annotation, doc_adaptor = bundle
     if len(errors) > 0:
         resource_type = put_args.get('resource_type')
@@ -261,14 +717,103 @@ def finish_write_operation(request, umbrella, document, put_args):
     except GitWorkflowError, err:
         _LOG.exception('write operation failed in annotate_and_write')
         raise httpexcept(HTTPBadRequest, err.msg)
+    finally:
+        invalidate_cached_document(umbrella, doc_id)
     if annotated_commit.get('error', 0) != 0:
         raise httpexcept(HTTPBadRequest, json.dumps(annotated_commit))
-    mn = annotated_commit.get('merge_needed')
-    if (mn is not None) and (not mn):
-        trigger_push(request, umbrella, doc_id, 'EDIT', auth_info)
     return annotated_commit
 
 
+def bulk_write_operation(request, umbrella, items, auth_info):
+    """Writes a list of documents of `umbrella` for one (already authenticated) user.
+
+    `items` is a list of (document, put_args) pairs, with put_args as for
+        `finish_write_operation` (a "doc_id" of None creates a new document).
+    The documents are validated in parallel (by the `batch_thread_pool`, which hands the work
+    to the `validation_process_pool` if there is one). The writes to different shards are
+    done in parallel, and those to the same shard in the order of `items`. One push is
+    triggered for each shard that received a write that did not need a manual merge.
+    Returns a list with, for each item, its annotated commit or (if it failed) an object with
+    "error" -> 1, "resource_id" and a "description" of the failure.
+    """
+    settings = request.registry.settings
+    pool = batch_thread_pool(settings)
+
+    def failure(doc_id, x):
+        """Returns the result object for an item that failed with exception `x`."""
+        try:
+            description = json.loads(x.body)['description']
+        except:
+            description = x.detail or x.title
+        return {'error': 1, 'resource_id': doc_id, 'description': description}
+
+    def validate(index):
+        """Returns (index, bundle or failure object) for items[index]."""
+        document, put_args = items[index]
+        try:
+            return index, validate_and_convert_doc(settings, umbrella, document, put_args)
+        except HTTPException, x:
+            return index, failure(put_args.get('doc_id'), x)
+        except:
+            _LOG.exception('validation of bulk item {} failed'.format(index))
+            return index, failure(put_args.get('doc_id'),
+                                  httpexcept(HTTPInternalServerError, 'Validation failed'))
+
+    results = [None] * len(items)
+    by_shard = {}
+    for index, bundle in pool.imap_unordered(validate, range(len(items))):
+        if isinstance(bundle, dict):
+            results[index] = bundle
+        else:
+            doc_id = items[index][1].get('doc_id')
+            # new documents all go to the shard that takes new documents
+            by_shard.setdefault(_shard_path_for_doc(umbrella, doc_id), []).append((index, bundle))
+
+    def write_shard(indexed_bundles):
+        """Writes the documents of one shard, in order. Returns [(index, result)]."""
+        written = []
+        for index, bundle in sorted(indexed_bundles):
+            put_args = items[index][1]
+            try:
+                written.append((index, _commit_validated_doc(umbrella, bundle, put_args)))
+            except HTTPException, x:
+                written.append((index, failure(put_args.get('doc_id'), x)))
+            except:
+                _LOG.exception('write of bulk item {} failed'.format(index))
+                x = httpexcept(HTTPInternalServerError, 'Write failed')
+                written.append((index, failure(put_args.get('doc_id'), x)))
+        return written
+
+    pushed_shards = set()
+    any_merged = False
+    for written in pool.imap_unordered(write_shard, by_shard.values()):
+        for index, annotated_commit in written:
+            results[index] = annotated_commit
+            if annotated_commit.get('error', 0) != 0 or annotated_commit.get('merge_needed', True):
+                continue
+            any_merged = True
+            doc_id = annotated_commit.get('resource_id', items[index][1].get('doc_id'))
+            if doc_id is not None and umbrella.document_type == 'study':
+                warm_study_structure_index(umbrella, doc_id)
+            shard_key = _shard_path_for_doc(umbrella, doc_id) or doc_id
+            if shard_key not in pushed_shards:
+                pushed_shards.add(shard_key)
+                trigger_push(request, umbrella, doc_id, 'EDIT', auth_info)
+    if any_merged:
+        sync_study_doi_index(settings)
+    return results
+
+
+def _shard_path_for_doc(umbrella, doc_id):
+    """Returns the path of the shard that holds `doc_id`, or None if it is not known."""
+    if doc_id is None:
+        return None
+    try:
+        return umbrella.get_shard(doc_id).path
+    except:
+        return None
+
+
 def commit_new_doc_helper(umbrella, doc_bundle, auth_info, commit_msg):
     """Adaptor for a call to TypeAwareDocStore.add_new_doc that returns the annotated commit.
 
@@ -319,7 +864,7 @@ def fetch_all_docs_and_last_commit(docstore):
     for doc_id, props in docstore.iter_doc_objs():
         _LOG.debug('doc_id = {}'.format(doc_id))
         # reckon and add 'lastModified' property, based on commit history?
-        latest_commit = docstore.get_version_history_for_doc_id(doc_id)[0]
+        latest_commit = get_doc_version_history(docstore, doc_id, max_count=1)[0]
         props.update({
             'id': doc_id,
             'lastModified': {
@@ -334,15 +879,356 @@ def fetch_all_docs_and_last_commit(docstore):
     return doc_list
 
 
+######################################################################################
+# Cached access to documents
+_DOCUMENT_CACHE = LRUCache('document', max_entries=128)
+# outputs of newick, NEXUS, NeXML... exports and of subresource extraction
+_TRANSFORMED_DOCUMENT_CACHE = LRUCache('transformed_document',
+                                       max_entries=512,
+                                       max_bytes=64 * 1024 * 1024)
+_COMMIT_SHA_PATTERN = re.compile(r'^[0-9a-fA-F]{4,40}$')
+
+
+def doc_state_token(umbrella, doc_id, commit_sha=None):
+    """Returns a string that identifies the version of `doc_id` (and its WIP branches) to serve.
+
+    The token is the `shard_state_token` of the shard that holds the document, prefixed by
+    `commit_sha` if a specific commit is requested (the WIP map can change even then).
+    """
+    token = shard_state_token(umbrella.get_shard(doc_id).path)
+    if commit_sha:
+        return '{}:{}'.format(commit_sha, token)
+    return token
+
+
+def document_etag(token, subresource_req_dict, params, url):
+    """Returns the (unquoted) ETag for the response to a GET of a document or subresource.
+
+    `token` is the `doc_state_token` of the document; the other arguments are the output
+    of `subresource_request_helper` and the URL (which is echoed in JSON responses).
+    """
+    fields = params.get('fields')
+    variant = json.dumps([subresource_req_dict,
+                          bool(params.get('version_history')),
+                          bool(params.get('external_url')),
+                          None if fields is None else sorted(fields),
+                          url], sort_keys=True)
+    digest = hashlib.sha1(variant.encode('utf-8')).hexdigest()
+    return '{}-{}'.format(hashlib.sha1(token.encode('utf-8')).hexdigest()[:20], digest[:20])
+
+
+def fetch_document(umbrella, doc_id, commit_sha=None, version_history=False):
+    """Returns (document_blob, head_sha, wip_map, version_history) for `doc_id`.
+
+    `version_history` in the returned tuple is None unless `version_history` is True.
+    Results are held in the "document" cache keyed by the `doc_state_token`, so the returned
+    objects may be shared with other requests and must not be modified by the caller.
+    """
+    token = doc_state_token(umbrella, doc_id, commit_sha)
+    key = (umbrella.document_type, doc_id, token)
+    cached = _DOCUMENT_CACHE.get(key)
+    if cached is None:
+        r = None
+        try:
+            r = _read_stored_document(umbrella, doc_id, commit_sha)
+        except:
+            _LOG.exception('object store read of {} failed'.format(doc_id))
+        if r is None:
+            r = umbrella.return_document(doc_id, commit_sha=commit_sha, return_WIP_map=True)
+            cached = tuple(r)
+        else:
+            content, head_sha, wip_map = r
+            cached = (json_codec.loads(content), head_sha, wip_map)
+        # a write that lands while we were reading could make the result stale for `token`
+        if token == doc_state_token(umbrella, doc_id, commit_sha):
+            _DOCUMENT_CACHE.put(key, cached)
+    document_blob, head_sha, wip_map = cached
+    history = get_doc_version_history(umbrella, doc_id) if version_history else None
+    return document_blob, head_sha, wip_map, history
+
+
+def _doc_wip_map(shard_path, doc_id):
+    """Returns the dict of branch name -> SHA for "master" and the WIP branches of `doc_id`."""
+    # same convention as peyotl for naming the WIP branches of a document
+    wip_pattern = re.compile(r'.*_{}_[0-9]+$'.format(re.escape(doc_id)))
+    branches = read_branch_shas(shard_path)
+    wip_map = {b: s for b, s in branches.items() if wip_pattern.match(b)}
+    wip_map['master'] = branches.get('master')
+    return wip_map
+
+
+def _read_stored_document(umbrella, doc_id, commit_sha=None):
+    """Returns (file content, commit SHA, WIP map) for `doc_id` read from the object database
+    of its shard (see phylesystem_api.git_blobs), or None if it cannot be read that way.
+
+    The content is that of `commit_sha` if it is given, or of master. This does not need the
+    shard's lock or a checkout, so it does not wait for writes.
+    """
+    if commit_sha is not None and not _COMMIT_SHA_PATTERN.match(commit_sha):
+        return None
+    shard_path = umbrella.get_shard(doc_id).path
+    rel_path = umbrella.get_repo_and_path_fragment(doc_id)[1]
+    wip_map = _doc_wip_map(shard_path, doc_id)
+    head_sha = commit_sha or wip_map['master']
+    if head_sha is None:
+        return None
+    content = get_cat_file_pool(shard_path).read_blob(head_sha, rel_path)
+    if content is None:
+        return None
+    return content, head_sha, wip_map
+
+
+def raw_document_response(request, umbrella, doc_id):  # pylint: disable=W0613
+    """Returns a Response with the stored bytes of the master version of `doc_id`.
+
+    The blob is read from the master commit in the object database of the shard (see
+    `_read_stored_document`), not from the working tree, which peyotl rewrites in place
+    while it writes the document. So the body is always that of the commit whose SHA is
+    sent in the X-Commit-SHA header.
+    Raises HTTPNotFound if the document does not exist.
+    """
+    try:
+        body, head_sha, _ = _read_stored_document(umbrella, doc_id)
+    except:
+        _LOG.exception('raw GET of {} failed'.format(doc_id))
+        raise HTTPNotFound('document {} GET failure'.format(doc_id))
+    response = Response(body=body, content_type='application/json')
+    response.headers['X-Commit-SHA'] = str(head_sha)
+    return response
+
+
+def fetch_study_skeleton(umbrella, doc_id, subresource_type, subresource_id, commit_sha=None,
+                         version_history=False):
+    """Returns the same tuple as `fetch_document`, but with a "skeleton" of the study (see
+    phylesystem_api.study_structure) that holds only what is needed for the subresource.
+
+    Returns None if the subresource needs the full study or the skeleton cannot be built
+    (the caller should then use `fetch_document`).
+    """
+    if subresource_type not in SKELETON_SUBRESOURCE_TYPES:
+        return None
+    if isinstance(subresource_id, list):
+        subresource_id = tuple(subresource_id)
+    try:
+        r = _read_stored_document(umbrella, doc_id, commit_sha)
+        if r is None:
+            return None
+        content, head_sha, wip_map = r
+        skeleton = build_skeleton_study(content, subresource_type, subresource_id)
+    except KeyError:
+        return None  # unknown tree. The full study gives the right error
+    except:
+        _LOG.exception('skeleton of {} could not be built'.format(doc_id))
+        return None
+    history = get_doc_version_history(umbrella, doc_id) if version_history else None
+    return skeleton, head_sha, wip_map, history
+
+
+def warm_study_structure_index(umbrella, doc_id):
+    """Indexes the structure of `doc_id` on master (called after a write of a study)."""
+    try:
+        r = _read_stored_document(umbrella, doc_id)
+        if r is not None:
+            get_structure_index(r[0])
+    except:
+        _LOG.exception('structure index of {} could not be built'.format(doc_id))
+
+
+def get_doc_version_history(umbrella, doc_id, max_count=None):
+    """Returns the list of commit records (newest first) for `doc_id` on master.
+
+    The records come from the history index of the document's shard (see
+    phylesystem_api.history_index). If the index cannot answer, this falls back to
+    `umbrella.get_version_history_for_doc_id`.
+    """
+    history = None
+    try:
+        shard_path = umbrella.get_shard(doc_id).path
+        rel_path = umbrella.get_repo_and_path_fragment(doc_id)[1]
+        history = get_shard_history_index(shard_path).history(rel_path, max_count=max_count)
+    except:
+        _LOG.exception('history index lookup failed for {}'.format(doc_id))
+    if history is None:
+        history = umbrella.get_version_history_for_doc_id(doc_id)
+        if max_count is not None:
+            history = history[:max_count]
+    return history
+
+
+def transform_document(umbrella, doc_id, document_blob, head_sha, transformer,
+                       subresource_req_dict):
+    """Returns the output of `transformer` applied to a copy of `document_blob`.
+
+    Outputs are cached by the doc_id, `head_sha` and the normalized output format and
+    subresource of `subresource_req_dict` (see `subresource_request_helper`). Exceptions raised
+    by `transformer` are not caught.
+    """
+    variant = json.dumps([subresource_req_dict.get('output_format'),
+                          subresource_req_dict.get('output_is_json'),
+                          subresource_req_dict.get('subresource_type'),
+                          subresource_req_dict.get('subresource_id')], sort_keys=True)
+    key = (umbrella.document_type, doc_id, head_sha, variant)
+    cached = _TRANSFORMED_DOCUMENT_CACHE.get(key)
+    if cached is not None:
+        return cached
+    # the cached document_blob is shared, and transformers may modify their input
+    result = transformer(umbrella, doc_id, copy.deepcopy(document_blob), head_sha)
+    if isinstance(result, (str, unicode)):
+        size = len(result)
+    else:
+        size = len(json.dumps(result))
+    _TRANSFORMED_DOCUMENT_CACHE.put(key, result, size=size)
+    return result
+
+
+def invalidate_cached_document(umbrella, doc_id):
+    """Drops any cached data derived from `doc_id` (called after writes and webhook calls)."""
+    if doc_id is None:
+        return
+    doc_type = umbrella.document_type
+    _DOCUMENT_CACHE.discard_if(lambda k: k[0] == doc_type and k[1] == doc_id)
+    _TRANSFORMED_DOCUMENT_CACHE.discard_if(lambda k: k[0] == doc_type and k[1] == doc_id)
+
+
+######################################################################################
+# Rendering of markdown comments
+_MARKDOWN_HTML_CACHE = LRUCache('markdown_html', max_entries=1024, max_bytes=16 * 1024 * 1024)
+_MARKDOWN_ALLOWED_TAGS = ['p', 'a', 'hr', 'i', 'em', 'b', 'div', 'ul', 'ol', 'li',
+                          'h1', 'h2', 'h3', 'h4']
+# markdown and bleach objects are reusable but not thread-safe, so each thread gets its own.
+_MARKDOWN_RENDERERS = local()
+
+
+# noinspection PyUnusedLocal
+def _add_blank_target(attrs, new=False):  # pylint: disable=W0613
+    """Hook to add target="_blank" to links created by bleach's Linker"""
+    attrs[(None, u'target')] = u'_blank'
+    return attrs
+
+
+def _get_markdown_renderers():
+    """Returns this thread's (Markdown, Cleaner, Linker) triple, creating it if needed."""
+    renderers = getattr(_MARKDOWN_RENDERERS, 'renderers', None)
+    if renderers is None:
+        renderers = (markdown.Markdown(),
+                     Cleaner(tags=_MARKDOWN_ALLOWED_TAGS),
+                     Linker(callbacks=[_add_blank_target]))
+        _MARKDOWN_RENDERERS.renderers = renderers
+    return renderers
+
+
+def render_markdown_html(src):
+    """Returns the sanitized, linkified HTML version of the markdown `src`.
+
+    Results are held in the "markdown_html" cache keyed by a hash of `src`.
+    """
+    if not src:
+        return ''
+    if isinstance(src, unicode):
+        encoded = src.encode('utf-8')
+    else:
+        encoded = src
+    key = hashlib.sha1(encoded).hexdigest()
+    html = _MARKDOWN_HTML_CACHE.get(key)
+    if html is None:
+        md, cleaner, linker = _get_markdown_renderers()
+        html = linker.linkify(cleaner.clean(md.reset().convert(src)))
+        _MARKDOWN_HTML_CACHE.put(key, html, size=len(html))
+    return html
+
+
 ######################################################################################
 # Code for execution in a non-blocking thread
+_PUSH_GROUP_WINDOW = 0.0  # seconds; 0 for one push per write
+
+
+def configure_push_grouping(settings):
+    """Sets the window for grouping pushes from the 'push_group_window_ms' setting."""
+    global _PUSH_GROUP_WINDOW
+    _PUSH_GROUP_WINDOW = max(0.0, float(settings.get('push_group_window_ms', 0)) / 1000.0)
+
+
 class JobQueue(Queue):
-    """Thread-safe Queue that logs the addition of a job to debug"""
+    """Thread-safe Queue that logs the addition of a job to debug
+
+    If pushes are grouped (a 'push_group_window_ms' greater than 0), a GitPushJob for a shard
+    that already has a push waiting in the queue is folded into that push (which will push the
+    new commits too), and a push does not come due until the window has passed since it was
+    queued. So the writes to a shard that arrive within the window share one push.
+
+    The jobs are held in a heap ordered by the time at which they come due, so a push waiting
+    for its window does not hold back the jobs (e.g. pushes to other shards) that are due
+    before it.
+    """
+    def __init__(self):
+        """Creates an empty queue with no waiting pushes"""
+        Queue.__init__(self)
+        self._waiting_pushes = {}
+        self._waiting_pushes_lock = Lock()
+
+    def _init(self, maxsize):
+        """Holds the jobs in a heap of (due time, sequence number, job)"""
+        self.queue = []
+        self._sequence = itertools.count()
+
+    def _put(self, item):
+        """Adds `item` to the heap; jobs without a due time are due when they are queued"""
+        due_time = getattr(item, 'due_time', None)
+        if due_time is None:
+            due_time = time.time()
+        heapq.heappush(self.queue, (due_time, next(self._sequence), item))
+
+    def _get(self):
+        """Removes the job that comes due first from the heap"""
+        return heapq.heappop(self.queue)[2]
+
     def put(self, item, block=None, timeout=None):
         """Logs `item` at the debug level then calls base-class put"""
+        if _PUSH_GROUP_WINDOW > 0 and isinstance(item, GitPushJob):
+            group_key = item.shard_key()
+            with self._waiting_pushes_lock:
+                waiting = self._waiting_pushes.get(group_key)
+                if waiting is not None:
+                    waiting.fold(item)
+                    _LOG.debug("%s folded into a waiting push" % str(item))
+                    return
+                item.group_key = group_key
+                item.due_time = time.time() + _PUSH_GROUP_WINDOW
+                self._waiting_pushes[group_key] = item
         _LOG.debug("%s queued" % str(item))
         Queue.put(self, item, block=block, timeout=timeout)
 
+    def get(self, block=True, timeout=None):
+        """Returns the next job that is due, in the order in which the jobs come due.
+
+        Like Queue.get, raises Empty if no job is due (without `block`, or when `timeout`
+        has passed). Jobs that are queued while this call waits for a grouped push to come due
+        are returned first if they are due earlier.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.not_empty:
+            while True:
+                wait = self.queue[0][0] - time.time() if self.queue else None
+                if wait is not None and wait <= 0:
+                    item = self._get()
+                    self.not_full.notify()
+                    break
+                if not block:
+                    raise Empty
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.not_empty.wait(wait)
+        group_key = getattr(item, 'group_key', None)
+        if group_key is not None:
+            with self._waiting_pushes_lock:
+                # writes after this point need a push of their own
+                if self._waiting_pushes.get(group_key) is item:
+                    del self._waiting_pushes[group_key]
+        return item
+
 
 _jobq = JobQueue()
 
@@ -386,6 +1272,159 @@ def start_worker(num_workers):
         t.start()
 
 
+_BATCH_POOL = None
+_BATCH_POOL_PID = None
+_BATCH_POOL_LOCK = Lock()
+
+
+def batch_thread_pool(settings):
+    """Returns the ThreadPool shared by batch requests, creating it if needed.
+
+    The number of threads (and so the number of items of batch requests that are resolved in
+    parallel by this process) is the 'batch_max_workers' setting (default 4).
+    """
+    global _BATCH_POOL, _BATCH_POOL_PID
+    with _BATCH_POOL_LOCK:
+        # the threads of a pool do not survive a fork
+        if _BATCH_POOL is None or _BATCH_POOL_PID != os.getpid():
+            _BATCH_POOL = ThreadPool(int(settings.get('batch_max_workers', 4)))
+            _BATCH_POOL_PID = os.getpid()
+        return _BATCH_POOL
+
+
+_VALIDATION_POOL = None
+_VALIDATION_POOL_PID = None
+_VALIDATION_POOL_LOCK = Lock()
+_VALIDATION_POOL_SETTINGS = None  # the app settings, as seen by the processes of the pool
+
+
+def _validate_and_convert_in_worker(umbrella_key, document, put_args):
+    """Runs validate_and_convert_doc in a process of the validation pool.
+
+    Returns (True, result) or (False, description of the exception). Exceptions are not
+    raised, because some (e.g. peyotl's GitWorkflowError) cannot be unpickled by the parent,
+    which would kill the thread of the pool that collects the results.
+    """
+    try:
+        umbrella = resolve_umbrella(_VALIDATION_POOL_SETTINGS, umbrella_key)
+        return True, umbrella.validate_and_convert_doc(document, put_args)
+    except Exception, x:
+        _LOG.exception('validation in the process pool failed')
+        return False, '{}: {}'.format(type(x).__name__, x)
+
+
+def start_validation_process_pool(settings):
+    """Creates the multiprocessing Pool used to validate documents in this process.
+
+    The number of processes is the 'validation_processes' setting (no pool is created if it is
+    absent or 0). The processes are forked from this process, so this must be called before
+    the server starts its threads (another thread could hold a lock that the children would
+    inherit). They share the doc store umbrellas that are built at that point.
+    """
+    global _VALIDATION_POOL, _VALIDATION_POOL_PID, _VALIDATION_POOL_SETTINGS
+    num_processes = int(settings.get('validation_processes', 0))
+    if num_processes <= 0:
+        return
+    with _VALIDATION_POOL_LOCK:
+        _VALIDATION_POOL_SETTINGS = settings
+        _VALIDATION_POOL = multiprocessing.Pool(num_processes)
+        _VALIDATION_POOL_PID = os.getpid()
+
+
+def close_validation_process_pool():
+    """Terminates the validation pool of this process (if any)."""
+    global _VALIDATION_POOL, _VALIDATION_POOL_PID
+    with _VALIDATION_POOL_LOCK:
+        if _VALIDATION_POOL is not None and _VALIDATION_POOL_PID == os.getpid():
+            _VALIDATION_POOL.terminate()
+        _VALIDATION_POOL, _VALIDATION_POOL_PID = None, None
+
+
+def validation_process_pool():
+    """Returns the Pool made by `start_validation_process_pool` in this process, or None.
+
+    Without a pool the documents are validated by the thread that handles the request.
+    """
+    with _VALIDATION_POOL_LOCK:
+        # a pool can only be used by the process that created it
+        if _VALIDATION_POOL is None or _VALIDATION_POOL_PID != os.getpid():
+            return None
+        return _VALIDATION_POOL
+
+
+def validate_and_convert_doc(settings, umbrella, document, put_args):
+    """Returns the (processed_doc, errors, annotation, doc_adaptor) of validating `document`.
+
+    This is the output of the umbrella's validate_and_convert_doc method. If there is a
+    `validation_process_pool`, the (CPU-bound) work is done by one of its processes, so it does
+    not hold the GIL of the process that is serving requests.
+    Raises HTTPGatewayTimeout if the pool does not answer in 'validation_timeout' seconds,
+    HTTPBadRequest if the validator raised an exception in the pool, and
+    HTTPInternalServerError if the pool failed (e.g. the result could not be pickled).
+
+    If the 'incremental_validation' setting is true, a study that is an edit (with a
+    "starting_commit_SHA") is validated as changes to that version (see
+    phylesystem_api.incremental_validation): only its changed trees and otus groups are
+    validated, and the messages about the rest are those stored in the starting version.
+    The whole study is validated if that could give a different result.
+    """
+    if asbool(settings.get('incremental_validation', False)):
+        bundle = _validate_study_incrementally(settings, umbrella, document, put_args)
+        if bundle is not None:
+            return bundle
+    return _validate_and_convert_doc(settings, umbrella, document, put_args)
+
+
+def _validate_study_incrementally(settings, umbrella, document, put_args):
+    """Returns the bundle of `validate_and_convert_doc` for `document` validated as changes to
+    its starting version, or None if the whole document must be validated."""
+    doc_id, parent_sha = put_args.get('doc_id'), put_args.get('starting_commit_SHA')
+    if umbrella.document_type != 'study' or not doc_id or not parent_sha:
+        return None
+    try:
+        parent = fetch_document(umbrella, doc_id, commit_sha=parent_sha)[0]
+    except:
+        _LOG.exception('starting version of {} could not be read'.format(doc_id))
+        return None
+    plan = plan_incremental_validation(document, parent, getattr(umbrella, 'repo_nexml2json', None))
+    if plan is None:
+        return None
+    try:
+        bundle = _validate_and_convert_doc(settings, umbrella, plan.skeleton, put_args)
+    except HTTPGatewayTimeout:
+        raise
+    except:
+        _LOG.exception('validation of the changes to {} failed'.format(doc_id))
+        return None
+    errors, annotation, doc_adaptor = bundle[1:]
+    if errors:
+        return None  # the errors are reported by the validation of the whole document
+    annotation = plan.merge_annotation(annotation)
+    if annotation is None:
+        return None
+    # the document is not converted, as it is in the version of NexSON used by the doc store
+    return document, [], annotation, doc_adaptor
+
+
+def _validate_and_convert_doc(settings, umbrella, document, put_args):
+    """Validates `document` with the umbrella, in the `validation_process_pool` if there is one."""
+    pool = validation_process_pool()
+    if pool is None:
+        return umbrella.validate_and_convert_doc(document, put_args)
+    timeout = int(settings.get('validation_timeout', 600))
+    args = (umbrella_settings_key(settings, umbrella), document, put_args)
+    try:
+        ok, result = pool.apply_async(_validate_and_convert_in_worker, args).get(timeout)
+    except multiprocessing.TimeoutError:
+        raise httpexcept(HTTPGatewayTimeout, 'Validation of the document timed out')
+    except:
+        _LOG.exception('validation in the process pool failed')
+        raise httpexcept(HTTPInternalServerError, 'Validation of the document failed')
+    if not ok:
+        raise httpexcept(HTTPBadRequest, 'Validation of the document failed: {}'.format(result))
+    return result
+
+
 ######################################################################################
 # bookkeeping for the in-memory info about push status
 def add_push_failure(push_failure_dict_lock, push_failure_dict, umbrella, msg):
@@ -425,6 +1464,34 @@ def copy_of_push_failures(push_failure_dict_lock, push_failure_dict, umbrella):
         return copy.copy(push_failure_dict.setdefault(umbrella.document_type, []))
 
 
+def push_failures_for_umbrella(settings, umbrella):
+    """Returns a copy of the list of push failures for the doc_type of `umbrella`.
+
+    If pushes are delegated to another process (see phylesystem_api.prefork), the list
+    is fetched from the process that performs the pushes.
+    """
+    job_queue = settings['job_queue']
+    if hasattr(job_queue, 'copy_of_push_failures'):
+        return job_queue.copy_of_push_failures(umbrella)
+    return copy_of_push_failures(push_failure_dict_lock=settings['push_failure_lock'],
+                                 push_failure_dict=settings['doc_type_to_push_failure_list'],
+                                 umbrella=umbrella)
+
+
+def umbrella_settings_key(settings, umbrella):
+    """Returns the settings key ("phylesystem", "taxon_amendments"...) that holds `umbrella`."""
+    for key in _UMBRELLA_SETTINGS_KEYS:
+        if resolve_umbrella(settings, key) is umbrella:
+            return key
+    raise ValueError('umbrella for "{}" not found in settings'.format(umbrella.document_type))
+
+
+def resolve_all_umbrellas(settings):
+    """Builds (if necessary) all of the umbrellas referred to in `settings`."""
+    for key in _UMBRELLA_SETTINGS_KEYS:
+        resolve_umbrella(settings, key)
+
+
 def find_studies_by_doi(indexer_domain, study_doi):
     """Returns a list of studies with a DOI that match `study_doi` by calling indexer.
 
@@ -435,20 +1502,49 @@ def find_studies_by_doi(indexer_domain, study_doi):
     return oti_wrapper.find_studies_by_doi(study_doi)
 
 
+def find_duplicate_study_ids(settings, doc_id, study_doi):
+    """Returns a list of the IDs of studies other than `doc_id` with a DOI matching `study_doi`.
+
+    The local study DOI index is used if it is ready. Otherwise (or if the
+    'duplicate_study_detection' setting is "otindex") otindex is called.
+    """
+    doi_index = settings.get('study_doi_index')
+    found = None
+    if doi_index is not None:
+        found = doi_index.find_studies(study_doi)
+    if found is None:
+        found = find_studies_by_doi(settings['otindex_base_url'], study_doi)
+    return [i for i in found if i != doc_id]
+
+
+def sync_study_doi_index(settings):
+    """Brings the study DOI index up to date with the master branches (called after writes)."""
+    doi_index = settings.get('study_doi_index')
+    if doi_index is None:
+        return
+    try:
+        doi_index.sync()
+    except:
+        _LOG.exception('sync of the study DOI index failed')
+
+
 class GitPushJob(object):
     """Class that wraps up the info to push a shard to GitHub for use in thread-safe queues.
 
     Instances of this job are placed on the JobQueue, and run by the `worker` function. So
     the methods of this class need to coordinate with that function.
     """
-    def __init__(self, request, umbrella, doc_id, operation, auth_info=None):
+    def __init__(self, request, umbrella, doc_id, operation, auth_info=None, settings=None):
         """:param request: request object just used to get config dependent settings.
+            May be None if `settings` is supplied.
         :param umbrella: instance of a TypeAwareDocStore that holds the doc to be pushed
         :param doc_id: the ID of the document to push
         :param operation: string such as "EDIT" or "DELETE" for logging purposes
         :param auth_info: info about the user triggering the push operation.
+        :param settings: the app settings dict (used instead of request.registry.settings)
         """
-        settings = request.registry.settings
+        if settings is None:
+            settings = request.registry.settings
         self.push_failure_dict_lock = settings['push_failure_lock']
         self.push_failure_dict = settings['doc_type_to_push_failure_list']
         self.doc_id = doc_id
@@ -458,11 +1554,32 @@ class GitPushJob(object):
         self.auth_info = auth_info
         self.reindex_fn = None
         self.push_success = False
+        self.folded_doc_ids = []  # docs of other pushes of the shard that this one performs
+        self.group_key = None
+        self.due_time = None
 
     def __str__(self):
         """Writes the operation, doc_id and doc_store info for logging purposes"""
         template = 'GitPushJob for {o} operation of "{i}" to store of "{d}" documents'
-        return template.format(o=self.operation, i=self.doc_id, d=self.umbrella.document_type)
+        s = template.format(o=self.operation, i=self.doc_id, d=self.umbrella.document_type)
+        if self.folded_doc_ids:
+            s += ' (and {} folded pushes)'.format(len(self.folded_doc_ids))
+        return s
+
+    def shard_key(self):
+        """Returns (document type, shard path) for the shard that the push will push.
+
+        The path is None if `doc_id` is None (every shard is pushed) and the doc_id if the
+        shard is not known."""
+        doc_type = self.umbrella.document_type
+        if self.doc_id is None:
+            return doc_type, None
+        return doc_type, _shard_path_for_doc(self.umbrella, self.doc_id) or self.doc_id
+
+    def fold(self, other):
+        """Records that this push (of the same shard) also stands in for the push `other`."""
+        self.folded_doc_ids.append(other.doc_id)
+        self.folded_doc_ids.extend(other.folded_doc_ids)
 
     def push_to_github(self):
         """Attempts the push. State is stored in push_success and status_str. updates push failures.
@@ -579,6 +1696,33 @@ def otindex_call(study_ids, otindex_base_url, oti_verb):
 
 ######################################################################################
 # more complex helpers for converting http requests to dicts of options
+DOCUMENT_ENVELOPE_FIELDS = frozenset(['sha', 'data', 'branch2sha', 'url', 'commentHTML',
+                                      'version_history', 'versionHistory', 'external_url',
+                                      'shardName', 'duplicateStudyIDs'])
+
+
+def parse_envelope_fields(fields):
+    """Returns None or a frozenset of names from the `fields` argument of a document GET.
+
+    `fields` can be None, a comma-separated string or a list of strings.
+    Raises HTTPBadRequest for names that are not in DOCUMENT_ENVELOPE_FIELDS.
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, (str, unicode)):
+        fields = fields.split(',')
+    try:
+        names = frozenset(f.strip() for f in fields if f.strip())
+    except:
+        raise httpexcept(HTTPBadRequest, 'fields must be a comma-separated list of names')
+    unknown = names - DOCUMENT_ENVELOPE_FIELDS
+    if unknown:
+        msg = 'Unknown fields: {}. Known fields are: {}'
+        msg = msg.format(', '.join(sorted(unknown)), ', '.join(sorted(DOCUMENT_ENVELOPE_FIELDS)))
+        raise httpexcept(HTTPBadRequest, msg)
+    return names
+
+
 def subresource_request_helper(request):
     """Helper function for get_document separates params into output and input dicts
 
@@ -610,30 +1754,46 @@ def subresource_request_helper(request):
         * version_history -> bool, True to include versionHistory in response
         * external_url -> bool, True to include external_url in response
         * starting_commit_SHA -> string or None
+        * fields -> None (the default envelope) or a frozenset of the names (from
+            DOCUMENT_ENVELOPE_FIELDS) of the members of a JSON response to compute. Read from
+            the "fields" (or "include") argument: a comma-separated string or a list.
     """
-    subresource_req_dict = {'output_is_json': True}
-    culled_params = {}
     # default behaviors, here. Overloaded by request specific args below
     params = {'version_history': True}
     params.update(request.params)
     params.update(dict(request.matchdict))
     try:
-        b = request.json_body
-        _LOG.debug('request.json_body={}'.format(b))
+        b = parsed_json_body(request)
+        _LOG.debug('JSON body={}'.format(b))
         params.update(b)
     except:
         pass
     _LOG.debug('request.params={}'.format(request.params))
     _LOG.debug('request.matchdict={}'.format(request.matchdict))
     _LOG.debug('params={}'.format(params))
+    return subresource_request_from_params(params, request.path.split('/')[-1])
+
+
+def subresource_request_from_params(params, last_word=None):
+    """Does the work of `subresource_request_helper` for a dict of arguments.
+
+    `last_word` is the last element of the path of the URL (if the arguments came from an URL).
+    If it has an extension (e.g. "ot_1424.json") the extension is treated as the output format.
+    """
+    subresource_req_dict = {'output_is_json': True}
+    culled_params = {}
+    params = dict(params)
+    params.setdefault('version_history', True)
     doc_id = params['doc_id']
     culled_params['doc_id'] = doc_id
     culled_params['version_history'] = params['version_history']
     culled_params['external_url'] = params.get('external_url', False)
     culled_params['starting_commit_SHA'] = params.get('starting_commit_SHA')
+    culled_params['fields'] = parse_envelope_fields(params.get('fields', params.get('include')))
     resource_type = params['resource_type']
     culled_params['resource_type'] = resource_type
-    last_word = request.path.split('/')[-1]
+    if last_word is None:
+        last_word = ''
     last_word_dot_split = last_word.split('.')
     last_word_was_doc_id = True
     type_ext = None
@@ -707,10 +1867,12 @@ def extract_write_args(request, study_post=False, require_document=True):
     resource_type = params['resource_type']
     data_kwarg_key = _RESOURCE_TYPE_2_DATA_JSON_ARG[resource_type]
     try:
-        b = request.json_body
+        b = parsed_json_body(request)
         for key, value in b.items():
             if key != data_kwarg_key:
                 params[key] = value
+    except HTTPException:
+        raise
     except:
         pass
     culled_params['auth_info'] = authenticate(**params)
@@ -743,9 +1905,9 @@ def _extract_json_obj_from_http_call(request, data_kwarg_key, exception_if_absen
         if data_kwarg_key in kwargs:
             json_blob = kwargs.get(data_kwarg_key, {})
         else:
-            json_blob = request.json_body
+            json_blob = parsed_json_body(request)
         if not (isinstance(json_blob, dict) or isinstance(json_blob, list)):
-            json_blob = json.loads(json_blob)
+            json_blob = json_codec.loads(json_blob)
         if data_kwarg_key in json_blob:
             json_blob = json_blob[data_kwarg_key]
     except:
@@ -757,6 +1919,59 @@ def _extract_json_obj_from_http_call(request, data_kwarg_key, exception_if_absen
     return json_blob
 
 
+def extract_bulk_write_args(request):
+    """Helper for the bulk write view. Returns (auth_info, items), with `items` being a list of
+    (document, put_args) pairs for `bulk_write_operation`.
+
+    The JSON body holds "documents" -> a list of objects with the document (as "document", or
+        as in the other write methods "nexson" for studies and "json" for other types) and:
+        "doc_id" (absent for new documents),
+        "starting_commit_SHA" (required with a "doc_id"),
+        "merged_SHA" and "commit_msg" (optional).
+    The other members of the body (and the params) are used to authenticate the user once
+        for all of the documents. A "commit_msg" there is the default for the documents.
+    raises Forbidden if auth fails, and HTTPBadRequest if the body cannot be used.
+    """
+    params = {}
+    params.update(request.params)
+    params.update(dict(request.matchdict))
+    try:
+        body = parsed_json_body(request)
+        documents = body['documents']
+        assert isinstance(documents, list)
+    except:
+        raise httpexcept(HTTPBadRequest, 'Expecting a JSON body with a "documents" list')
+    for key, value in body.items():
+        if key != 'documents':
+            params[key] = value
+    max_documents = int(request.registry.settings.get('bulk_write_max_documents', 500))
+    if len(documents) > max_documents:
+        msg = 'A bulk write can contain at most {} documents'.format(max_documents)
+        raise httpexcept(HTTPBadRequest, msg)
+    auth_info = authenticate(**params)
+    resource_type = params['resource_type']
+    umbrella_key = _RESOURCE_TYPE_2_SETTINGS_UMBRELLA_KEY.get(resource_type)
+    data_kwarg_key = 'nexson' if umbrella_key == 'phylesystem' else 'json'
+    items = []
+    for index, item in enumerate(documents):
+        document = None
+        if isinstance(item, dict):
+            document = item.get('document', item.get(data_kwarg_key))
+        if not isinstance(document, dict):
+            msg = 'Item {} of "documents" is not an object with a "document" object'
+            raise httpexcept(HTTPBadRequest, msg.format(index))
+        put_args = {'auth_info': auth_info,
+                    'resource_type': resource_type,
+                    'commit_msg': item.get('commit_msg', params.get('commit_msg'))}
+        for key in ('doc_id', 'starting_commit_SHA', 'merged_SHA'):
+            put_args[key] = item.get(key)
+        if put_args['doc_id'] is not None and put_args['starting_commit_SHA'] is None:
+            msg = 'Item {} of "documents" has a "doc_id" but no "starting_commit_SHA"'
+            raise httpexcept(HTTPBadRequest, msg.format(index))
+        items.append((document, put_args))
+    return auth_info, items
+
+
 def get_ids_of_synth_collections():
     """Fairly hacky way to get the IDs of all collections queued to be used in synthesis."""
     # URL could be configurable, but I'm not sure we've ever changed this...
@@ -836,6 +2051,8 @@ def append_tree_to_collection_helper(request, cds, collection_id, include_decisi
         raise httpexcept(HTTPInternalServerError, err.msg)
     except:
         raise httpexcept(HTTPBadRequest, traceback.format_exc())
+    finally:
+        invalidate_cached_document(cds, collection_id)
     # check for 'merge needed'?
     mn = commit_return.get('merge_needed')
     if (mn is not None) and (not mn):
@@ -4,21 +4,28 @@ of the guts of the work is done by functions in phylesystem_api.utility"""
 import itertools
 import json
 import traceback
-import bleach
-import markdown
 from peyotl import (add_cc0_waiver, concatenate_collections,
                     extract_tree_nexson,
                     get_logger, GitWorkflowError,
                     import_nexson_from_crossref_metadata, import_nexson_from_treebase, )
-from pyramid.httpexceptions import (HTTPNotFound, HTTPBadRequest, HTTPInternalServerError)
+from pyramid.httpexceptions import (HTTPException, HTTPNotFound, HTTPNotModified, HTTPBadRequest,
+                                    HTTPConflict, HTTPInternalServerError)
 from pyramid.response import Response
+from pyramid.settings import asbool
 from pyramid.view import view_config
-from phylesystem_api.utility import (append_tree_to_collection_helper,
-                                     collection_args_helper,
-                                     copy_of_push_failures, create_list_of_collections,
-                                     do_http_post_json,
-                                     err_body, extract_write_args, extract_posted_data,
-                                     fetch_all_docs_and_last_commit, find_studies_by_doi,
+from phylesystem_api.caching import cache_stats, SingleFlight
+from phylesystem_api.compression import compress_response, etag_variants
+from phylesystem_api.json_patch import apply_json_patch, JSONPatchError, JSONPatchTestFailed
+from phylesystem_api.utility import (append_tree_to_collection_helper, batch_thread_pool,
+                                     bulk_write_operation, collection_args_helper,
+                                     create_list_of_collections,
+                                     do_http_post_json, doc_state_token, doc_store_status,
+                                     document_etag,
+                                     err_body, extract_bulk_write_args, extract_write_args,
+                                     extract_posted_data,
+                                     fetch_all_docs_and_last_commit, fetch_document,
+                                     fetch_study_skeleton,
+                                     find_duplicate_study_ids,
                                      finish_write_operation, format_gh_webhook_response,
                                      get_ids_of_synth_collections,
                                      get_otindex_base_url, get_taxonomy_api_base_url,
@@ -26,13 +33,23 @@ from phylesystem_api.utility import (append_tree_to_collection_helper,
                                      get_tree_collections_doc_store,
                                      GitPushJob, github_payload_to_amr,
                                      httpexcept, harvest_ott_ids_from_paths,
-                                     harvest_study_ids_from_paths,
-                                     make_valid_doi, otindex_call,
+                                     harvest_study_ids_from_paths, invalidate_cached_document,
+                                     make_valid_doi, otindex_call, parsed_json_body,
+                                     push_failures_for_umbrella,
+                                     json_body_response,
+                                     raw_document_response, render_markdown_html,
+                                     SerializeOnce,
+                                     streaming_json_response, subresource_request_from_params,
                                      subresource_request_helper,
+                                     sync_study_doi_index,
+                                     transform_document,
                                      trigger_push,
-                                     umbrella_from_request, umbrella_with_id_from_request)
+                                     umbrella_for_resource_type, umbrella_from_request,
+                                     umbrella_with_id_from_request)
 
 _LOG = get_logger(__name__)
+# coalesces concurrent GETs of a document with the same ETag
+_DOCUMENT_GET_FLIGHTS = SingleFlight('document_get')
 
 
 ################################################################################
@@ -55,6 +72,27 @@ def index(request):  # pylint: disable=W0613
     }
 
 
+@view_config(route_name='versioned_health', renderer='json')
+def health(request):
+    """Reports whether the server is up and which doc stores are ready, without blocking.
+
+    Returns dict with `status` -> "ok" and `doc_stores` mapping each umbrella name to
+    "ready", "pending" (not built yet) or "failed".
+    """
+    return {"status": "ok",
+            "doc_stores": doc_store_status(request.registry.settings)}
+
+
+@view_config(route_name='cache_stats', renderer='json')
+def get_cache_stats(request):  # pylint: disable=W0613
+    """Returns a dict mapping the name of each in-process cache to its sizes and counters.
+
+    The counters ("hits", "misses", "evictions", "invalidations") are per-process and
+    cumulative since the server started.
+    """
+    return cache_stats()
+
+
 @view_config(route_name='generic_config', renderer='json')
 def generic_config(request):
     """Returns the results of a DocStore.get_configuration_dict() call for the resource type.
@@ -70,6 +108,7 @@ def generic_config(request):
                 "relpath" -> path from the top of the documents dir inside the repo to the document.
         "number_of_shards" -> length of the "shards" list
     """
+    compress_response(request)
     return umbrella_from_request(request).get_configuration_dict()
 
 
@@ -155,12 +194,7 @@ def push_failure(request):
         "errors" -> list of errors. Empty if `pushes_succeeding` is True.
     """
     umbrella = umbrella_from_request(request)
-    settings = request.registry.settings
-    pfd_lock = settings['push_failure_lock']
-    pfd = settings['doc_type_to_push_failure_list']
-    pf = copy_of_push_failures(push_failure_dict=pfd,
-                               push_failure_dict_lock=pfd_lock,
-                               umbrella=umbrella)
+    pf = push_failures_for_umbrella(request.registry.settings, umbrella)
     return {'doc_type': umbrella.document_type,
             'pushes_succeeding': len(pf) == 0,
             'errors': pf, }
@@ -173,6 +207,7 @@ def push_failure(request):
 @view_config(route_name='generic_list', renderer='json')
 def generic_list(request):
     """Returns a list of all of the document IDs in the matched DocStore."""
+    compress_response(request)
     return umbrella_from_request(request).get_doc_ids()
 
 
@@ -271,6 +306,18 @@ def get_document(request):
         "version_history" -> is an optional return.
         "external_url" -> if requested this will be the same URL as a call to `external_url`
         "shardName" -> text description of the shard that holds the document.
+    The `fields` (or `include`) argument, e.g. "fields=data,sha", restricts the envelope to the
+        listed members, and the others are not computed at all.
+    JSON responses are streamed (see `iter_json_chunks`) unless the "stream_document_json"
+        setting is false.
+    Responses are compressed if the client accepts it (see phylesystem_api.compression).
+    Responses carry an ETag (see `document_etag`); a GET with a matching If-None-Match header
+        gets a 304 response without the document being loaded or serialized.
+    Concurrent GETs with the same ETag are coalesced: one of them does the work, and they all
+        send the same serialized body.
+    With "raw=1" the stored JSON of the master version is sent as is (not in an envelope, not
+        converted to another format, and without being parsed), with the SHA of master in the
+        X-Commit-SHA header.
     If the resource requested is a study JSON, then the doi field of the document will be
         used to
         if resource_type == 'study':
@@ -299,35 +346,118 @@ def get_document(request):
     umbrella = umbrella_from_request(request)
     subresource_req_dict, params = subresource_request_helper(request)
     doc_id = params['doc_id']
+    transformer, out_syntax = plausible_transformation(umbrella, subresource_req_dict)
+    parent_sha = params.get('starting_commit_SHA')
+    _LOG.debug('parent_sha = {}'.format(parent_sha))
+    try:
+        token = doc_state_token(umbrella, doc_id, commit_sha=parent_sha)
+        etag = document_etag(token, subresource_req_dict, params, request.url)
+    except:
+        etag = None  # unknown doc_id. Reported as a GET failure below.
+    if etag is not None:
+        for candidate in etag_variants(etag):
+            if candidate in request.if_none_match:
+                raise HTTPNotModified(etag=candidate)
+    if asbool(request.params.get('raw', False)):
+        # the stored form is sent, so output format arguments are ignored
+        if subresource_req_dict.get('subresource_type') or parent_sha:
+            msg = 'raw=1 is only supported for whole documents on the master branch'
+            raise httpexcept(HTTPBadRequest, msg)
+        response = raw_document_response(request, umbrella, doc_id)
+        # the ETag is only sent if master did not move while the document was read
+        if etag is not None and doc_state_token(umbrella, doc_id) == token:
+            response.etag = etag
+        return response
+    if etag is not None:
+        compress_response(request, cache_key=('document', etag))
+    else:
+        compress_response(request)
+    settings = request.registry.settings
+
+    def compute_result():
+        """Runs the GET (once for all concurrent requests with the same ETag)."""
+        return SerializeOnce(document_get_helper(settings, umbrella, resource_type,
+                                                 subresource_req_dict, params, transformer,
+                                                 out_syntax, request.url))
+
+    if etag is None:
+        holder, shared = compute_result(), False
+    else:
+        holder, shared = _DOCUMENT_GET_FLIGHTS.do(etag, compute_result)
+    result = holder.value
+    if subresource_req_dict['output_is_json']:
+        if etag is not None:
+            request.response.etag = etag
+        if shared:
+            # the concurrent requests share one serialization of the result
+            return json_body_response(request, holder.json_body())
+        if asbool(settings.get('stream_document_json', True)):
+            return streaming_json_response(request, result)
+        return result
+    request.override_renderer = 'string'
+    response = Response(body=result, content_type='text/plain')
+    if etag is not None:
+        response.etag = etag
+    return response
+
+
+def plausible_transformation(umbrella, subresource_req_dict):
+    """Returns the (transformer or None, output syntax) for a GET described by
+    `subresource_req_dict`, or raises HTTPBadRequest if the request is impossible."""
     triple = umbrella.is_plausible_transformation(subresource_req_dict)
     is_plausible, reason_or_converter, out_syntax = triple
     if not is_plausible:
         raise httpexcept(HTTPBadRequest, 'Impossible request: {}'.format(reason_or_converter))
-    transformer = reason_or_converter
+    return reason_or_converter, out_syntax
+
+
+def document_get_helper(settings, umbrella, resource_type, subresource_req_dict, params,
+                        transformer, out_syntax, url):
+    """Does the work of a GET of a document or subresource (see `get_document`).
+
+    Returns the response envelope dict if subresource_req_dict['output_is_json'] or the
+    text of the document otherwise. Raises HTTP exceptions for failures.
+    """
+    doc_id = params['doc_id']
     parent_sha = params.get('starting_commit_SHA')
-    _LOG.debug('parent_sha = {}'.format(parent_sha))
-    version_history = None
+    fields = params['fields']
+
+    def wanted(*names):
+        """Returns True if any of the envelope members in `names` should be computed."""
+        return fields is None or not fields.isdisjoint(names)
+
+    if fields is None:
+        with_history = (out_syntax == 'JSON') and params['version_history']
+    else:
+        with_history = (out_syntax == 'JSON') and wanted('version_history', 'versionHistory')
+    r = None
+    if resource_type == 'study':
+        # tree and OTU subresources can be served without decoding the whole study
+        r = fetch_study_skeleton(umbrella, doc_id,
+                                 subresource_req_dict.get('subresource_type'),
+                                 subresource_req_dict.get('subresource_id'),
+                                 commit_sha=parent_sha,
+                                 version_history=with_history)
     try:
-        if (out_syntax == 'JSON') and params['version_history']:
-            r, version_history = umbrella.return_document_and_history(doc_id,
-                                                                      commit_sha=parent_sha,
-                                                                      return_WIP_map=True)
-        else:
-            r = umbrella.return_document(doc_id, commit_sha=parent_sha, return_WIP_map=True)
+        if r is None:
+            r = fetch_document(umbrella, doc_id, commit_sha=parent_sha,
+                               version_history=with_history)
     except:
         _LOG.exception('GET failed')
         raise HTTPNotFound('{r} document {i} GET failure'.format(r=resource_type, i=doc_id))
     # noinspection PyBroadException
     try:
-        document_blob, head_sha, wip_map = r
+        document_blob, head_sha, wip_map, version_history = r
     except:
         _LOG.exception('GET failed')
         raise httpexcept(HTTPBadRequest, err_body(traceback.format_exc()))
-    if transformer is None:
+    skip_transform = subresource_req_dict['output_is_json'] and not wanted('data', 'commentHTML')
+    if transformer is None or skip_transform:
         result_data = document_blob
     else:
         try:
-            result_data = transformer(umbrella, doc_id, document_blob, head_sha)
+            result_data = transform_document(umbrella, doc_id, document_blob, head_sha,
+                                             transformer, subresource_req_dict)
         except KeyError, x:
             raise httpexcept(HTTPNotFound, 'subresource not found: {}'.format(x))
         except ValueError, y:
@@ -336,55 +466,161 @@ def get_document(request):
             msg = "Exception in coercing to the document to the requested type. "
             _LOG.exception(msg)
             raise httpexcept(HTTPBadRequest, err_body(msg))
-    if subresource_req_dict['output_is_json']:
-        result = {'sha': head_sha,
-                  'data': result_data,
-                  'branch2sha': wip_map,
-                  'url': request.url,
-                  }
+    if not subresource_req_dict['output_is_json']:
+        return result_data
+    result = {}
+    for name, value in (('sha', head_sha), ('data', result_data),
+                        ('branch2sha', wip_map), ('url', url)):
+        if wanted(name):
+            result[name] = value
+    if wanted('commentHTML'):
         try:
-            comment_html = render_markdown(umbrella.get_markdown_comment(result_data))
+            comment_html = render_markdown_html(umbrella.get_markdown_comment(result_data))
         except:
             comment_html = ''  # pylint: disable=R0204
         result['commentHTML'] = comment_html
-        try:
-            if version_history is not None:
+    try:
+        if version_history is not None:
+            if wanted('version_history'):
                 result['version_history'] = version_history
-                # TODO get rid of camelCaseVersion
-                result['versionHistory'] = result['version_history']
-        except:
-            _LOG.exception('populating of version_history failed for {}'.format(doc_id))
-        try:
-            if params.get('external_url'):
-                result['external_url'] = umbrella.get_public_url(doc_id)
-        except:
-            _LOG.exception('populating of external_url failed for {}'.format(doc_id))
+            # TODO get rid of camelCaseVersion
+            if wanted('versionHistory'):
+                result['versionHistory'] = version_history
+    except:
+        _LOG.exception('populating of version_history failed for {}'.format(doc_id))
+    try:
+        if (params.get('external_url') and fields is None) or \
+                (fields is not None and 'external_url' in fields):
+            result['external_url'] = umbrella.get_public_url(doc_id)
+    except:
+        _LOG.exception('populating of external_url failed for {}'.format(doc_id))
+    if wanted('shardName'):
         try:
             result['shardName'] = umbrella.get_repo_and_path_fragment(doc_id)[0]
         except:
             _LOG.exception('populating of shardName failed for {}'.format(doc_id))
-        if resource_type == 'study':
-            duplicate_study_ids = []
+    if resource_type == 'study' and wanted('duplicateStudyIDs'):
+        duplicate_study_ids = []
+        try:
+            study_doi = document_blob['nexml']['^ot:studyPublication']['@href']
+        except:
+            pass  # no DOI
+        else:
             try:
-                study_doi = document_blob['nexml']['^ot:studyPublication']['@href']
+                duplicate_study_ids = find_duplicate_study_ids(settings, doc_id, study_doi)
             except:
-                pass  # no DOI
-            else:
-                try:
-                    oti_domain = get_otindex_base_url(request)
-                    duplicate_study_ids = find_studies_by_doi(oti_domain, study_doi)
-                except:
-                    _LOG.exception('Call to find_studies_by_doi failed')
-                else:
-                    try:
-                        duplicate_study_ids.remove(doc_id)
-                    except:
-                        pass
-            if duplicate_study_ids:
-                result['duplicateStudyIDs'] = duplicate_study_ids
-        return result
-    request.override_renderer = 'string'
-    return Response(body=result_data, content_type='text/plain')
+                _LOG.exception('Call to find_duplicate_study_ids failed')
+        if duplicate_study_ids:
+            result['duplicateStudyIDs'] = duplicate_study_ids
+    return result
+
+
+@view_config(route_name='batch_get', renderer='json', request_method='POST')
+def batch_get(request):
+    """Resolves a list of document/subresource GETs in one call.
+
+    The JSON body holds:
+        "requests" -> list of objects with the "resource_type" and "doc_id" of a document and
+            any of the other arguments of a GET of a document (e.g. "subresource_type",
+            "subresource_id", "format", "fields"...).
+        "output" -> "ndjson" (the default) or "json"
+    The items are resolved in parallel by a bounded pool of threads (see `batch_thread_pool`).
+    Each item yields an object with "key" (the index of the item as a string), "status" (the
+    HTTP status that a GET of the item would have had) and either "body" (the response to
+    the GET, or its text for non-JSON formats) or "error" (a description of the failure).
+    With "ndjson" output, the response has one such object per line, in the order of the
+    requests. With "json" output, the response is an object mapping each key to its object.
+    """
+    settings = request.registry.settings
+    try:
+        body = parsed_json_body(request)
+        items = body['requests']
+        assert isinstance(items, list)
+    except:
+        raise httpexcept(HTTPBadRequest, 'Expecting a JSON body with a "requests" list')
+    output = body.get('output', 'ndjson')
+    if output not in ('ndjson', 'json'):
+        raise httpexcept(HTTPBadRequest, '"output" must be "ndjson" or "json"')
+    max_items = int(settings.get('batch_max_items', 1000))
+    if len(items) > max_items:
+        msg = 'A batch can contain at most {} requests'.format(max_items)
+        raise httpexcept(HTTPBadRequest, msg)
+    keyed_items = [(str(index), item) for index, item in enumerate(items)]
+
+    def resolve(keyed_item):
+        """Returns the result object for one (key, item) pair."""
+        return _batch_get_item(request, settings, keyed_item[0], keyed_item[1])
+
+    pool = batch_thread_pool(settings)
+    compress_response(request)
+    if output == 'json':
+        return streaming_json_response(request, dict(pool.map(resolve, keyed_items)))
+
+    def iter_lines():
+        """Yields one line of JSON per item, as the items are resolved."""
+        for key, result in pool.imap(resolve, keyed_items):
+            yield json.dumps(result) + '\n'
+
+    response = request.response
+    response.content_type = 'application/x-ndjson'
+    response.charset = 'UTF-8'
+    response.app_iter = iter_lines()
+    return response
+
+
+def _batch_get_item(request, settings, key, item):
+    """Returns (key, result object) for one item of a `batch_get` call. Never raises."""
+    result = {'key': key}
+    try:
+        if not isinstance(item, dict):
+            raise httpexcept(HTTPBadRequest, 'Each request must be an object')
+        try:
+            resource_type, doc_id = item['resource_type'], item['doc_id']
+        except KeyError:
+            raise httpexcept(HTTPBadRequest, 'Each request needs "resource_type" and "doc_id"')
+        umbrella = umbrella_for_resource_type(settings, resource_type)
+        subresource_req_dict, params = subresource_request_from_params(item)
+        transformer, out_syntax = plausible_transformation(umbrella, subresource_req_dict)
+        url_parts = [request.application_url, request.matchdict['api_version'], resource_type,
+                     doc_id]
+        for k in ('subresource_type', 'subresource_id'):
+            if item.get(k):
+                url_parts.append(item[k])
+        url = '/'.join(url_parts)
+        result['body'] = document_get_helper(settings, umbrella, resource_type,
+                                             subresource_req_dict, params, transformer,
+                                             out_syntax, url)
+        result['status'] = 200
+    except HTTPException, x:
+        result['status'] = x.status_int
+        try:
+            result['error'] = json.loads(x.body)['description']
+        except:
+            result['error'] = x.detail or x.title
+    except:
+        _LOG.exception('batch item {} failed'.format(key))
+        result['status'] = 500
+        result['error'] = 'Unexpected error resolving the request'
+    return key, result
+
+
+@view_config(route_name='bulk_write', renderer='json', request_method='POST')
+def bulk_write(request):
+    """Creates or updates a list of documents of one resource type in one call.
+
+    See `extract_bulk_write_args` for the arguments, and `bulk_write_operation` for how the
+    documents are written. The response holds "results" -> the list of the annotated commits
+    (or failures) of the documents, in the order of the request, and "error" -> 1 if any
+    document failed (otherwise 0).
+    """
+    umbrella = umbrella_from_request(request)
+    auth_info, items = extract_bulk_write_args(request)
+    results = bulk_write_operation(request, umbrella, items, auth_info)
+    num_failed = len([r for r in results if r.get('error', 0) != 0])
+    description = '{} of {} documents written'.format(len(results) - num_failed, len(results))
+    return {'error': 1 if num_failed else 0,
+            'description': description,
+            'results': results, }
 
 
 ################################################################################
@@ -437,6 +673,75 @@ def put_document(request):
     return finish_write_operation(request, umbrella, document, put_args)
 
 
+################################################################################
+# PATCH - edit the doc with a JSON Patch (RFC 6902) against its parent version
+
+@view_config(route_name='patch_study_via_id', renderer='json', request_method='PATCH')
+def patch_study_document(request):
+    """PATCH method for editing an existing study.
+    Adds "resource_type" -> "study" then calls generic `patch_document`.
+    """
+    request.matchdict['resource_type'] = 'study'
+    return patch_document(request)
+
+
+@view_config(route_name='patch_taxon_amendment_via_id', renderer='json', request_method='PATCH')
+def patch_amendment_document(request):
+    """PATCH method for editing an existing taxon amendment.
+    Adds "resource_type" -> "taxon_amendments" then calls generic `patch_document`.
+    """
+    request.matchdict['resource_type'] = 'taxon_amendments'
+    return patch_document(request)
+
+
+@view_config(route_name='patch_tree_collection_via_id', renderer='json', request_method='PATCH')
+def patch_collection_document(request):
+    """PATCH method for editing an existing tree_collection.
+    Adds "resource_type" -> "tree_collections" and
+    "doc_id" then calls generic `patch_document`.
+    """
+    request.matchdict['resource_type'] = 'tree_collections'
+    u_c = [request.matchdict.get('coll_user_id', ''), request.matchdict.get('coll_id', ''), ]
+    request.matchdict['doc_id'] = '/'.join(u_c)
+    return patch_document(request)
+
+
+def patch_document(request):
+    """Open Tree API methods for editing existing resources with a JSON Patch.
+
+    The body is the JSON Patch (an array of operations) or an object with the patch as its
+    "patch" member. The patch is applied to the stored form of the version of the document at
+    "starting_commit_SHA", and the result is written as if it had been PUT.
+    See `finish_write_operation` for description of the response.
+    """
+    body, put_args = extract_write_args(request, require_document=False)
+    parent_sha = put_args.get('starting_commit_SHA')
+    if parent_sha is None:
+        msg = 'PATCH operation expects a "starting_commit_SHA" argument with the SHA of the parent'
+        raise httpexcept(HTTPBadRequest, msg)
+    doc_id = put_args.get('doc_id')
+    if doc_id is None:
+        msg = 'PATCH operation expects a URL that ends with a document ID'
+        raise httpexcept(HTTPBadRequest, msg)
+    patch = body.get('patch') if isinstance(body, dict) else body
+    if patch is None:
+        raise httpexcept(HTTPBadRequest, 'PATCH operation expects a JSON Patch in the body')
+    umbrella = umbrella_from_request(request)
+    try:
+        base_document = fetch_document(umbrella, doc_id, commit_sha=parent_sha)[0]
+    except:
+        _LOG.exception('PATCH could not read the parent version')
+        msg = 'version {} of document {} could not be read'.format(parent_sha, doc_id)
+        raise httpexcept(HTTPNotFound, msg)
+    try:
+        document = apply_json_patch(base_document, patch)
+    except JSONPatchTestFailed, x:
+        raise httpexcept(HTTPConflict, 'JSON Patch test failed: {}'.format(x))
+    except JSONPatchError, x:
+        raise httpexcept(HTTPBadRequest, 'JSON Patch could not be applied: {}'.format(x))
+    return finish_write_operation(request, umbrella, document, put_args)
+
+
 ################################################################################
 # Create a new doc by POSTing new data or information about how to create a
 #   minimal doc.
@@ -587,7 +892,9 @@ def delete_document(request):
     except:
         _LOG.exception('Exception deleting document {} in DELETE'.format(doc_id))
     else:
+        invalidate_cached_document(umbrella, doc_id)
         if x.get('error') == 0:
+            sync_study_doi_index(request.registry.settings)
             trigger_push(request,
                          umbrella=umbrella,
                          doc_id=doc_id,
@@ -623,7 +930,7 @@ def study_options(request):
     """A simple method for approving CORS preflight request"""
     response = Response(status_code=200)
     if request.env.http_access_control_request_method:
-        response.headers['Access-Control-Allow-Methods'] = 'POST,GET,DELETE,PUT,OPTIONS'
+        response.headers['Access-Control-Allow-Methods'] = 'POST,GET,DELETE,PUT,PATCH,OPTIONS'
     if request.env.http_access_control_request_headers:
         headers = 'Origin, Content-Type, Accept, Authorization'
         response.headers['Access-Control-Allow-Headers'] = headers
@@ -649,12 +956,15 @@ def nudge_study_index(request):
     payload = extract_posted_data(request)
     add_or_update_ids, modified, remove_ids = github_payload_to_amr(payload,
                                                                     harvest_study_ids_from_paths)
-    add_or_update_ids.add(modified)
+    add_or_update_ids |= modified
     sds = get_phylesystem_doc_store(request)
     # this check will not be sufficient if we have multiple shards
     opentree_docstore_url = sds.remote_docstore_url
     if payload['repository']['url'] != opentree_docstore_url:
         raise httpexcept(HTTPBadRequest, "wrong repo for this API instance")
+    for doc_id in add_or_update_ids | remove_ids:
+        invalidate_cached_document(sds, doc_id)
+    sync_study_doi_index(request.registry.settings)
     otindex_base_url = get_otindex_base_url(request)
     msg = ""
     if add_or_update_ids:
@@ -690,6 +1000,8 @@ def nudge_taxon_index(request):
         raise httpexcept(HTTPBadRequest, "wrong repo for this API instance")
     added_ids, modified_ids, removed_ids = github_payload_to_amr(payload,
                                                                  harvest_ott_ids_from_paths)
+    for doc_id in added_ids | modified_ids | removed_ids:
+        invalidate_cached_document(tads, doc_id)
     msg_list = []
     # build a working URL, gather amendment body, and nudge the index!
     amendments_api_base_url = get_taxonomy_api_base_url(request)
@@ -749,6 +1061,7 @@ def synth_collection_helper(request):
 @view_config(route_name='trees_in_synth', renderer='json')
 def trees_in_synth(request):
     """Returns a collection that is the concatenation of all trees queued for synthesis."""
+    compress_response(request)
     return synth_collection_helper(request)[3]
 
 
@@ -822,6 +1135,8 @@ def exclude_tree_from_synth(request):
                 raise httpexcept(HTTPInternalServerError, err.msg)
             except:
                 raise httpexcept(HTTPBadRequest, traceback.format_exc())
+            finally:
+                invalidate_cached_document(cds, coll_id)
             # We only need to push once per affected shard even if multiple
             # collections in the shard change...
             mn = commit_return.get('merge_needed')
@@ -849,15 +1164,4 @@ def render_markdown(request):
         src = data['src']
     except KeyError:
         raise httpexcept(HTTPBadRequest, '"src" parameter not found in POST')
-
-    # noinspection PyUnusedLocal
-    def add_blank_target(attrs, new=False):  # pylint: disable=W0613
-        """Hook to add target="_blank" to links created by bleach.linkify"""
-        attrs['target'] = '_blank'
-        return attrs
-
-    h = markdown.markdown(src)
-    ct = ['p', 'a', 'hr', 'i', 'em', 'b', 'div', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4']
-    h = bleach.clean(h, tags=ct)
-    h = bleach.linkify(h, callbacks=[add_blank_target])
-    return Response(h)
+    return Response(render_markdown_html(src))
@@ -39,10 +39,15 @@ setup(name='phylesystem_api',
       zip_safe=False,
       install_requires=requires,
       tests_require=tests_require,
-      extras_require={'testing': tests_require, },
+      extras_require={'testing': tests_require,
+                      'brotli': ['brotli'],
+                      'ijson': ['ijson'],
+                      'simplejson': ['simplejson'], },
       test_suite="phylesystem_api",
       entry_points="""\
       [paste.app_factory]
       main = phylesystem_api:main
+      [paste.server_runner]
+      prefork = phylesystem_api.prefork:prefork_server_runner
       """,
       )